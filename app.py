@@ -1,12 +1,70 @@
-from flask import Flask, request, render_template, jsonify
+from flask import Flask, g, request, render_template, jsonify, Response, stream_with_context
 from flask_cors import CORS  # Import flask-cors
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
+from werkzeug.wsgi import get_input_stream
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict, deque, namedtuple
+from itertools import chain, repeat
+import argparse
+import hashlib
+import io
+import json
+import os
 import re
 from enum import Enum
 import sys
+import tempfile
+import threading
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # Optional, gzip is always available
+    zstandard = None
+
+from jobs import DONE, FAILED, RUNNING, JobStore
+from metrics import CallbackMetric, Counter, Histogram, Registry
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
+# Defaults, overridable with FLASK_-prefixed environment variables
+# (e.g. FLASK_MAX_BATCH_ITEMS=500)
+app.config.update(
+    MAX_BATCH_ITEMS=1000,               # Documents accepted by /api/convert/batch
+    MAX_BATCH_BYTES=50 * 1024 * 1024,   # Total wikitext size accepted by /api/convert/batch
+    BATCH_CHUNK_SIZE=16,                # Documents sent to a worker at a time
+    CONVERT_WORKERS=None,               # Worker processes, defaults to the number of CPUs
+    CONVERSION_CACHE_MAX_ENTRIES=1024,  # Cached conversions, 0 disables the cache
+    CONVERSION_CACHE_MAX_BYTES=64 * 1024 * 1024,  # Memory used by cached conversions
+    CONVERSION_ETAGS=True,              # Send ETag and honour If-None-Match on /api/convert
+    INCREMENTAL_CONVERSION=True,        # Reuse the tokens of unchanged paragraphs in the web routes
+    SEGMENT_CACHE_MAX_ENTRIES=65536,    # Memoised paragraphs
+    SEGMENT_CACHE_MAX_BYTES=128 * 1024 * 1024,  # Memory used by memoised paragraphs
+    INLINE_CONVERT_MAX_BYTES=1024 * 1024,  # Larger pages sent to /api/convert?async=1 become jobs, None disables
+    STREAM_CONVERT_MIN_BYTES=256 * 1024,  # Larger pages that do not become jobs are streamed, None disables
+    MAX_JOB_BYTES=50 * 1024 * 1024,     # Largest page accepted by /api/jobs
+    MAX_PENDING_JOBS=64,                # Jobs queued or running at a time
+    JOB_WORKERS=2,                      # Worker processes for jobs
+    JOB_TTL=3600,                       # Seconds a job is kept after its last update
+    JOB_DATABASE=os.path.join(tempfile.gettempdir(), 'wiki-translate-tagger-jobs.sqlite3'),
+    CONVERSION_METRICS=True,            # Record stage timings and construct counts for /metrics
+    MAX_INPUT_BYTES=10 * 1024 * 1024,   # Largest page converted synchronously, larger ones get a 413
+    TRACE_MAX_TOKENS=10000,             # Tokens listed by /api/convert?trace=1, None lists them all
+    CONVERSION_TIME_BUDGET=10,          # Seconds a synchronous conversion may take before a 422, None disables
+    ASYNC_CONVERT_WORKERS=None,         # Worker processes of asgi.py, defaults to the number of CPUs
+    ASYNC_MAX_QUEUED=64,                # Requests waiting for a worker or thread in asgi.py before a 503
+    ASYNC_INLINE_MAX_BYTES=8 * 1024,    # Smaller pages are converted by asgi.py without a worker
+    ASYNC_LARGE_MIN_BYTES=64 * 1024,    # Larger pages may only use half of the asgi.py workers
+    ASYNC_FLASK_THREADS=16,             # Threads of asgi.py serving the requests left to the Flask app
+    MAX_DECOMPRESSED_BYTES=100 * 1024 * 1024,  # Largest request body once decompressed, larger ones get a 413
+    COMPRESS_MIN_BYTES=1024,            # Smaller responses are not compressed, None disables compression
+    SITE_TAGS={},                       # Extra tags, {name: "wrap" | "tvar" | "passthrough" | "recurse" | "gallery" | "inline"}
+    SITEINFO_DIR=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'siteinfo'),  # <wiki>.json siteinfo files
+)
+app.config.from_prefixed_env()
+
 behaviour_switches = ['__NOTOC__', '__FORCETOC__', '__TOC__', '__NOEDITSECTION__', '__NEWSECTIONLINK__', '__NONEWSECTIONLINK__', '__NOGALLERY__', '__HIDDENCAT__', '__EXPECTUNUSEDCATEGORY__', '__NOCONTENTCONVERT__', '__NOCC__', '__NOTITLECONVERT__', '__NOTC__', '__START__', '__END__', '__INDEX__', '__NOINDEX__', '__STATICREDIRECT__', '__EXPECTUNUSEDTEMPLATE__', '__NOGLOBAL__', '__DISAMBIG__', '__EXPECTED_UNCONNECTED_PAGE__', '__ARCHIVEDTALK__', '__NOTALK__', '__EXPECTWITHOUTSCANS__']
 
 # --- Helper Functions for Processing Different Wikitext Elements ---
@@ -41,6 +99,9 @@ def is_emoji_unicode(char):
     # Add more ranges as needed for full coverage
     return False
 
+# Whitespace kept outside the <translate> tags
+_WRAP_WHITESPACE = ' \n\t\r\f\v'
+
 def _wrap_in_translate(text):
     """
     Wraps the given text with <translate> tags.
@@ -48,217 +109,136 @@ def _wrap_in_translate(text):
     The <translate> tags are added around the non-whitespace content,
     preserving leading and trailing whitespace.
     """
-    if not text or not text.strip():
-        return text
-
-    # Find the first and last non-whitespace characters
-    first_char_index = -1
-    last_char_index = -1
-    for i, char in enumerate(text):
-        if char not in (' ', '\n', '\t', '\r', '\f', '\v'): # Check for common whitespace characters
-            if first_char_index == -1:
-                first_char_index = i
-            last_char_index = i
-
-    # If no non-whitespace characters are found (should be caught by text.strip() check, but for robustness)
-    if first_char_index == -1:
+    if not text or text.isspace():
         return text
-
-    leading_whitespace = text[:first_char_index]
-    content = text[first_char_index : last_char_index + 1]
-    trailing_whitespace = text[last_char_index + 1 :]
-
+    content = text.strip(_WRAP_WHITESPACE)
+    if len(content) == len(text):
+        return f"<translate>{text}</translate>"
+    leading_length = len(text) - len(text.lstrip(_WRAP_WHITESPACE))
+    leading_whitespace = text[:leading_length]
+    trailing_whitespace = text[leading_length + len(content):]
     return f"{leading_whitespace}<translate>{content}</translate>{trailing_whitespace}"
 
-def process_syntax_highlight(text):
+class TagPolicy(Enum):
     """
-    Processes <syntaxhighlight> tags in the wikitext.
-    It wraps the content in <translate> tags.
+    What the converter does with a tag and its content.
     """
-    assert(text.startswith('<syntaxhighlight') and text.endswith('</syntaxhighlight>')), "Invalid syntax highlight tag"
-    # Get inside the <syntaxhighlight> tag
-    start_tag_end = text.find('>') + 1
-    end_tag_start = text.rfind('<')
-    if start_tag_end >= end_tag_start:
-        return text 
-    prefix = text[:start_tag_end]
-    content = text[start_tag_end:end_tag_start].strip()
-    suffix = text[end_tag_start:]
-    if not content:
-        return text
-    # Wrap the content in <translate> tags
-    wrapped_content = _wrap_in_translate(content)
-    return f"{prefix}{wrapped_content}{suffix}"
+    wrap = 1         # The content is wrapped in <translate> tags
+    tvar = 2         # The content is kept in a <tvar>, numbered per tag name
+    passthrough = 3  # The tag is copied unchanged
+    recurse = 4      # The content is converted as wikitext, e.g. the links in a <ref>
+    gallery = 5      # Every line is a file whose caption is converted as wikitext
+    inline = 6       # Kept in the surrounding <translate> block, with its links converted, e.g. <ref>
 
-def process_table(text):
-    """
-    Processes table blocks in the wikitext.
-    It wraps the content in <translate> tags.
-    """
-    assert(text.startswith('{|') and text.endswith('|}')), "Invalid table tag"
-    return text
+# Policy of the tags the tokeniser recognises, by tag name. Use
+# register_tag() to change it, or the SITE_TAGS setting.
+TAG_POLICIES = {
+    'syntaxhighlight': TagPolicy.wrap,
+    'blockquote': TagPolicy.wrap,
+    'poem': TagPolicy.wrap,
+    'code': TagPolicy.tvar,
+    'div': TagPolicy.wrap,
+    'hiero': TagPolicy.wrap,
+    'sub': TagPolicy.wrap,
+    'sup': TagPolicy.wrap,
+    'math': TagPolicy.passthrough,
+    'small': TagPolicy.wrap,
+    'nowiki': TagPolicy.wrap,
+    'br': TagPolicy.passthrough,
+    # Extension tags
+    'ref': TagPolicy.inline,
+    'references': TagPolicy.passthrough,
+    'gallery': TagPolicy.gallery,
+    'includeonly': TagPolicy.passthrough,
+    'noinclude': TagPolicy.recurse,
+    'onlyinclude': TagPolicy.recurse,
+    'pre': TagPolicy.passthrough,
+    'score': TagPolicy.passthrough,
+    'timeline': TagPolicy.passthrough,
+    'graph': TagPolicy.passthrough,
+    'mapframe': TagPolicy.passthrough,
+    'maplink': TagPolicy.passthrough,
+    'templatedata': TagPolicy.passthrough,
+    'chem': TagPolicy.passthrough,
+    'ce': TagPolicy.passthrough,
+    # Translate markup, left as it is so that converting twice changes nothing
+    'translate': TagPolicy.passthrough,
+    'tvar': TagPolicy.passthrough,
+    'languages': TagPolicy.passthrough,
+}
 
-def process_blockquote(text):
-    """
-    Processes blockquote tags in the wikitext.
-    It wraps the content in <translate> tags.
-    """
-    assert(text.startswith('<blockquote>') and text.endswith('</blockquote>')), "Invalid blockquote tag"
-    start_tag_end = text.find('>') + 1
-    end_tag_start = text.rfind('<')
-    if start_tag_end >= end_tag_start:
-        return text 
-    prefix = text[:start_tag_end]
-    content = text[start_tag_end:end_tag_start].strip()
-    suffix = text[end_tag_start:]
-    if not content:
-        return text
-    # Wrap the content in <translate> tags
-    wrapped_content = _wrap_in_translate(content)
-    return f"{prefix}{wrapped_content}{suffix}"
+# Tags that have no closing tag, such as <br>
+VOID_TAGS = {'br', 'languages'}
 
-def process_poem_tag(text):
+def _is_marked_up(text):
     """
-    Processes <poem> tags in the wikitext.
-    It wraps the content in <translate> tags.
+    Whether the text already has Translate markup.
     """
-    assert(text.startswith('<poem') and text.endswith('</poem>')), "Invalid poem tag"
-    start_tag_end = text.find('>') + 1
-    end_tag_start = text.rfind('<')
-    if start_tag_end >= end_tag_start:
-        return text 
-    prefix = text[:start_tag_end]
-    content = text[start_tag_end:end_tag_start].strip()
-    suffix = text[end_tag_start:]
-    if not content:
-        return text
-    # Wrap the content in <translate> tags
-    wrapped_content = _wrap_in_translate(content)
-    return f"{prefix}{wrapped_content}{suffix}"
+    return '<translate' in text or '<tvar' in text or '</translate>' in text or '</tvar>' in text
 
-def process_code_tag(text, tvar_code_id=0):
-    """
-    Processes <code> tags in the wikitext.
-    It wraps the content in <translate> tags.
-    """
-    assert(text.startswith('<code') and text.endswith('</code>')), "Invalid code tag"
-    # Get inside the <code> tag
-    start_tag_end = text.find('>') + 1
-    end_tag_start = text.rfind('<')
-    if start_tag_end >= end_tag_start:
-        return text 
-    prefix = text[:start_tag_end]
-    content = text[start_tag_end:end_tag_start].strip()
-    suffix = text[end_tag_start:]
-    if not content:
-        return text
-    # Wrap the content in <translate> tags
-    wrapped_content = f'<tvar name=code{tvar_code_id}>{content}</tvar>'
-    return f"{prefix}{wrapped_content}{suffix}"
+# Translate tags, opening or closing
+_TRANSLATE_TAG_RE = re.compile(r'<(/?)(translate|tvar)(?=[\s/>])')
+_TRANSLATE_TAGS = frozenset(['translate', 'tvar'])
 
-def process_div(text):
+def _breaks_units(text):
     """
-    Processes <div> tags in the wikitext.
-    It wraps the content in <translate> tags.
+    Whether the text would break the <translate> block it is put in: it
+    has <translate> tags, which do not nest, or <tvar> tags that are not
+    closed or close nothing.
     """
-    assert(text.startswith('<div') and text.endswith('</div>')), "Invalid div tag"
-    start_tag_end = text.find('>') + 1
-    end_tag_start = text.rfind('<')
-    if start_tag_end >= end_tag_start:
-        return text 
-    prefix = text[:start_tag_end]
-    content = text[start_tag_end:end_tag_start].strip()
-    suffix = text[end_tag_start:]
-    if not content:
-        return text
-    # Wrap the content in <translate> tags
-    wrapped_content = _wrap_in_translate(content)
-    return f"{prefix}{wrapped_content}{suffix}"
+    depth = 0
+    for match in _TRANSLATE_TAG_RE.finditer(text):
+        closing, name = match.groups()
+        if name == 'translate' or (closing and not depth):
+            return True
+        depth += -1 if closing else 1
+    return depth != 0
 
-def process_hiero(text):
+def _split_tag(text):
     """
-    Processes <hiero> tags in the wikitext.
-    It wraps the content in <translate> tags.
+    Splits a tag with its content, e.g. <div class="x"> a </div>, into the
+    opening tag, the content without surrounding whitespace and the closing
+    tag. Returns None if the content is empty.
     """
-    assert(text.startswith('<hiero>') and text.endswith('</hiero>')), "Invalid hiero tag"
-    start_tag_end = text.find('>') + 1
-    end_tag_start = text.rfind('<')
-    if start_tag_end >= end_tag_start:
-        return text 
-    prefix = text[:start_tag_end]
-    content = text[start_tag_end:end_tag_start].strip()
-    suffix = text[end_tag_start:]
+    start = text.find('>') + 1
+    end = text.rfind('<')
+    if start >= end:
+        return None
+    content = text[start:end].strip()
     if not content:
-        return text
-    # Wrap the content in <translate> tags
-    wrapped_content = _wrap_in_translate(content)
-    return f"{prefix}{wrapped_content}{suffix}"
+        return None
+    return text[:start], content, text[end:]
 
-def process_sub_sup(text):
+def process_wrapped_tag(text):
     """
-    Processes <sub> and <sup> tags in the wikitext.
-    It wraps the content in <translate> tags.
+    Processes the tags with the wrap policy, e.g. <div> or <poem>.
+    It wraps the content in <translate> tags, dropping the whitespace
+    around it.
     """
-    assert((text.startswith('<sub>') and text.endswith('</sub>')) or
-           (text.startswith('<sup>') and text.endswith('</sup>'))), "Invalid sub/sup tag"
-    start_tag_end = text.find('>') + 1
-    end_tag_start = text.rfind('<')
-    if start_tag_end >= end_tag_start:
-        return text 
-    prefix = text[:start_tag_end]
-    content = text[start_tag_end:end_tag_start].strip()
-    suffix = text[end_tag_start:]
-    if not content:
+    parts = _split_tag(text)
+    if parts is None or _is_marked_up(parts[1]):
         return text
-    # Wrap the content in <translate> tags
-    wrapped_content = _wrap_in_translate(content)
-    return f"{prefix}{wrapped_content}{suffix}"
-
-def process_math(text):
-    """
-    Processes <math> tags in the wikitext.
-    It wraps the content in <translate> tags.
-    """
-    assert(text.startswith('<math>') and text.endswith('</math>')), "Invalid math tag"
-    return text
+    prefix, content, suffix = parts
+    return f"{prefix}<translate>{content}</translate>{suffix}"
 
-def process_small_tag(text):
+def process_tvar_tag(text, tvar_name):
     """
-    Processes <small> tags in the wikitext.
-    It wraps the content in <translate> tags.
+    Processes the tags with the tvar policy, e.g. <code>.
+    It keeps the content in a <tvar> named `tvar_name`.
     """
-    assert(text.startswith('<small>') and text.endswith('</small>')), "Invalid small tag"
-    start_tag_end = text.find('>') + 1
-    end_tag_start = text.rfind('<')
-    if start_tag_end >= end_tag_start:
-        return text 
-    prefix = text[:start_tag_end]
-    content = text[start_tag_end:end_tag_start].strip()
-    suffix = text[end_tag_start:]
-    if not content:
+    parts = _split_tag(text)
+    if parts is None:
         return text
-    # Wrap the content in <translate> tags
-    wrapped_content = _wrap_in_translate(content)
-    return f"{prefix}{wrapped_content}{suffix}"
+    prefix, content, suffix = parts
+    return f"{prefix}<tvar name={tvar_name}>{content}</tvar>{suffix}"
 
-def process_nowiki(text):
+def process_table(text):
     """
-    Processes <nowiki> tags in the wikitext.
+    Processes table blocks in the wikitext.
     It wraps the content in <translate> tags.
     """
-    assert(text.startswith('<nowiki>') and text.endswith('</nowiki>')), "Invalid nowiki tag"
-    start_tag_end = text.find('>') + 1
-    end_tag_start = text.rfind('<')
-    if start_tag_end >= end_tag_start:
-        return text 
-    prefix = text[:start_tag_end]
-    content = text[start_tag_end:end_tag_start].strip()
-    suffix = text[end_tag_start:]
-    if not content:
-        return text
-    # Wrap the content in <translate> tags
-    wrapped_content = _wrap_in_translate(content)
-    return f"{prefix}{wrapped_content}{suffix}"
+    assert(text.startswith('{|') and text.endswith('|}')), "Invalid table tag"
+    return text
 
 def process_item(text):
     """
@@ -271,17 +251,212 @@ def process_item(text):
     elif text.startswith(':'):
         offset = 1
     elif text.startswith('#'):
-        while text[offset] == '#':
-            offset += 1
+        offset = len(text) - len(text.lstrip('#'))
     elif text.startswith('*'):
-        while text[offset] == '*':
-            offset += 1
+        offset = len(text) - len(text.lstrip('*'))
     # Add translate tags around the item content
     item_content = text[offset:].strip()
-    if not item_content:
+    if not item_content or _is_marked_up(item_content):
         return text
     return text[:offset] + ' ' + _wrap_in_translate(item_content) + '\n'
 
+_NESTED_PIPE_RE = re.compile(r'\[\[|\]\]|\{\{|\}\}|\|')
+
+def _split_top_level(text):
+    """
+    Splits the text on '|' characters that are not inside nested
+    [[...]] links or {{...}} templates, e.g. in file captions.
+    """
+    if '[[' not in text and '{{' not in text:
+        return text.split('|')
+    fields = []
+    start = 0
+    depth = 0
+    for match in _NESTED_PIPE_RE.finditer(text):
+        token = match.group()
+        if token == '|':
+            if depth == 0:
+                fields.append(text[start:match.start()])
+                start = match.end()
+        elif token in ('[[', '{{'):
+            depth += 1
+        elif depth:
+            depth -= 1
+    fields.append(text[start:])
+    return fields
+
+# --- Link Classification ---
+# Tables and matchers used to classify links, built once at import time.
+
+# Namespace names, localised ones included, by canonical namespace. Used
+# when no wiki is given; per-wiki names are loaded from siteinfo files.
+NAMESPACE_ALIASES = {
+    'File': [
+        'File', 'Image', 'Datei', 'Bild', 'Fichier', 'Archivo', 'Imagen', 'Immagine', 'Ficheiro',
+        'Arquivo', 'Imagem', 'Plik', 'Grafika', 'Bestand', 'Afbeelding', 'Файл', 'Изображение',
+        'ファイル', '画像', '文件', '图像',
+    ],
+    'Category': [
+        'Category', 'Cat', 'Kategorie', 'Catégorie', 'Categoría', 'Categoria', 'Kategoria',
+        'Categorie', 'Категория', 'カテゴリ', '分类',
+    ],
+    'Special': [
+        'Special', 'Spezial', 'Spécial', 'Especial', 'Speciale', 'Specjalna', 'Speciaal',
+        'Служебная', '特別', '特殊',
+    ],
+}
+
+# Namespace IDs of the namespaces the converter treats specially
+NAMESPACE_IDS = {6: 'File', 14: 'Category', -1: 'Special'}
+
+def _normalise_namespace_name(name):
+    # Namespace names are case-insensitive and spaces and underscores are equivalent
+    return name.lower().replace('_', ' ')
+
+def _trie_pattern(names):
+    """
+    Returns a regex pattern matching any of `names`, with the alternatives
+    factored into a prefix trie so that a name is recognised in one pass
+    however many aliases there are.
+    """
+    trie = {}
+    for name in names:
+        node = trie
+        for char in name:
+            node = node.setdefault(char, {})
+        node[''] = {}  # End of a name
+
+    def build(node):
+        branches = [
+            ('[ _]' if char == ' ' else re.escape(char)) + build(child)
+            for char, child in sorted(node.items()) if char
+        ]
+        if not branches:
+            return ''
+        pattern = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        if '' in node:
+            pattern = f'(?:{pattern})?'
+        return pattern
+
+    return build(trie)
+
+class NamespaceRegistry:
+    """
+    Names and aliases of the File, Category and Special namespaces of one
+    wiki, compiled into a single case-insensitive regex.
+    `aliases` maps each canonical namespace to its names.
+    """
+
+    def __init__(self, name, aliases):
+        self.name = name
+        self.names = {
+            _normalise_namespace_name(alias): namespace
+            for namespace, namespace_aliases in aliases.items() for alias in namespace_aliases
+        }
+        self.regex = re.compile(r'\s*(' + _trie_pattern(self.names) + '):', re.IGNORECASE)
+        # Identifies the names in ETags, which change when the siteinfo does
+        self.fingerprint = hashlib.sha256(repr(sorted(self.names.items())).encode('utf-8')).hexdigest()[:12]
+
+    @classmethod
+    def from_siteinfo(cls, name, siteinfo):
+        """
+        Builds the registry from the output of
+        api.php?action=query&meta=siteinfo&siprop=namespaces|namespacealiases
+        in either JSON format version. Canonical English names are always
+        recognised, as they are by MediaWiki.
+        """
+        query = siteinfo.get('query', siteinfo)
+        aliases = {namespace: [namespace] for namespace in NAMESPACE_IDS.values()}
+        namespaces = query.get('namespaces', {})
+        if isinstance(namespaces, dict):
+            namespaces = namespaces.values()
+        entries = [(ns.get('id'), ns.get('name', ns.get('*'))) for ns in namespaces]
+        entries += [(ns.get('id'), ns.get('canonical')) for ns in namespaces]
+        entries += [(alias.get('id'), alias.get('alias', alias.get('*'))) for alias in query.get('namespacealiases', [])]
+        for namespace_id, alias in entries:
+            if namespace_id in NAMESPACE_IDS and alias:
+                aliases[NAMESPACE_IDS[namespace_id]].append(alias)
+        return cls(name, aliases)
+
+    def match(self, text, pos=0):
+        """
+        Returns the canonical namespace of the link target starting at
+        `pos` and the offset after its colon, or (None, pos).
+        """
+        match = self.regex.match(text, pos)
+        if match is None:
+            return None, pos
+        return self.names[_normalise_namespace_name(match.group(1))], match.end()
+
+    def split(self, title):
+        """
+        Returns (namespace, name) for a title in the File, Category or
+        Special namespace, with the canonical namespace name, or
+        (None, title) for other titles.
+        """
+        namespace, end = self.match(title)
+        return namespace, title[end:]
+
+default_namespaces = NamespaceRegistry(None, NAMESPACE_ALIASES)
+
+_WIKI_ID_RE = re.compile(r'[A-Za-z0-9_-]+')
+_namespace_registries = {}
+
+def get_namespaces(wiki=None):
+    """
+    Returns the NamespaceRegistry of `wiki`, loaded from
+    SITEINFO_DIR/<wiki>.json on first use and cached, or the default
+    registry when no wiki is given. Raises ValueError for unknown wikis.
+    """
+    if not wiki:
+        return default_namespaces
+    registry = _namespace_registries.get(wiki)
+    if registry is None:
+        if not isinstance(wiki, str) or not _WIKI_ID_RE.fullmatch(wiki):
+            raise ValueError(f'Invalid wiki name {wiki!r}')
+        path = os.path.join(app.config['SITEINFO_DIR'], f'{wiki}.json')
+        try:
+            with open(path, encoding='utf-8') as f:
+                siteinfo = json.load(f)
+        except FileNotFoundError:
+            raise ValueError(f'Unknown wiki {wiki!r}') from None
+        registry = _namespace_registries[wiki] = NamespaceRegistry.from_siteinfo(wiki, siteinfo)
+    return registry
+
+def split_namespace(title, namespaces=None):
+    """
+    Splits a title into its canonical namespace and name, see
+    NamespaceRegistry.split.
+    """
+    return (namespaces or default_namespaces).split(title)
+
+# Common localised names of the file options that are not translated,
+# such as "mini" for "thumb" on German wikis
+FILE_OPTION_ALIASES = {
+    'thumb': ['thumbnail', 'mini', 'miniatur', 'vignette', 'miniatura'],
+    'frame': ['framed', 'enframed', 'gerahmt', 'cadre'],
+    'frameless': ['rahmenlos', 'sans_cadre'],
+    'border': ['rand', 'bordure'],
+    'center': ['zentriert', 'centré'],
+    'none': ['ohne', 'néant'],
+    'upright': ['hochkant', 'redresse'],
+}
+
+# File options that make a file a block image rather than an inline icon
+_FILE_NOT_INLINE_KEYWORDS = frozenset([
+    'left', 'right', 'centre', 'center', 'thumb', 'frame', 'frameless', 'border', 'none', '{{dirstart}}', '{{dirend}}',
+] + [alias for option in ('thumb', 'frame', 'frameless', 'border', 'center', 'none')
+     for alias in FILE_OPTION_ALIASES[option]])
+# File options that are not translated
+_FILE_KEYWORDS = _FILE_NOT_INLINE_KEYWORDS | frozenset([
+    'upright', 'baseline', 'middle', 'sub', 'super', 'text-top', 'text-bottom',
+] + FILE_OPTION_ALIASES['upright'])
+_FILE_KEYWORD_PREFIXES = ('link=', 'upright=', 'alt=', 'verweis=', 'hochkant=', 'lien=')
+# Alignment options are replaced with their direction-aware templates
+_FILE_DIRECTIONS = {'left': '{{dirstart}}', 'right': '{{dirend}}'}
+_PIXEL_RE = re.compile(r'\d+(?:x\d+)?px')  # Matches pixel values like "100px" or "100x50px"
+_EXTERNAL_LINK_RE = re.compile(r'\[(https?://[^\s]+)\s+([^\]]+)\]')
+
 class double_brackets_types(Enum):
     wikilink = 1
     category = 2
@@ -290,146 +465,91 @@ class double_brackets_types(Enum):
     special = 5
     invalid_file = 6
 
-def _process_file(s, tvar_inline_icon_id=0): 
-    # Define keywords that should NOT be translated when found as parameters
-    NON_TRANSLATABLE_KEYWORDS = {
-        'left', 'right', 'centre', 'center', 'thumb', 'frameless', 'border', 'none', 
-        'upright', 'baseline', 'middle', 'sub', 'super', 'text-top', 'text-bottom', '{{dirstart}}', '{{dirend}}'
-    }
-    NON_TRANSLATABLE_KEYWORDS_PREFIXES = {
-        'link=', 'upright=', 'alt='
-    }
-    NOT_INLINE_KEYWORDS = {
-        'left', 'right', 'centre', 'center', 'thumb', 'frameless', 'border', 'none', '{{dirstart}}', '{{dirend}}'
-    }
-    file_aliases = ['File:', 'file:', 'Image:', 'image:']
-
-    tokens = []
-    
-    inner_content = s[2:-2]  # Remove the leading [[ and trailing ]]
-    tokens = inner_content.split('|')
-    tokens = [token.strip() for token in tokens]  # Clean up whitespace around tokens
-    
-    # The first token shall start with a file alias
-    # e.g., "File:Example.jpg" or "Image:Example.png"
-    if not tokens or not tokens[0].startswith(tuple(file_aliases)):
-        return line, double_brackets_types.invalid_file
-    
-    # The first token is a file link
-    filename = tokens[0].split(':', 1)[1] if ':' in tokens[0] else tokens[0]
-    tokens[0] = f'File:{filename}' 
-    
-    # Substitute 'left' with {{dirstart}}
-    while 'left' in tokens:
-        tokens[tokens.index('left')] = '{{dirstart}}'
-    # Substitute 'right' with {{dirend}}
-    while 'right' in tokens:
-        tokens[tokens.index('right')] = '{{dirend}}'
-    
-    ############################
-    # Managing inline icons
-    #############################
+def _process_file(fields, filename, tvar_inline_icon_id=0):
+    """
+    Converts a file link given its top-level fields and file name, in one
+    pass over the fields: captions and alt texts are translatable, options
+    are kept. A file with only inline options and an emoji alt text is an
+    inline icon and is returned as a single tvar.
+    """
+    tokens = [f'File:{filename}']
+    output_parts = [tokens[0]]
     is_inline_icon = True
-    for token in tokens:
-        if token in NOT_INLINE_KEYWORDS:
-            is_inline_icon = False
-            break
-    if is_inline_icon :
-        # Check if it contains 'alt=' followed by an emoji
-        for token in tokens[1:]:
-            if token.startswith('alt='):
-                alt_text = token[len('alt='):].strip()
-                if not any(is_emoji_unicode(char) for char in alt_text):
-                    is_inline_icon = False
-                    break
-            elif token not in NON_TRANSLATABLE_KEYWORDS:
+    for field in fields[1:]:
+        token = field.strip()
+        token = _FILE_DIRECTIONS.get(token, token)
+        tokens.append(token)
+        if token.startswith('alt='):
+            alt_text = token[len('alt='):].strip()
+            output_parts.append('alt=' + (alt_text if _is_marked_up(alt_text) else _wrap_in_translate(alt_text)))
+            if is_inline_icon and not any(is_emoji_unicode(char) for char in alt_text):
                 is_inline_icon = False
-                break
-            elif any(token.startswith(prefix) for prefix in NON_TRANSLATABLE_KEYWORDS_PREFIXES):
+        elif token in _FILE_KEYWORDS:
+            output_parts.append(token)
+            if token in _FILE_NOT_INLINE_KEYWORDS:
                 is_inline_icon = False
-                break
-        
+        else:
+            is_inline_icon = False
+            # Options with a known prefix, pixel sizes and captions already
+            # marked up are kept as they are, anything else is assumed to be
+            # a caption
+            if token.startswith(_FILE_KEYWORD_PREFIXES) or _PIXEL_RE.match(token) or _is_marked_up(token):
+                output_parts.append(token)
+            else:
+                output_parts.append(f"<translate>{token}</translate>")
+
     if is_inline_icon:
         # return something like: <tvar name="icon">[[File:smiley.png|alt=🙂]]</tvar>
-        returnline = f'<tvar name=icon{tvar_inline_icon_id}>[[' + '|'.join(tokens) + ']]</tvar>'
-        return returnline, double_brackets_types.inline_icon
-    
-    ############################
-    # Managing general files
-    #############################
-    
-    output_parts = []
-    
-    # The first token is the file name (e.g., "File:Example.jpg")
-    # We substitute any occurrences of "Image:" with "File:"
-    output_parts.append(tokens[0])
+        return f'<tvar name=icon{tvar_inline_icon_id}>[[' + '|'.join(tokens) + ']]</tvar>', double_brackets_types.inline_icon
+    return '[[' + '|'.join(output_parts) + ']]', double_brackets_types.not_inline_icon_file
 
-    pixel_regex = re.compile(r'\d+(?:x\d+)?px')  # Matches pixel values like "100px" or "100x50px)"
-    for token in tokens[1:]:
-        # Check for 'alt='
-        if token.startswith('alt='):
-            alt_text = token[len('alt='):].strip()
-            output_parts.append('alt='+_wrap_in_translate(alt_text))
-        # Check if the token is a known non-translatable keyword
-        elif token in NON_TRANSLATABLE_KEYWORDS:
-            output_parts.append(token)
-        # If the token starts with a known non-translatable prefix, keep it as is
-        elif any(token.startswith(prefix) for prefix in NON_TRANSLATABLE_KEYWORDS_PREFIXES):
-            output_parts.append(token)
-        # If the token is a pixel value, keep it as is
-        elif pixel_regex.match(token):
-            output_parts.append(token)
-        # Otherwise, assume it's a caption or other translatable text
-        else:
-            output_parts.append(f"<translate>{token}</translate>")
+# Characters that cannot appear in page names
+_INVALID_TITLE_RE = re.compile(r'[<>\[\]{}|]')
 
-    # Reconstruct the line with the transformed parts
-    returnline = '[[' + '|'.join(output_parts) + ']]' 
-    return returnline, double_brackets_types.not_inline_icon_file
-    
-def process_double_brackets(text, tvar_id=0):
+def process_double_brackets(text, tvar_id=0, namespaces=None):
     """
     Processes internal links in the wikitext.
     It wraps the content in <translate> tags.
+    Namespaces are recognised with the `namespaces` registry, by default
+    the built-in one.
     """
     if not (text.startswith("[[") and text.endswith("]]")) :
-        print(f"Input >{text}< must be wrapped in double brackets [[ ]]")
-        sys.exit(1)
+        raise ValueError(f"Input >{text}< must be wrapped in double brackets [[ ]]")
     # Split the link into parts, handling both internal links and links with display text
     
     inner_wl = text[2:-2]  # Remove the leading [[ and trailing ]]
-    parts = inner_wl.split('|')
-    
-    # part 0
-    category_aliases = ['Category:', 'category:', 'Cat:', 'cat:']
-    file_aliases = ['File:', 'file:', 'Image:', 'image:']
+    parts = _split_top_level(inner_wl)
     
     parts[0] = parts[0].strip()  # Clean up the first part
-    # Check if the first part is a category or file alias
-    if parts[0].startswith(tuple(category_aliases)):
-        # Handle category links
-        cat_name = parts[0].split(':', 1)[1] if ':' in parts[0] else parts[0]
-        return f'[[Category:{cat_name}{{{{#translation:}}}}]]', double_brackets_types.category
-    elif parts[0].startswith(tuple(file_aliases)):
+    namespace, name = (namespaces or default_namespaces).split(parts[0])
+    if namespace == 'Category':
+        # Handle category links, unless already converted
+        if name.endswith('{{#translation:}}'):
+            return f'[[Category:{name}]]', double_brackets_types.category
+        return f'[[Category:{name}{{{{#translation:}}}}]]', double_brackets_types.category
+    elif namespace == 'File':
         # Handle file links
-        return _process_file(text)
-    elif parts[0].startswith('Special:'):
+        return _process_file(parts, name)
+    elif namespace == 'Special':
         # Handle special pages
         return f'[[{parts[0]}]]', double_brackets_types.special
     
+    if _INVALID_TITLE_RE.search(parts[0]):
+        # Not a page name, so not a link either
+        return text, double_brackets_types.wikilink
     # Assuming it's a regular internal link
     if len(parts) == 1:
         return f'[[<tvar name={tvar_id}>Special:MyLanguage</tvar>/{capitalise_first_letter(parts[0])}|{parts[0]}]]', double_brackets_types.wikilink
     if len(parts) == 2 :
         return f'[[<tvar name={tvar_id}>Special:MyLanguage</tvar>/{capitalise_first_letter(parts[0])}|{parts[1]}]]', double_brackets_types.wikilink
-    return text
+    return text, double_brackets_types.wikilink
 
 def process_external_link(text, tvar_url_id=0):
     """
     Processes external links in the format [http://example.com Description] and ensures
     that only the description part is wrapped in <translate> tags, leaving the URL untouched.
     """
-    match = re.match(r'\[(https?://[^\s]+)\s+([^\]]+)\]', text)
+    match = _EXTERNAL_LINK_RE.match(text)
 
     if match:
         url_part = match.group(1)
@@ -446,6 +566,9 @@ def process_template(text):
     assert(text.startswith('{{') and text.endswith('}}')), "Invalid template tag"
     # Split the template content from the rest of the text
     inner_content = text[2:-2].strip()  # Remove the leading {{ and trailing }}
+    if inner_content[:1] == '{' or inner_content[-1:] == '}':
+        # Stripping would merge its braces with those around it
+        return text
     inner_content = capitalise_first_letter(inner_content)  # Capitalise the first letter of the inner content
     
     # If the inner content is empty, return an empty string
@@ -455,6 +578,37 @@ def process_template(text):
     # Wrap the inner content in <translate> tags
     return '{{' + inner_content + '}}'
 
+# Parameter names whose values are usually prose rather than identifiers
+TRANSLATABLE_TEMPLATE_PARAMETERS = frozenset([
+    'text', 'title', 'caption', 'alt', 'description', 'label', 'quote',
+    'content', 'heading', 'message', 'note', 'tooltip', 'summary',
+])
+
+TemplateParameter = namedtuple('TemplateParameter', ['name', 'value', 'translatable'])
+
+def parse_template(text):
+    """
+    Parses a {{...}} template into its name and a list of TemplateParameter.
+    Positional parameters are named '1', '2', ... as in MediaWiki. Pipes
+    inside nested templates and links do not split parameters. Named
+    parameters listed in TRANSLATABLE_TEMPLATE_PARAMETERS are flagged as
+    translatable.
+    """
+    assert(text.startswith('{{') and text.endswith('}}')), "Invalid template tag"
+    fields = _split_top_level(text[2:-2])
+    name = fields[0].strip()
+    params = []
+    position = 0
+    for field in fields[1:]:
+        key, sep, value = field.partition('=')
+        if sep and '{{' not in key and '[[' not in key:
+            key = key.strip()
+            params.append(TemplateParameter(key, value.strip(), key.lower() in TRANSLATABLE_TEMPLATE_PARAMETERS))
+        else:
+            position += 1
+            params.append(TemplateParameter(str(position), field, False))
+    return name, params
+
 def process_raw_url(text):
     """
     Processes raw URLs in the wikitext.
@@ -467,372 +621,2252 @@ def process_raw_url(text):
     return text.strip()
 
 
-# --- Main Tokenisation Logic ---
+# --- Caching ---
 
-def convert_to_translatable_wikitext(wikitext):
+class ConversionCache:
     """
-    Converts standard wikitext to translatable wikitext by wrapping
-    translatable text with <translate> tags, while preserving and
-    correctly handling special wikitext elements.
-    This function tokenizes the entire text, not line by line.
+    Bounded LRU cache of conversion results keyed by a hash of the input.
+    It is limited both by the number of entries and by the memory used by
+    the cached results, and counts hits, misses and evictions.
     """
-    if not wikitext:
-        return ""
-    
-    # add an extra newline at the beginning, useful to process items at the beginning of the text
-    wikitext = '\n' + wikitext
 
-    parts = []
-    last = 0
-    curr = 0
-    text_length = len(wikitext)
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
 
-    while curr < text_length :
-        found = None
-        # Syntax highlight block
-        pattern = '<syntaxhighlight'
-        if wikitext.startswith(pattern, curr):
-            end_pattern = wikitext.find('</syntaxhighlight>', curr) + len('</syntaxhighlight>')
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            parts.append((wikitext[curr:end_pattern], process_syntax_highlight))
-            curr = end_pos
-            last = curr
-            continue 
-        # Table block
-        pattern = '{|'
-        if wikitext.startswith(pattern, curr):
-            end_pattern = wikitext.find('|}', curr) + len('|}')
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            parts.append((wikitext[curr:end_pattern], process_table))
-            curr = end_pattern
-            last = curr
-            continue
-        # Blockquote
-        pattern = '<blockquote>'
-        if wikitext.startswith(pattern, curr):
-            end_pattern = wikitext.find('</blockquote>', curr) + len('</blockquote>')
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            parts.append((wikitext[curr:end_pattern], process_blockquote))
-            curr = end_pattern
-            last = curr
-            continue
-        # Poem tag
-        pattern = '<poem'
-        if wikitext.startswith(pattern, curr):
-            end_pattern = wikitext.find('</poem>', curr) + len('</poem>')
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            parts.append((wikitext[curr:end_pattern], process_poem_tag))
-            curr = end_pattern
-            last = curr
-            continue
-        # Code tag
-        pattern = '<code'
-        if wikitext.startswith(pattern, curr):
-            end_pattern = wikitext.find('</code>', curr) + len('</code>')
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            parts.append((wikitext[curr:end_pattern], process_code_tag))
-            curr = end_pattern
-            last = curr
-            continue
-        # Div tag
-        pattern = '<div'
-        if wikitext.startswith(pattern, curr):
-            end_pattern = wikitext.find('</div>', curr) + len('</div>')
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            parts.append((wikitext[curr:end_pattern], process_div))
-            curr = end_pattern
-            last = curr
-            continue
-        # Hiero tag
-        pattern = '<hiero>'
-        if wikitext.startswith(pattern, curr):
-            end_pattern = wikitext.find('</hiero>', curr) + len('</hiero>')
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            parts.append((wikitext[curr:end_pattern], process_hiero))
-            curr = end_pattern
-            last = curr
-            continue
-        # Sub tag
-        pattern = '<sub>'
-        if wikitext.startswith(pattern, curr):
-            end_pattern = wikitext.find('</sub>', curr) + len('</sub>')
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            parts.append((wikitext[curr:end_pattern], process_sub_sup))
-            curr = end_pattern
-            last = curr
-            continue
-        # Sup tag
-        pattern = '<sup>'
-        if wikitext.startswith(pattern, curr):
-            end_pattern = wikitext.find('</sup>', curr) + len('</sup>')
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            parts.append((wikitext[curr:end_pattern], process_sub_sup))
-            curr = end_pattern
-            last = curr
-            continue
-        # Math tag
-        pattern = '<math>'
-        if wikitext.startswith(pattern, curr):
-            end_pattern = wikitext.find('</math>', curr) + len('</math>')
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            parts.append((wikitext[curr:end_pattern], process_math))
-            curr = end_pattern
-            last = curr
-            continue
-        # Small tag
-        pattern = '<small>'
-        if wikitext.startswith(pattern, curr):
-            end_pattern = wikitext.find('</small>', curr) + len('</small>')
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            parts.append((wikitext[curr:end_pattern], process_small_tag))
-            curr = end_pattern
-            last = curr
-            continue
-        # Nowiki tag
-        pattern = '<nowiki>'
-        if wikitext.startswith(pattern, curr):
-            end_pattern = wikitext.find('</nowiki>', curr) + len('</nowiki>')
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            parts.append((wikitext[curr:end_pattern], process_nowiki))
-            curr = end_pattern
-            last = curr
-            continue
-        # br tag
-        patterns = ['<br>', '<br/>', '<br />']
-        for p in patterns:
-            if wikitext.startswith(p, curr):
-                end_pattern = curr + len(p)
-                if last < curr:
-                    parts.append((wikitext[last:curr], _wrap_in_translate))
-                parts.append((wikitext[curr:end_pattern], lambda x: x))
-                curr = end_pattern
-                last = curr
-                found = True
-                break
-        if found:
-            continue
-        # Lists
-        patterns_newline = ['\n*', '\n#', '\n:', '\n;']
-        if any(wikitext.startswith(p, curr) for p in patterns_newline) :
-            curr += 1 # Discard the newline character
-            parts.append((wikitext[last:curr], _wrap_in_translate))
-            # Iterate through the list items
-            patterns = ['*', '#', ':', ';']
-            while any(wikitext.startswith(p, curr) for p in patterns) :
-                end_pattern = wikitext.find('\n', curr)
-                if end_pattern == -1:
-                    end_pattern = text_length
-                else :
-                    end_pattern += 1 # Include the newline in the part
-                parts.append((wikitext[curr:end_pattern], process_item))
-                curr = end_pattern
-                last = curr
-            continue
-        # Internal links
-        pattern = '[['
-        if wikitext.startswith(pattern, curr):
-            # Count the number of opening double brackets '[[' and closing ']]' to find the end
-            end_pos = curr + 2
-            bracket_count = 1
-            while end_pos < text_length and bracket_count > 0:
-                if wikitext.startswith('[[', end_pos):
-                    bracket_count += 1
-                    end_pos += 2
-                elif wikitext.startswith(']]', end_pos):
-                    bracket_count -= 1
-                    end_pos += 2
-                else:   
-                    end_pos += 1
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            if end_pos > curr + 2:  # Ensure we have a valid link
-                parts.append((wikitext[curr:end_pos], process_double_brackets))
-            curr = end_pos
-            last = curr
-            continue
-        # External links
-        pattern = '[http'
-        if wikitext.startswith(pattern, curr):
-            # Find the end of the external link
-            end_pos = wikitext.find(']', curr)
-            if end_pos == -1:
-                end_pos = text_length
-            else :
-                end_pos += 1 # Include the closing ']' in the part
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            parts.append((wikitext[curr:end_pos + 1], process_external_link))
-            curr = end_pos
-            last = curr
-            continue
-        # Templates
-        pattern = '{{'
-        if wikitext.startswith(pattern, curr):
-            # Find the end of the template
-            end_pos = wikitext.find('}}', curr) + 2
-            if end_pos == 1:
-                end_pos = text_length
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            parts.append((wikitext[curr:end_pos], process_template))
-            curr = end_pos
-            last = curr
-            continue
-        # Raw URLs
-        pattern = 'http'
-        if wikitext.startswith(pattern, curr):
-            # Find the end of the URL (space or end of string)
-            end_pos = wikitext.find(' ', curr)
-            if end_pos == -1:
-                end_pos = text_length
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            parts.append((wikitext[curr:end_pos], process_raw_url))
-            curr = end_pos
-            last = curr
-            continue
-        # Behaviour switches
-        for switch in behaviour_switches:
-            if wikitext.startswith(switch, curr):
-                end_pos = curr + len(switch)
-                if last < curr:
-                    parts.append((wikitext[last:curr], _wrap_in_translate))
-                parts.append((wikitext[curr:end_pos], lambda x: x))
-                curr = end_pos
-                last = curr
-                
-        
-        curr += 1  # Move to the next character if no pattern matched
-        
-    # Add any remaining text after the last processed part
-    if last < text_length:
-        parts.append((wikitext[last:], _wrap_in_translate))
-    
+    @staticmethod
+    def key(wikitext, wiki=None):
+        digest = hashlib.sha256(wikitext.encode('utf-8')).hexdigest()
+        return f'{wiki}-{digest}' if wiki else digest
+
+    def __contains__(self, key):
+        # Does not count as a hit or refresh the entry
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size=None):
+        """
+        Stores `value` under `key`. `size` is the memory accounted for the
+        value; it defaults to sys.getsizeof(value), which only suits strings.
+        """
+        if size is None:
+            size = sys.getsizeof(value)
+        if self.max_entries <= 0 or size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+            self._entries[key] = (value, size)
+            self._size += size
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+# --- Syntax Tree ---
+
+def _passthrough(text):
     """
-    print ('*' * 20)
-    for i, (part, handler) in enumerate(parts):
-        print(f"--- Start element {i} with handler {handler.__name__} ---")
-        print(part) 
-        print(f"---\n") 
-        
-    print ('*' * 20)
+    Handler for parts that are copied to the output unchanged.
     """
-    
-    # Process links
-    tvar_id = 0
-    tvar_url_id = 0
-    tvar_code_id = 0
-    tvar_inline_icon_id = 0
-    for i, (part, handler) in enumerate(parts):
-        # Handlers for links require a tvar_id
-        if handler == process_double_brackets:
-            new_part, double_brackets_type = handler(part, tvar_id)
-            if double_brackets_type in [double_brackets_types.wikilink, double_brackets_types.special, double_brackets_types.inline_icon]:
-                new_handler = _wrap_in_translate  # Change handler to _wrap_in_translate
-            else :
-                new_handler = lambda x: x  # No further processing for categories and files
-            parts[i] = (new_part, new_handler)
-            tvar_id += 1
-        elif handler == process_external_link:
-            new_part = handler(part, tvar_url_id)
-            new_handler = _wrap_in_translate  # Change handler to _wrap_in_translate
-            parts[i] = (new_part, new_handler)
-            tvar_url_id += 1
-        elif handler == process_code_tag:
-            new_part = handler(part, tvar_code_id)
-            new_handler = _wrap_in_translate  # Change handler to _wrap_in_translate
-            parts[i] = (new_part, new_handler)
-            tvar_code_id += 1
-        elif handler == process_double_brackets :
-            new_part, double_brackets_type = handler(part, tvar_inline_icon_id)
-            if double_brackets_type == double_brackets_types.inline_icon:
-                new_handler = _wrap_in_translate  # Change handler to _wrap_in_translate
-                tvar_inline_icon_id += 1
-            else:
-                new_handler = lambda x: x
-            
-    # Scan again the parts: merge consecutive parts handled by _wrap_in_translate
-    _parts = []
-    if parts:
-        current_part, current_handler = parts[0]
-        for part, handler in parts[1:]:
-            if handler == _wrap_in_translate and current_handler == _wrap_in_translate:
-                # Merge the parts
-                current_part += part
-            else:
-                _parts.append((current_part, current_handler))
-                current_part, current_handler = part, handler
-        # Add the last accumulated part
-        _parts.append((current_part, current_handler))
-        
-    # Process the parts with their respective handlers
-    processed_parts = [handler(part) for part, handler in _parts]            
-    
-    # Debug output
+    return text
+
+class Node:
     """
-    print("Processed parts:")
-    for i, (ppart, (part, handler)) in enumerate(zip(processed_parts, _parts)):
-        print(f"--- Start element {i} with handler {handler.__name__} ---")
-        print(part)
-        print(f"---\n") 
-        print(ppart)  
-        print(f"---\n") 
+    A construct of a parsed page. Nodes store offsets into the page source
+    instead of copies of their text; `text` slices it on demand.
+    `handler` is the function that converts the node's text and `kind`
+    names the construct in metrics and traces.
     """
-    
-    # Join the processed parts into a single string
-    return ''.join(processed_parts)[1:]  # Remove the leading newline added at the beginning
+    __slots__ = ('source', 'start', 'end')
+    handler = staticmethod(_passthrough)
+    kind = None
 
-@app.route('/')
-def index():
-    return render_template('home.html')
+    def __init__(self, source, start, end):
+        self.source = source
+        self.start = start
+        self.end = end
 
-@app.route('/convert', methods=['GET'])
-def redirect_to_home():
-    return render_template('home.html')
+    @property
+    def text(self):
+        return self.source[self.start:self.end]
 
-@app.route('/convert', methods=['POST'])
-def convert():
-    wikitext = request.form.get('wikitext', '')
-    converted_text = convert_to_translatable_wikitext(wikitext)
-    return render_template('home.html', original=wikitext, converted=converted_text)
+    def __repr__(self):
+        return f'{type(self).__name__}({self.text!r})'
 
-@app.route('/api/convert', methods=['GET', 'POST'])
-def api_convert():
-    if request.method == 'GET':
-        return """
-        <h1>Translate Tagger API</h1>
-        <p>Send a POST request with JSON data to use this API.</p>
-        <p>Example:</p>
-        <pre>
-        curl -X POST https://translatetagger.toolforge.org/api/convert \\
-        -H "Content-Type: application/json" \\
-        -d '{"wikitext": "This is a test [[link|example]]"}'
-        </pre>
-        """
-    elif request.method == 'POST':
-        data = request.get_json()
-        if not data or 'wikitext' not in data:
-            return jsonify({'error': 'Missing "wikitext" in JSON payload'}), 400
-        
-        wikitext = data.get('wikitext', '')
-        converted_text = convert_to_translatable_wikitext(wikitext)
-        
-        return jsonify({
-            'original': wikitext,
-            'converted': converted_text
-        })
+class Text(Node):
+    """
+    Plain text, wrapped in <translate> tags together with the translatable
+    nodes next to it.
+    """
+    __slots__ = ()
+    kind = 'text'
+    handler = staticmethod(_wrap_in_translate)
+
+class Verbatim(Node):
+    """
+    Text copied to the output unchanged, e.g. an already converted part.
+    `kind` is the kind of the node it was converted from.
+    """
+    __slots__ = ('kind',)
+
+    def __init__(self, source, start, end, kind=None):
+        super().__init__(source, start, end)
+        self.kind = kind
+
+    @classmethod
+    def of(cls, text, kind=None):
+        return cls(text, 0, len(text), kind)
+
+class Switch(Node):
+    """
+    A behaviour switch such as __NOTOC__.
+    """
+    __slots__ = ()
+    kind = 'switch'
+
+class ListItem(Node):
+    """
+    One line of a *, #, : or ; list, including its newline.
+    """
+    __slots__ = ()
+    kind = 'list_item'
+    handler = staticmethod(process_item)
+
+class Table(Node):
+    """
+    A {| ... |} table.
+    """
+    __slots__ = ()
+    kind = 'table'
+    handler = staticmethod(process_table)
+
+class Link(Node):
+    """
+    An internal [[...]] link.
+    """
+    __slots__ = ()
+    kind = 'link'
+    handler = staticmethod(process_double_brackets)
+
+    @property
+    def target(self):
+        return _split_top_level(self.source[self.start + 2:self.end - 2])[0].strip()
+
+class File(Link):
+    """
+    A [[File:...]] or [[Image:...]] link.
+    """
+    __slots__ = ()
+    kind = 'file'
+
+class Category(Link):
+    """
+    A [[Category:...]] link.
+    """
+    __slots__ = ()
+    kind = 'category'
+
+class ExternalLink(Node):
+    """
+    A bracketed [http://... description] link.
+    """
+    __slots__ = ()
+    kind = 'external_link'
+    handler = staticmethod(process_external_link)
+
+class Url(Node):
+    """
+    A raw http(s) URL in running text.
+    """
+    __slots__ = ()
+    kind = 'url'
+    handler = staticmethod(process_raw_url)
+
+class Template(Node):
+    """
+    A {{...}} template or {{{...}}} parameter, nested ones included.
+    """
+    __slots__ = ()
+    kind = 'template'
+    handler = staticmethod(process_template)
+
+    @property
+    def name(self):
+        return self.parse()[0]
+
+    def parse(self):
+        """
+        Returns the template name and its parameters, see parse_template.
+        """
+        return parse_template(self.text)
+
+# Node type of the links to each namespace
+_LINK_NODE_TYPES = {None: Link, 'File': File, 'Category': Category, 'Special': Link}
+
+# Handler of the tags with each policy
+_TAG_POLICY_HANDLERS = {
+    TagPolicy.wrap: process_wrapped_tag,
+    TagPolicy.tvar: process_tvar_tag,
+    TagPolicy.passthrough: _passthrough,
+    # Only self-closing tags are left as nodes, e.g. <gallery />
+    TagPolicy.recurse: _passthrough,
+    TagPolicy.gallery: _passthrough,
+    # Never left as nodes, they are kept in the text around them
+    TagPolicy.inline: _passthrough,
+}
+
+class Tag(Node):
+    """
+    An HTML or extension tag with its content, e.g. <code>...</code>, or a
+    <br> tag.
+    """
+    __slots__ = ('name',)
+
+    def __init__(self, source, start, end, name):
+        super().__init__(source, start, end)
+        self.name = name
+
+    @property
+    def policy(self):
+        return TAG_POLICIES[self.name]
+
+    @property
+    def handler(self):
+        return _TAG_POLICY_HANDLERS[TAG_POLICIES[self.name]]
+
+    @property
+    def kind(self):
+        return self.name
+
+# --- Main Tokenisation Logic ---
+
+# Constructs that run from an opening pattern to a fixed closing pattern,
+# besides tags. Maps the opening pattern to its closing pattern.
+_CLOSED_CONSTRUCTS = {
+    '{|': '|}',
+}
+
+_LIST_MARKERS = ('*', '#', ':', ';')
+
+# Closing Translate tags, found on their own when their opening tag is gone
+_STRAY_CLOSERS = frozenset(['</translate>', '</tvar>'])
+
+def _tag_pattern():
+    # '<' and the name of any registered tag, as a single trie
+    return '<' + _trie_pattern(TAG_POLICIES) + r'(?=[\s/>])'
+
+def _compile_tokeniser():
+    """
+    Builds the regexes of the tokeniser and of the segment splitter from
+    TAG_POLICIES. However many tags are registered, the tag names are
+    matched by one alternative. Also fingerprints the tag policies for
+    ETags.
+    """
+    global _TOKEN_RE, _SEGMENT_SCAN_RE, _TAG_RE, _CELL_TOKEN_RE, _TAG_FINGERPRINT
+    _TAG_FINGERPRINT = hashlib.sha256(repr(
+        (sorted((name, policy.value) for name, policy in TAG_POLICIES.items()), sorted(VOID_TAGS))
+    ).encode('utf-8')).hexdigest()[:12]
+    # One alternation over every construct the tokeniser recognises. The order of
+    # the alternatives is the order in which constructs take precedence when
+    # several of them start at the same position.
+    _TOKEN_RE = re.compile('|'.join(
+        [_tag_pattern()]
+        + [re.escape(p) for p in sorted(_STRAY_CLOSERS)]
+        + [re.escape(p) for p in _CLOSED_CONSTRUCTS]
+        + [r'\n[*#:;]', r'\[\[', r'\[http', r'\{\{', 'http']
+        + [re.escape(s) for s in behaviour_switches]
+    ))
+    _SEGMENT_SCAN_RE = re.compile('|'.join(
+        [r'\n(?=\n)', _tag_pattern()]
+        + [re.escape(p) for p in _CLOSED_CONSTRUCTS]
+        + [r'\[\[', r'\]\]', r'\[http', 'http']
+    ))
+    _TAG_RE = re.compile(_tag_pattern())
+    # What separates the cells of a table line, and what they may be inside of
+    _CELL_TOKEN_RE = re.compile(_tag_pattern() + r'|\[\[|\]\]|\{\{|\}\}|\|\||!!|\|')
+
+def register_tag(name, policy, void=False):
+    """
+    Registers a tag, typically a site-specific extension tag, or changes
+    the policy of a known one. `policy` is a TagPolicy or its name; a
+    `void` tag has no closing tag. Cached conversions are dropped since
+    they may change. Worker processes that are already running keep the
+    tags they had; tags given in SITE_TAGS are registered everywhere.
+    """
+    if not isinstance(policy, TagPolicy):
+        try:
+            policy = TagPolicy[policy]
+        except KeyError:
+            raise ValueError(f'Unknown tag policy {policy!r}') from None
+    if not re.fullmatch(r'[A-Za-z][\w-]*', name):
+        raise ValueError(f'Invalid tag name {name!r}')
+    TAG_POLICIES[name] = policy
+    if void:
+        VOID_TAGS.add(name)
+    else:
+        VOID_TAGS.discard(name)
+    _compile_tokeniser()
+    conversion_cache.clear()
+    segment_cache.clear()
+
+_compile_tokeniser()
+
+_LINK_BRACKETS_RE = re.compile(r'\[\[|\]\]')
+_BRACE_RUN_RE = re.compile(r'\{\{+|\}\}+')  # Faster to search for than \{{2,}
+
+def _build_brace_index(wikitext):
+    """
+    Matches {{...}} templates and {{{...}}} parameters, nested ones
+    included, in one pass over the runs of braces. As in the MediaWiki
+    preprocessor, a closing run is matched against the innermost open run:
+    three braces on both sides make a parameter, otherwise two make a
+    template, and what is left of either run keeps matching.
+    Returns a dict mapping the offset of every matched opening pair to
+    the offset just after its closing braces.
+    """
+    index = {}
+    stack = []  # [offset, braces left] of the opening runs still open
+    for match in _BRACE_RUN_RE.finditer(wikitext):
+        pos = match.start()
+        remaining = len(match.group())
+        if wikitext[pos] == '{':
+            stack.append([pos, remaining])
+            continue
+        while remaining >= 2 and stack:
+            opener = stack[-1]
+            count = min(opener[1], remaining, 3)
+            opener[1] -= count
+            index[opener[0] + opener[1]] = pos + count
+            pos += count
+            remaining -= count
+            if opener[1] < 2:
+                stack.pop()
+    return index
+
+def _find_link_end(wikitext, curr):
+    """
+    Returns the offset just after the ]] closing the [[ at `curr`, counting
+    nested links, or -1 if the link is never closed.
+    """
+    bracket_count = 1
+    for bracket in _LINK_BRACKETS_RE.finditer(wikitext, curr + 2):
+        bracket_count += 1 if bracket.group() == '[[' else -1
+        if bracket_count == 0:
+            return bracket.end()
+    return -1
+
+def _build_link_index(wikitext):
+    """
+    Matches every [[ with its ]] in one pass, as _find_link_end does for a
+    single link. Returns a dict mapping the offset of every closed [[ to the
+    offset just after its ]]. Used once a page has an unterminated link,
+    since scanning to the end of the page again for every later link would
+    be quadratic.
+    """
+    index = {}
+    stack = []
+    for bracket in _LINK_BRACKETS_RE.finditer(wikitext):
+        if bracket.group() == '[[':
+            stack.append(bracket.start())
+        elif stack:
+            index[stack.pop()] = bracket.end()
+    return index
+
+class _Finder:
+    """
+    str.find for a text scanned from left to right: the next occurrence of
+    every substring is remembered, so that however many times a substring
+    is looked for, the text is searched for it at most once.
+    """
+    __slots__ = ('text', 'found')
+
+    def __init__(self, text):
+        self.text = text
+        self.found = {}
+
+    def find(self, sub, pos):
+        found = self.found.get(sub)
+        if found is None or -1 < found < pos:
+            found = self.found[sub] = self.text.find(sub, pos)
+        return found
+
+def _url_end(wikitext, curr, find):
+    """
+    Returns the offset where the raw URL at `curr` ends: at the next space,
+    newline or tag, or at the end of the text.
+    """
+    ends = [end for end in (find(' ', curr), find('\n', curr), find('<', curr)) if end != -1]
+    return min(ends) if ends else len(wikitext)
+
+def _parse_list(wikitext, curr, append):
+    """
+    Appends a ListItem for every list line starting at `curr` and returns
+    the offset after the last one.
+    """
+    while wikitext.startswith(_LIST_MARKERS, curr):
+        end_pos = wikitext.find('\n', curr)
+        if end_pos == -1:
+            end_pos = len(wikitext)
+        else:
+            end_pos += 1  # Include the newline in the item
+        append(ListItem(wikitext, curr, end_pos))
+        curr = end_pos
+    return curr
+
+# --- Tables and Galleries ---
+# Tables and galleries are expanded into the nodes of their parts: the
+# markup (table and row lines, cell separators and attributes, file names
+# and options) is copied as it is, while cell contents and captions are
+# parsed as wikitext, so that text gets wrapped and links get tvars
+# numbered with the rest of the page. Rows and gallery lines are expanded
+# independently of one another.
+
+# Policies of the tags whose content is expanded into nodes
+_EXPANDED_TAG_POLICIES = frozenset([TagPolicy.recurse, TagPolicy.gallery])
+
+def _append_parsed(wikitext, start, end, namespaces, append):
+    """
+    Parses wikitext[start:end] on its own and appends its nodes, with
+    offsets into `wikitext`.
+    """
+    if not wikitext.startswith(_LIST_MARKERS, start) and not _TOKEN_RE.search(wikitext, start, end):
+        append(Text(wikitext, start, end))  # Plain text, the usual table cell
+        return
+    for node in parse(wikitext[start:end], namespaces):
+        node.source = wikitext
+        node.start += start
+        node.end += start
+        append(node)
+
+# Nodes converted in place in the content of a tag with the inline policy
+_INLINE_NODE_TYPES = frozenset([Link, ExternalLink])
+
+def _append_inline(wikitext, start, end, namespaces, append):
+    """
+    Appends the nodes of wikitext[start:end], the content of a tag with the
+    inline policy: its links and tvar tags, which are converted in place,
+    and Text nodes for everything else, which is copied as it is.
+    """
+    nodes = []
+    _append_parsed(wikitext, start, end, namespaces, nodes.append)
+    for node in nodes:
+        node_type = type(node)
+        if node_type in _INLINE_NODE_TYPES or (node_type is Tag and node.policy is TagPolicy.tvar):
+            append(node)
+        else:
+            append(Text(wikitext, node.start, node.end))
+
+def _tag_end(wikitext, curr, name, find):
+    """
+    Returns the offset after the registered tag `name` starting at `curr`,
+    its closing tag included, or 0 if parse() would not read it as a tag.
+    An unclosed <translate> or <tvar> runs to the end of the text.
+    """
+    content_start = find('>', curr) + 1
+    if content_start and (wikitext[content_start - 2] == '/' or name in VOID_TAGS):
+        return content_start
+    closing = '</' + name + '>'
+    content_end = find(closing, content_start) if content_start else -1
+    if content_end != -1:
+        return content_end + len(closing)
+    return len(wikitext) if name in _TRANSLATE_TAGS else 0
+
+def _table_cell_markup(wikitext, line_start, marker_end, line_end, header, find):
+    """
+    Returns the (start, end) spans of the markup of the cells on a table
+    line: the cell separators, with the attributes of the cell and their
+    '|' when it has any. Separators inside links, templates and tags such
+    as <nowiki> are ignored.
+    """
+    markup = []
+    cell = [line_start, marker_end]
+    attributes = True  # Whether a '|' may still end the attributes of the cell
+    depth = 0
+    search = _CELL_TOKEN_RE.search
+    token = search(wikitext, marker_end, line_end)
+    while token:
+        separator = token.group()
+        next_pos = token.end()
+        if separator[0] == '<':
+            next_pos = _tag_end(wikitext, token.start(), separator[1:], find) or next_pos
+            attributes = False
+        elif separator in ('[[', '{{'):
+            depth += 1
+            attributes = False
+        elif separator in (']]', '}}'):
+            depth = max(depth - 1, 0)
+        elif depth:
+            pass
+        elif separator == '||' or (header and separator == '!!'):
+            markup.append(cell)
+            cell = [token.start(), token.end()]
+            attributes = True
+        elif separator == '|' and attributes:
+            cell[1] = token.end()
+            attributes = False
+        token = search(wikitext, next_pos, line_end) if next_pos < line_end else None
+    markup.append(cell)
+    return markup
+
+def _spanning_constructs(wikitext, start, end):
+    """
+    Returns the sorted (start, end) spans of the templates and tags of
+    wikitext[start:end] that may span several lines of a table.
+    """
+    table = wikitext[start:end]
+    spans = [(start + open_pos, start + close_pos)
+             for open_pos, close_pos in _build_brace_index(table).items()] if '{{' in table else []
+    if '<' in table:
+        find = _Finder(wikitext).find
+        tag_end = start
+        for match in _TAG_RE.finditer(wikitext, start, end):
+            if match.start() < tag_end:
+                continue  # Inside the previous tag
+            tag_end = _tag_end(wikitext, match.start(), match.group()[1:], find) or tag_end
+            if tag_end > match.start():
+                spans.append((match.start(), tag_end))
+    spans.sort()
+    return spans
+
+def _expand_table(wikitext, start, end, namespaces, append):
+    """
+    Appends the nodes of the {| ... |} table at wikitext[start:end]. The
+    table line, row lines, captions and cell markup are kept verbatim and
+    the contents of the cells are parsed. A line continues the cell above
+    it unless it starts with '|' or '!' outside a template or tag. Nested tables
+    and tables on a single line are kept whole, as a Table node.
+    """
+    body_end = end - 2  # Start of the closing '|}'
+    head_end = wikitext.find('\n', start, body_end)
+    if head_end == -1 or wikitext.find('{|', start + 2, body_end) != -1:
+        append(Table(wikitext, start, end))
+        return
+    # Templates and tags spanning several lines, whose lines are not table markup
+    spans = _spanning_constructs(wikitext, start, end)
+    next_span = 0
+    span_end = 0
+    find = _Finder(wikitext).find
+
+    markup = [(start, head_end + 1)]
+    line_start = head_end + 1
+    while line_start < body_end:
+        line_end = wikitext.find('\n', line_start, body_end)
+        next_line = body_end if line_end == -1 else line_end + 1
+        line_end = body_end if line_end == -1 else line_end
+        while next_span < len(spans) and spans[next_span][0] < line_start:
+            span_end = max(span_end, spans[next_span][1])
+            next_span += 1
+        marker = line_start
+        while marker < line_end and wikitext[marker] in ' \t':
+            marker += 1
+        if line_start >= span_end and marker < line_end:
+            char = wikitext[marker]
+            if wikitext.startswith('|-', marker):
+                markup.append((line_start, next_line))
+            elif wikitext.startswith('|+', marker):
+                markup.extend(_table_cell_markup(wikitext, line_start, marker + 2, line_end, False, find)[:1])
+            elif char == '|' or char == '!':
+                markup.extend(_table_cell_markup(wikitext, line_start, marker + 1, line_end, char == '!', find))
+        line_start = next_line
+    markup.append((body_end, end))
+
+    append(Verbatim(wikitext, start, head_end + 1, 'table'))
+    for (_, content_start), (next_start, next_end) in zip(markup, markup[1:]):
+        if content_start < next_start:
+            _append_parsed(wikitext, content_start, next_start, namespaces, append)
+        append(Verbatim(wikitext, next_start, next_end))
+
+# Gallery line options, which are not captions
+_GALLERY_OPTION_RE = re.compile(r'\s*(?:alt|link|page|lang|class)\s*=')
+
+def _expand_gallery(wikitext, start, end, namespaces, append):
+    """
+    Appends the nodes of the lines of a <gallery> whose content is
+    wikitext[start:end]. Each line is a file name followed by options and
+    a caption, the last field that is not an option; only the caption is
+    parsed, the rest is kept verbatim.
+    """
+    line_start = start
+    while line_start < end:
+        line_end = wikitext.find('\n', line_start, end)
+        next_line = end if line_end == -1 else line_end + 1
+        line_end = end if line_end == -1 else line_end
+        fields = _split_top_level(wikitext[line_start:line_end])
+        caption_start = line_end
+        for caption in reversed(fields[1:]):
+            caption_start -= len(caption) + 1
+            if caption.strip() and not _GALLERY_OPTION_RE.match(caption):
+                caption_start += 1  # After its '|'
+                caption_end = caption_start + len(caption)
+                append(Verbatim(wikitext, line_start, caption_start))
+                _append_parsed(wikitext, caption_start, caption_end, namespaces, append)
+                if caption_end < next_line:
+                    append(Verbatim(wikitext, caption_end, next_line))
+                break
+        else:
+            append(Verbatim(wikitext, line_start, next_line))
+        line_start = next_line
+
+def parse(wikitext, namespaces=None):
+    """
+    Parses the wikitext into a flat list of nodes covering it end to end.
+    Plain text between constructs becomes a single Text node; the regex
+    jumps straight to the next construct, so runs of plain text are never
+    visited character by character. Links are typed with the `namespaces`
+    registry, by default the built-in one.
+    """
+    match_namespace = (namespaces or default_namespaces).match
+    nodes = []
+    append = nodes.append
+    # A list at the very start has no newline before it
+    last = _parse_list(wikitext, 0, append)
+    text_length = len(wikitext)
+    search = _TOKEN_RE.search
+    find = _Finder(wikitext).find
+    match = search(wikitext, last)
+    braces = None  # Template index, built when the first template is found
+    links = None  # Link index, built when the first unterminated link is found
+
+    while match:
+        curr = match.start()
+        token = match.group()
+
+        if token in _STRAY_CLOSERS:
+            # Copied as it is, outside <translate> blocks, so that it never
+            # closes one
+            end_pos = match.end()
+            node = Verbatim(wikitext, curr, end_pos)
+        elif token[0] == '<':
+            name = token[1:]
+            content_start = find('>', curr) + 1
+            end_pos = content_start
+            if content_start and wikitext[content_start - 2] != '/' and name not in VOID_TAGS:
+                closing = '</' + name + '>'
+                content_end = find(closing, content_start)
+                end_pos = content_end + len(closing) if content_end != -1 else 0
+            if not end_pos and name in _TRANSLATE_TAGS:
+                # An unclosed <translate> or <tvar> leaves the rest of the
+                # text open: it is copied as it is, so that the opening tag
+                # never pairs with a closing tag added after it
+                end_pos = text_length
+                node = Verbatim(wikitext, curr, end_pos)
+            elif not end_pos:
+                # Unterminated tag: keep scanning after its name
+                match = search(wikitext, curr + len(token))
+                continue
+            else:
+                policy = TAG_POLICIES[name]
+                if policy is TagPolicy.inline:
+                    # The tags stay in the text around them, and so does the
+                    # content but for its links
+                    if end_pos != content_start and _TRANSLATE_TAG_RE.search(wikitext, content_start, content_end):
+                        # Already marked up: copied as it is
+                        append(Text(wikitext, last, curr))
+                        append(Verbatim(wikitext, curr, end_pos, name))
+                        last = end_pos
+                    elif end_pos != content_start:
+                        append(Text(wikitext, last, content_start))
+                        _append_inline(wikitext, content_start, content_end, namespaces, append)
+                        last = content_end
+                    match = search(wikitext, end_pos)
+                    continue
+                if policy in _EXPANDED_TAG_POLICIES and end_pos != content_start:
+                    # The content is parsed on its own, between the tags copied as they are
+                    if last < curr:
+                        append(Text(wikitext, last, curr))
+                    append(Verbatim(wikitext, curr, content_start, name))
+                    if policy is TagPolicy.recurse:
+                        _append_parsed(wikitext, content_start, content_end, namespaces, append)
+                    else:
+                        _expand_gallery(wikitext, content_start, content_end, namespaces, append)
+                    append(Verbatim(wikitext, content_end, end_pos))
+                    last = end_pos
+                    match = search(wikitext, end_pos)
+                    continue
+                node = Tag(wikitext, curr, end_pos, name)
+        elif token in _CLOSED_CONSTRUCTS:
+            closing = _CLOSED_CONSTRUCTS[token]
+            end_pos = find(closing, curr)
+            if end_pos == -1:
+                # Unterminated construct: keep scanning after the opening pattern
+                match = search(wikitext, curr + len(token))
+                continue
+            end_pos += len(closing)
+            if last < curr:
+                append(Text(wikitext, last, curr))
+            _expand_table(wikitext, curr, end_pos, namespaces, append)
+            last = end_pos
+            match = search(wikitext, end_pos)
+            continue
+        elif token[0] == '\n':
+            # Lists: the newline stays with the preceding text
+            curr += 1
+            append(Text(wikitext, last, curr))
+            last = _parse_list(wikitext, curr, append)
+            match = search(wikitext, last)
+            continue
+        elif token == '[[':
+            if links is None:
+                end_pos = _find_link_end(wikitext, curr)
+                if end_pos == -1:
+                    links = _build_link_index(wikitext)
+            else:
+                end_pos = links.get(curr, -1)
+            if end_pos == -1:
+                # Unterminated link: the first bracket is plain text
+                match = search(wikitext, curr + 1)
+                continue
+            node = _LINK_NODE_TYPES[match_namespace(wikitext, curr + 2)[0]](wikitext, curr, end_pos)
+        elif token == '[http':
+            end_pos = find(']', curr)
+            if end_pos == -1:
+                # Unterminated external link: the bracket is plain text
+                match = search(wikitext, curr + 1)
+                continue
+            end_pos += 1  # Include the closing ']' in the node
+            node = ExternalLink(wikitext, curr, end_pos)
+        elif token == '{{':
+            if braces is None:
+                braces = _build_brace_index(wikitext)
+            end_pos = braces.get(curr)
+            if end_pos is None:
+                # No matching braces: the first brace is plain text, and so
+                # is the second unless more braces follow
+                match = search(wikitext, curr + 1 if wikitext.startswith('{', curr + 2) else curr + 2)
+                continue
+            node = Template(wikitext, curr, end_pos)
+        elif token == 'http':
+            end_pos = _url_end(wikitext, curr, find)
+            node = Url(wikitext, curr, end_pos)
+        else:
+            end_pos = match.end()
+            node = Switch(wikitext, curr, end_pos)
+
+        if last < curr:
+            append(Text(wikitext, last, curr))
+        if _TRANSLATE_TAG_RE.search(wikitext, curr, end_pos) and _breaks_units(wikitext[curr:end_pos]):
+            # Copied as it is, since converting it could put it in a <translate> block
+            node = Verbatim(wikitext, curr, end_pos, node.kind)
+        append(node)
+        last = end_pos
+        match = search(wikitext, end_pos)
+
+    # Add any remaining text after the last construct
+    if last < text_length:
+        append(Text(wikitext, last, text_length))
+    return nodes
+
+# --- Incremental Tokenisation ---
+# Long pages are split at blank lines that no construct spans. Every such
+# segment parses to the same nodes on its own as it does inside the whole
+# page, so its nodes can be memoised by content hash and reused when only
+# other paragraphs of the page change. Tvar numbering and merging still run
+# over the stitched nodes, which keeps the tvar names globally consistent.
+
+# Handlers whose output does not depend on the tvar counters; their nodes
+# are memoised already converted
+_POSITION_INDEPENDENT_HANDLERS = frozenset([
+    process_wrapped_tag, process_table, process_item, process_template, process_raw_url,
+])
+
+def _split_segments(wikitext):
+    """
+    Splits the wikitext before the second newline of every blank line that
+    is outside links, templates, tables, tags and URLs. The segments are
+    yielded as soon as they are found.
+    """
+    find = _Finder(wikitext).find
+    start = 0
+    link_depth = 0
+    open_until = 0  # End of the furthest construct opened so far
+    text_length = len(wikitext)
+    # Templates are matched exactly as the tokeniser matches them
+    templates = sorted(_build_brace_index(wikitext).items()) if '{{' in wikitext else []
+    next_template = 0
+    for match in _SEGMENT_SCAN_RE.finditer(wikitext):
+        token = match.group()
+        pos = match.start()
+        if token == '\n':
+            boundary = pos + 1
+            while next_template < len(templates) and templates[next_template][0] < boundary:
+                open_until = max(open_until, templates[next_template][1])
+                next_template += 1
+            if not link_depth and boundary >= open_until and boundary > start:
+                yield wikitext[start:boundary]
+                start = boundary
+        elif token == '[[':
+            link_depth += 1
+        elif token == ']]':
+            link_depth = max(link_depth - 1, 0)
+        elif token[0] == '<':
+            # Tags end as the tokeniser ends them: with their opening tag if
+            # it is self-closing or void, otherwise with their closing tag
+            end_pos = find('>', pos)
+            name = token[1:]
+            if end_pos != -1 and wikitext[end_pos - 1] != '/' and name not in VOID_TAGS:
+                end_pos = find('</' + name + '>', end_pos)
+            if end_pos == -1 and name in _TRANSLATE_TAGS:
+                end_pos = text_length  # Open until the end, see parse
+            open_until = max(open_until, end_pos)
+        elif token in _CLOSED_CONSTRUCTS:
+            end_pos = find(_CLOSED_CONSTRUCTS[token], pos)
+            if end_pos != -1:
+                open_until = max(open_until, end_pos)
+        else:
+            # External links run to the next ']', see _url_end for raw URLs
+            if token == '[http':
+                end_pos = find(']', pos)
+                open_until = max(open_until, text_length if end_pos == -1 else end_pos)
+            else:
+                open_until = max(open_until, _url_end(wikitext, pos, find))
+    yield wikitext[start:]
+
+def _parse_segment(segment, namespaces):
+    """
+    Returns the nodes of one segment, with position-independent nodes
+    already converted to Verbatim ones, from the segment cache when possible.
+    """
+    key = (namespaces.name, hashlib.blake2b(segment.encode('utf-8'), digest_size=16).digest())
+    nodes = segment_cache.get(key)
+    if nodes is None:
+        nodes = tuple(
+            Verbatim.of(node.handler(node.text), node.kind) if node.handler in _POSITION_INDEPENDENT_HANDLERS else node
+            for node in parse(segment, namespaces)
+        )
+        size = sys.getsizeof(segment) + sum(sys.getsizeof(node.source) for node in nodes if type(node) is Verbatim)
+        segment_cache.put(key, nodes, size=size)
+    return nodes
+
+def _parse_incremental(wikitext, namespaces=None):
+    """
+    Same as parse, but reuses the memoised nodes of unchanged segments.
+    """
+    namespaces = namespaces or default_namespaces
+    nodes = []
+    for segment in _split_segments(wikitext):
+        nodes.extend(_parse_segment(segment, namespaces))
+    return nodes
+
+segment_cache = ConversionCache(
+    max_entries=app.config['SEGMENT_CACHE_MAX_ENTRIES'],
+    max_bytes=app.config['SEGMENT_CACHE_MAX_BYTES'],
+)
+
+# Link types whose converted text is translatable
+_TRANSLATABLE_LINK_TYPES = frozenset([
+    double_brackets_types.wikilink, double_brackets_types.special, double_brackets_types.inline_icon,
+])
+
+_TVAR_NAME_RE = re.compile(r'<tvar name=([^>]*)>')
+
+class ConversionTimeout(Exception):
+    """
+    Raised when a conversion runs past its deadline.
+    """
+
+class ConversionTrace:
+    """
+    Record of a conversion, filled in by render(): every node with its
+    offsets, handler, processing time and the tvar names it was given,
+    and every <translate> block with the nodes it wraps. Only the first
+    `max_tokens` nodes are recorded; `token_count` counts all of them.
+    """
+
+    def __init__(self, max_tokens=None):
+        self.max_tokens = max_tokens
+        self.token_count = 0
+        self.tokens = []
+        self.blocks = []
+        self.tvars = {}  # tvar name -> index of the token that defines it
+        self._pending = []  # Indexes of the tokens in the next <translate> block
+
+    def token(self, node, seconds=0.0, converted=None, translatable=False):
+        self.token_count += 1
+        index = len(self.tokens)
+        if self.max_tokens is not None and index >= self.max_tokens:
+            return
+        record = {
+            'index': index,
+            'kind': node.kind,
+            'start': node.start,
+            'end': node.end,
+            'handler': node.handler.__name__,
+            'seconds': seconds,
+        }
+        if converted is not None:
+            record['tvars'] = _TVAR_NAME_RE.findall(converted)
+            for name in record['tvars']:
+                self.tvars[name] = index
+        if translatable:
+            self._pending.append(index)
+        self.tokens.append(record)
+
+    def block(self, seconds):
+        index = len(self.blocks)
+        tokens = self._pending
+        self._pending = []
+        if not tokens:
+            return  # Past max_tokens
+        for token in tokens:
+            self.tokens[token]['block'] = index
+        self.blocks.append({
+            'index': index,
+            'start': self.tokens[tokens[0]]['start'],
+            'end': self.tokens[tokens[-1]]['end'],
+            'tokens': tokens,
+            'seconds': seconds,
+        })
+
+    def slowest(self, count=10):
+        """
+        Returns the `count` tokens that took the longest to convert.
+        """
+        return sorted(self.tokens, key=lambda token: token['seconds'], reverse=True)[:count]
+
+def render_iter(nodes, namespaces=None, trace=None, deadline=None):
+    """
+    Converts parsed nodes to translatable wikitext, yielding the output
+    piece by piece. Runs of text and translatable links are wrapped in a
+    single <translate> block; tvar names are numbered in document order.
+    `nodes` may be any iterable and is consumed lazily.
+    With a ConversionTrace, what happens to every node is recorded in it.
+    ConversionTimeout is raised if a construct is reached after `deadline`,
+    a time.monotonic() value.
+    """
+    pending = []  # Translatable text not wrapped yet
+    tvar_id = 0
+    tvar_url_id = 0
+    tvar_tag_ids = {}  # Next tvar number of the tags with the tvar policy, by tag name
+
+    def flush():
+        if trace is None:
+            wrapped = _wrap_in_translate(''.join(pending))
+        else:
+            started = time.perf_counter()
+            wrapped = _wrap_in_translate(''.join(pending))
+            trace.block(time.perf_counter() - started)
+        pending.clear()
+        return wrapped
+
+    for node in nodes:
+        node_type = type(node)
+        if node_type is Text:
+            pending.append(node.text)
+            if trace is not None:
+                trace.token(node, translatable=True)
+            continue
+        if deadline is not None and time.monotonic() > deadline:
+            raise ConversionTimeout('Conversion ran past its deadline')
+        if trace is not None:
+            started = time.perf_counter()
+        translatable = True
+        # Handlers for links and tvar tags require a tvar id
+        if isinstance(node, Link):
+            converted, double_brackets_type = process_double_brackets(node.text, tvar_id, namespaces)
+            tvar_id += 1
+            translatable = double_brackets_type in _TRANSLATABLE_LINK_TYPES
+        elif node_type is ExternalLink:
+            converted = process_external_link(node.text, tvar_url_id)
+            tvar_url_id += 1
+        elif node_type is Tag and node.policy is TagPolicy.tvar:
+            name = node.name
+            tvar_number = tvar_tag_ids.get(name, 0)
+            tvar_tag_ids[name] = tvar_number + 1
+            converted = process_tvar_tag(node.text, f'{name}{tvar_number}')
+        else:
+            converted = node.handler(node.text)
+            translatable = False
+        if trace is not None:
+            trace.token(node, time.perf_counter() - started, converted, translatable)
+        if translatable:
+            pending.append(converted)
+            continue
+        if pending:
+            yield flush()
+        yield converted
+    if pending:
+        yield flush()
+
+def render(nodes, namespaces=None, trace=None, deadline=None):
+    """
+    Converts parsed nodes to translatable wikitext, see render_iter.
+    """
+    return ''.join(render_iter(nodes, namespaces, trace, deadline))
+
+# --- Metrics ---
+# Conversions are instrumented in the process that runs them: /metrics
+# covers the web process, not the batch and job worker processes.
+
+metrics_registry = Registry()
+CONVERSIONS = metrics_registry.register(Counter(
+    'translate_tagger_conversions_total', 'Conversions run in this process.'))
+STAGE_SECONDS = metrics_registry.register(Histogram(
+    'translate_tagger_conversion_stage_seconds',
+    'Wall time of each conversion stage: parse (tokenising) and render '
+    '(tvar numbering, merging and handlers, done in one pass).', ['stage']))
+CONSTRUCTS = metrics_registry.register(Counter(
+    'translate_tagger_constructs_total', 'Constructs found in converted pages, by kind.', ['kind']))
+INPUT_BYTES = metrics_registry.register(Counter(
+    'translate_tagger_input_bytes_total', 'UTF-8 size of the converted wikitext.'))
+OUTPUT_BYTES = metrics_registry.register(Counter(
+    'translate_tagger_output_bytes_total', 'UTF-8 size of the translatable wikitext produced.'))
+REQUEST_SECONDS = metrics_registry.register(Histogram(
+    'translate_tagger_request_duration_seconds', 'Latency of the conversion routes.',
+    ['path', 'method', 'status']))
+
+def _count_kinds(nodes, kinds):
+    """
+    Yields the nodes, counting them by kind in the `kinds` dict.
+    """
+    for node in nodes:
+        kind = node.kind
+        kinds[kind] = kinds.get(kind, 0) + 1
+        yield node
+
+def _record_conversion(wikitext, kinds, output_bytes, parse_seconds, render_seconds):
+    CONVERSIONS.inc()
+    STAGE_SECONDS.observe(parse_seconds, stage='parse')
+    STAGE_SECONDS.observe(render_seconds, stage='render')
+    INPUT_BYTES.inc(len(wikitext.encode('utf-8')))
+    OUTPUT_BYTES.inc(output_bytes)
+    kinds.pop('text', None)
+    kinds.pop(None, None)
+    for kind, count in kinds.items():
+        CONSTRUCTS.inc(count, kind=kind)
+
+def _deadline(time_budget):
+    if time_budget is None:
+        return None
+    return time.monotonic() + time_budget
+
+def _check_deadline(deadline):
+    if deadline is not None and time.monotonic() > deadline:
+        raise ConversionTimeout('Conversion ran past its deadline')
+
+def convert_to_translatable_wikitext(wikitext, incremental=False, namespaces=None, time_budget=None):
+    """
+    Converts standard wikitext to translatable wikitext by wrapping
+    translatable text with <translate> tags, while preserving and
+    correctly handling special wikitext elements.
+    This function tokenizes the entire text, not line by line.
+    With `incremental`, paragraphs already seen are not tokenised again.
+    `namespaces` is the NamespaceRegistry of the wiki the text comes from.
+    With a `time_budget` in seconds, ConversionTimeout is raised once the
+    conversion has taken longer.
+    """
+    if not wikitext:
+        return ""
+    deadline = _deadline(time_budget)
+    start = time.perf_counter()
+    nodes = _parse_incremental(wikitext, namespaces) if incremental else parse(wikitext, namespaces)
+    parsed = time.perf_counter()
+    _check_deadline(deadline)
+    converted = render(nodes, namespaces, deadline=deadline)
+    if app.config['CONVERSION_METRICS']:
+        render_seconds = time.perf_counter() - parsed
+        kinds = {}
+        for _ in _count_kinds(nodes, kinds):
+            pass
+        _record_conversion(wikitext, kinds, len(converted.encode('utf-8')), parsed - start, render_seconds)
+    return converted
+
+# Characters of output gathered before convert_iter yields them
+CONVERT_ITER_CHUNK_SIZE = 64 * 1024
+
+def convert_iter(wikitext, incremental=False, namespaces=None, time_budget=None, chunk_size=CONVERT_ITER_CHUNK_SIZE):
+    """
+    Converts `wikitext` like convert_to_translatable_wikitext, but yields
+    the output in chunks of about `chunk_size` characters as soon as they
+    are converted. The page is parsed one segment (see _split_segments) at
+    a time, so besides the input only the nodes of the current segment and
+    one chunk of output are held in memory. Once the first chunk has been
+    yielded, a ConversionTimeout can only interrupt the iteration.
+    """
+    if not wikitext:
+        return
+    namespaces = namespaces or default_namespaces
+    deadline = _deadline(time_budget)
+    parse_segment = _parse_segment if incremental else parse
+    parse_seconds = 0
+
+    def parse_segments():
+        nonlocal parse_seconds
+        for segment in _split_segments(wikitext):
+            started = time.perf_counter()
+            nodes = parse_segment(segment, namespaces)
+            parse_seconds += time.perf_counter() - started
+            yield from nodes
+
+    def chunks(nodes):
+        chunk = []
+        size = 0
+        for piece in render_iter(nodes, namespaces, deadline=deadline):
+            chunk.append(piece)
+            size += len(piece)
+            if size >= chunk_size:
+                yield ''.join(chunk)
+                chunk.clear()
+                size = 0
+        if chunk:
+            yield ''.join(chunk)
+
+    if not app.config['CONVERSION_METRICS']:
+        yield from chunks(parse_segments())
+        return
+    kinds = {}
+    output_bytes = 0
+    busy = 0  # Time spent converting, not waiting for the consumer
+    resumed = time.perf_counter()
+    for chunk in chunks(_count_kinds(parse_segments(), kinds)):
+        output_bytes += len(chunk.encode('utf-8'))
+        busy += time.perf_counter() - resumed
+        yield chunk
+        resumed = time.perf_counter()
+    busy += time.perf_counter() - resumed
+    _record_conversion(wikitext, kinds, output_bytes, parse_seconds, busy - parse_seconds)
+
+def trace_conversion(wikitext, namespaces=None, time_budget=None, max_tokens=None):
+    """
+    Converts `wikitext` like convert_to_translatable_wikitext and returns
+    {"converted", "stages", "tokens", "blocks", "tvars", "slowest",
+    "token_count", "truncated"}: the time of each stage, every token with
+    its offsets in `wikitext`, handler, processing time and tvars, the
+    <translate> blocks, the token defining each tvar and the slowest tokens.
+    With `max_tokens`, only the first tokens and what refers to them are
+    listed, and "truncated" is true if there were more.
+    Meant for finding what makes a page slow; tracing itself slows the
+    conversion down. `time_budget` is enforced as in
+    convert_to_translatable_wikitext.
+    """
+    trace = ConversionTrace(max_tokens)
+    deadline = _deadline(time_budget)
+    start = time.perf_counter()
+    nodes = parse(wikitext, namespaces) if wikitext else []
+    parsed = time.perf_counter()
+    _check_deadline(deadline)
+    converted = render(nodes, namespaces, trace, deadline)
+    return {
+        'converted': converted,
+        'stages': {'parse': parsed - start, 'render': time.perf_counter() - parsed},
+        'tokens': trace.tokens,
+        'blocks': trace.blocks,
+        'tvars': trace.tvars,
+        'slowest': [token['index'] for token in trace.slowest()],
+        'token_count': trace.token_count,
+        'truncated': trace.token_count > len(trace.tokens),
+    }
+
+_TRANSLATE_BLOCK_RE = re.compile(r'<translate(?:\s[^>]*)?>(.*?)</translate>', re.DOTALL)
+
+def unit_hash(content):
+    """
+    Stable hash of the content of a translation unit.
+    """
+    return hashlib.blake2b(content.encode('utf-8'), digest_size=16).hexdigest()
+
+def translation_units(converted):
+    """
+    Returns the <translate> units of converted wikitext, in order, as
+    {"index", "start", "end", "tvars", "hash"}: the offsets of the content
+    of the unit in `converted`, the tvar names it uses and unit_hash() of
+    the content. Comparing the hashes of two revisions of a page tells
+    which units changed.
+    """
+    units = []
+    for index, match in enumerate(_TRANSLATE_BLOCK_RE.finditer(converted)):
+        content = match.group(1)
+        units.append({
+            'index': index,
+            'start': match.start(1),
+            'end': match.end(1),
+            'tvars': _TVAR_NAME_RE.findall(content),
+            'hash': unit_hash(content),
+        })
+    return units
+
+# A tvar with its value, and the target that follows a link tvar, e.g.
+# "/Page" in [[<tvar name=0>Special:MyLanguage</tvar>/Page|page]]: without it
+# every link would have the same value. Descriptions are not part of it.
+_TVAR_RE = re.compile(r'<tvar name=([^>]*)>(.*?</tvar>(?:/[^\]|<]*)?)', re.DOTALL)
+_TVAR_NUMBER_RE = re.compile(r'(.*?)(\d+)')
+
+def _tvar_family(name):
+    """
+    Splits a tvar name such as "code3" into its family and number, ("code", 3).
+    """
+    match = _TVAR_NUMBER_RE.fullmatch(name)
+    return (match.group(1), int(match.group(2))) if match else (name, None)
+
+def _carry_tvar_names(old_converted, old_part, new_part):
+    """
+    Returns `new_part`, the conversion replacing `old_part` of
+    `old_converted`, with the tvar names of `old_part` carried over.
+
+    Units are matched by their content with tvar names left out, in a
+    single pass: a unit that did not change is copied from `old_part`.
+    In the other units, every tvar takes the name of a tvar with the same
+    value (and link target) from an old unit that is gone, or a new name
+    numbered after every name of `old_converted`.
+    """
+    next_numbers = {}  # Next free number of every tvar family
+    for name in _TVAR_NAME_RE.findall(old_converted):
+        family, number = _tvar_family(name)
+        if number is not None:
+            next_numbers[family] = max(next_numbers.get(family, 0), number + 1)
+    old_units = [match.group(1) for match in _TRANSLATE_BLOCK_RE.finditer(old_part)]
+    unchanged = {}  # Unit content without tvar names -> indexes of the old units
+    for index, content in enumerate(old_units):
+        unchanged.setdefault(_TVAR_NAME_RE.sub('<tvar>', content), deque()).append(index)
+
+    new_units = list(_TRANSLATE_BLOCK_RE.finditer(new_part))
+    replacements = [None] * len(new_units)
+    used = [False] * len(old_units)
+    for position, match in enumerate(new_units):
+        indexes = unchanged.get(_TVAR_NAME_RE.sub('<tvar>', match.group(1)))
+        if indexes:
+            index = indexes.popleft()
+            used[index] = True
+            replacements[position] = old_units[index]
+    # The tvars of the old units that are gone, which changed units may take over
+    available = {}  # (family, value) -> old names
+    for index, is_used in enumerate(used):
+        if not is_used:
+            for name, value in _TVAR_RE.findall(old_units[index]):
+                available.setdefault((_tvar_family(name)[0], value), deque()).append(name)
+
+    def rename(content):
+        def tvar(match):
+            name, value = match.groups()
+            family, number = _tvar_family(name)
+            names = available.get((family, value))
+            if names:
+                return f'<tvar name={names.popleft()}>{value}'
+            if number is None:
+                return match.group()
+            number = next_numbers.get(family, 0)
+            next_numbers[family] = number + 1
+            return f'<tvar name={family}{number}>{value}'
+        return _TVAR_RE.sub(tvar, content)
+
+    for position, replacement in enumerate(replacements):
+        if replacement is None:
+            replacements[position] = rename(new_units[position].group(1))
+
+    pieces = []
+    last = 0
+    for match, replacement in zip(new_units, replacements):
+        pieces.append(new_part[last:match.start(1)])
+        pieces.append(replacement)
+        last = match.end(1)
+    pieces.append(new_part[last:])
+    return ''.join(pieces)
+
+def _translatable(node, namespaces):
+    """
+    Whether render() puts the converted node in a <translate> block with
+    the text around it.
+    """
+    node_type = type(node)
+    if node_type is Text or node_type is Link or node_type is ExternalLink:
+        return True
+    if node_type is File:
+        return process_double_brackets(node.text, 0, namespaces)[1] in _TRANSLATABLE_LINK_TYPES
+    return node_type is Tag and node.policy is TagPolicy.tvar
+
+def _blank_edge(nodes, namespaces, at_end):
+    """
+    Whether the translatable nodes at the start of `nodes`, or at their end
+    with `at_end`, are whitespace only and end at a node that is not
+    translatable, so that no <translate> block takes in text across them.
+    """
+    for node in reversed(nodes) if at_end else nodes:
+        if not _translatable(node, namespaces):
+            return True
+        if type(node) is not Text or node.text.strip(_WRAP_WHITESPACE):
+            return False
+    return False
+
+# Tvar names, which may differ between two conversions of the same text
+_TVAR_NAME_SPLIT_RE = re.compile(r'<tvar name=[^>]*>')
+
+def _find_converted(old_converted, converted):
+    """
+    Returns the (start, end) span of `old_converted` that is `converted`
+    but for tvar names, or None unless there is exactly one.
+    """
+    pattern = re.compile(
+        _TVAR_NAME_SPLIT_RE.pattern.join(re.escape(piece) for piece in _TVAR_NAME_SPLIT_RE.split(converted)))
+    match = pattern.search(old_converted)
+    if match is None or pattern.search(old_converted, match.start() + 1):
+        return None
+    return match.span()
+
+def convert_revision(old_wikitext, old_converted, new_wikitext, namespaces=None, time_budget=None):
+    """
+    Converts `new_wikitext`, a new revision of `old_wikitext` whose
+    conversion is `old_converted`, keeping the tvar names of the old
+    conversion so that existing translations stay valid.
+
+    Both revisions are split into segments (see _split_segments) and the
+    segments they share at their start and end are lined up: their
+    conversion is copied from `old_converted`. Only the segments in between
+    are parsed and rendered, widened to boundaries that no <translate>
+    block crosses, so that the cost grows with the size of the edit rather
+    than of the page. The old segments in between are found in
+    `old_converted` by their conversion; if they cannot be, e.g. because
+    `old_converted` was edited by hand, the whole page is converted.
+    Tvar names are then carried over as described in _carry_tvar_names,
+    and an unchanged page is returned as it was.
+    """
+    if new_wikitext == old_wikitext:
+        return old_converted
+    namespaces = namespaces or default_namespaces
+    deadline = _deadline(time_budget)
+    old_segments = list(_split_segments(old_wikitext))
+    new_segments = list(_split_segments(new_wikitext))
+    shared = min(len(old_segments), len(new_segments))
+    head = 0
+    while head < shared and old_segments[head] == new_segments[head]:
+        head += 1
+    tail = 0
+    while tail < shared - head and old_segments[-1 - tail] == new_segments[-1 - tail]:
+        tail += 1
+
+    def nodes(segments):
+        return [node for segment in segments for node in _parse_segment(segment, namespaces)]
+
+    def separates(segments, index):
+        # Whether the conversion of segments[:index] is the start of the conversion of segments
+        if index == 0 or index == len(segments):
+            return True
+        return (_blank_edge(_parse_segment(segments[index - 1], namespaces), namespaces, True)
+                or _blank_edge(_parse_segment(segments[index], namespaces), namespaces, False))
+
+    start = head
+    old_end = len(old_segments) - tail
+    new_end = len(new_segments) - tail
+    while True:
+        while not (separates(old_segments, start) and separates(new_segments, start)):
+            start -= 1
+        while not (separates(old_segments, old_end) and separates(new_segments, new_end)):
+            old_end += 1
+            new_end += 1
+        _check_deadline(deadline)
+        if start == 0 and old_end == len(old_segments):
+            span = (0, len(old_converted))
+            break
+        if start < old_end:
+            span = _find_converted(old_converted, render(nodes(old_segments[start:old_end]), namespaces, deadline=deadline))
+            if span is not None:
+                break
+        # Not found, or not only once: take in the segments around
+        if start > 0:
+            start -= 1
+        if old_end < len(old_segments):
+            old_end += 1
+            new_end += 1
+
+    converted = render(nodes(new_segments[start:new_end]), namespaces, deadline=deadline)
+    old_start, old_stop = span
+    return (old_converted[:old_start]
+            + _carry_tvar_names(old_converted, old_converted[old_start:old_stop], converted)
+            + old_converted[old_stop:])
+
+def _convert_many(texts, wiki=None, time_budget=None):
+    """
+    Converts a list of wikitext strings from `wiki` in a worker process.
+    Returns a list of (converted, error) tuples so that one failing
+    document does not fail the rest of its chunk.
+    """
+    namespaces = get_namespaces(wiki)
+    results = []
+    for text in texts:
+        try:
+            results.append((convert_to_translatable_wikitext(
+                text, namespaces=namespaces, time_budget=time_budget), None))
+        except ConversionTimeout:
+            results.append((None, _time_budget_error(time_budget)))
+        except Exception as e:
+            results.append((None, f'Conversion failed: {e!r}'))
+    return results
+
+def _time_budget_error(time_budget):
+    return f'Conversion exceeded the time budget of {time_budget} seconds'
+
+def _input_size_error(max_bytes):
+    return f'Page exceeds {max_bytes} bytes'
+
+def _byte_size(text):
+    """
+    The size of `text` in UTF-8, which the *_BYTES limits are given in.
+    """
+    return len(text.encode('utf-8'))
+
+def convert_ndjson(lines, namespaces=None, max_bytes=None, time_budget=None):
+    """
+    Converts newline-delimited JSON records of the form
+    {"title": ..., "wikitext": ...}, yielding one NDJSON line per record as
+    soon as it is converted. Only one record is held in memory at a time.
+    Blank lines are skipped; malformed records, records larger than
+    `max_bytes` and records taking longer than `time_budget` seconds to
+    convert produce an "error" line.
+    """
+    for line_number, line in enumerate(lines, 1):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            result = {'line': line_number, 'error': f'Invalid JSON: {e}'}
+        else:
+            if not isinstance(record, dict) or not isinstance(record.get('wikitext'), str):
+                result = {'line': line_number, 'error': 'Missing "wikitext" string'}
+                if isinstance(record, dict) and 'title' in record:
+                    result['title'] = record['title']
+            elif max_bytes is not None and _byte_size(record['wikitext']) > max_bytes:
+                result = {'line': line_number, 'title': record.get('title'), 'error': _input_size_error(max_bytes)}
+            else:
+                try:
+                    converted = convert_to_translatable_wikitext(
+                        record['wikitext'], namespaces=namespaces, time_budget=time_budget)
+                except ConversionTimeout:
+                    result = {'line': line_number, 'title': record.get('title'),
+                              'error': _time_budget_error(time_budget)}
+                else:
+                    result = {'title': record.get('title'), 'converted': converted}
+        yield json.dumps(result, ensure_ascii=False) + '\n'
+
+conversion_cache = ConversionCache(
+    max_entries=app.config['CONVERSION_CACHE_MAX_ENTRIES'],
+    max_bytes=app.config['CONVERSION_CACHE_MAX_BYTES'],
+)
+
+for name, policy in app.config['SITE_TAGS'].items():
+    register_tag(name, policy)
+
+# Identifies this version of the converter in ETags, so that clients do not
+# keep results produced by an older deployment
+with open(__file__, 'rb') as f:
+    _CONVERTER_FINGERPRINT = hashlib.sha256(f.read()).hexdigest()[:12]
+
+def conversion_etag(key, namespaces=None):
+    """
+    Returns the ETag of the result whose cache key is `key`. It changes
+    with the converter, the tag policies (SITE_TAGS, register_tag) and the
+    names of the `namespaces` registry, as the result may.
+    """
+    fingerprint = _CONVERTER_FINGERPRINT + _TAG_FINGERPRINT + (namespaces or default_namespaces).fingerprint
+    return f'{hashlib.sha256(fingerprint.encode()).hexdigest()[:12]}-{key}'
+
+def convert_cached(wikitext, key=None, namespaces=None):
+    """
+    Returns the conversion of `wikitext`, serving repeated inputs from
+    `conversion_cache`. `key` may be passed if the hash was already computed.
+    Conversions are limited to CONVERSION_TIME_BUDGET.
+    """
+    namespaces = namespaces or default_namespaces
+    if key is None:
+        key = ConversionCache.key(wikitext, namespaces.name)
+    converted_text = conversion_cache.get(key)
+    if converted_text is None:
+        converted_text = convert_to_translatable_wikitext(
+            wikitext, incremental=app.config['INCREMENTAL_CONVERSION'], namespaces=namespaces,
+            time_budget=app.config['CONVERSION_TIME_BUDGET'])
+        store_conversion(key, wikitext, converted_text, namespaces)
+    return converted_text
+
+def store_conversion(key, wikitext, converted_text, namespaces=None):
+    """
+    Adds the conversion of `wikitext`, whose cache key is `key`, to
+    `conversion_cache`.
+    """
+    conversion_cache.put(key, converted_text)
+    if converted_text != wikitext:
+        # Converting the result again changes nothing: a page sent back
+        # as it was converted is then only hashed
+        namespaces = namespaces or default_namespaces
+        conversion_cache.put(ConversionCache.key(converted_text, namespaces.name), converted_text)
+
+_executor = None
+
+def get_executor():
+    """
+    Returns the process pool used for bulk conversions, creating it on first use.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=app.config['CONVERT_WORKERS'])
+    return _executor
+
+# --- Asynchronous Jobs ---
+
+# Seconds between two progress updates of a running job
+JOB_PROGRESS_INTERVAL = 0.5
+
+def _report_progress(nodes, report, start, end):
+    """
+    Yields the nodes, reporting the fraction of them consumed, scaled to
+    the [start, end] range, at most every JOB_PROGRESS_INTERVAL seconds.
+    """
+    total = len(nodes) or 1
+    last_report = time.monotonic()
+    for i, node in enumerate(nodes):
+        if i % 1024 == 0 and time.monotonic() - last_report >= JOB_PROGRESS_INTERVAL:
+            report(start + (end - start) * i / total)
+            last_report = time.monotonic()
+        yield node
+
+def _run_job(database, ttl, job_id, wikitext, wiki, previous=None):
+    """
+    Converts the page of a job in a worker process, recording its progress
+    and result in the job store. With `previous`, an (old_wikitext,
+    old_converted) pair, the page is converted with convert_revision.
+    """
+    store = JobStore(database, ttl)
+    store.update(job_id, status=RUNNING)
+
+    def report(progress):
+        store.update(job_id, progress=round(progress, 3))
+
+    try:
+        namespaces = get_namespaces(wiki)
+        if previous is not None:
+            # Converted in one go, only the end is reported
+            converted = convert_revision(*previous, wikitext, namespaces)
+        else:
+            nodes = parse(wikitext, namespaces)
+            # Parsing takes about a fifth of the conversion time
+            report(0.2)
+            converted = render(_report_progress(nodes, report, 0.2, 1.0), namespaces)
+    except Exception as e:
+        store.update(job_id, status=FAILED, error=f'Conversion failed: {e!r}')
+    else:
+        store.update(job_id, status=DONE, progress=1.0, result=converted)
+
+_job_store = None
+_job_executor = None
+_pending_jobs = 0
+_pending_jobs_lock = threading.Lock()
+
+def get_job_store():
+    """
+    Returns the store of the jobs, opening the JOB_DATABASE on first use.
+    """
+    global _job_store
+    if _job_store is None or _job_store.path != app.config['JOB_DATABASE']:
+        _job_store = JobStore(app.config['JOB_DATABASE'], app.config['JOB_TTL'])
+    return _job_store
+
+def get_job_executor():
+    """
+    Returns the process pool running the jobs, creating it on first use.
+    It is separate from the bulk conversion pool so that long jobs do not
+    delay batches.
+    """
+    global _job_executor
+    if _job_executor is None:
+        _job_executor = ProcessPoolExecutor(max_workers=app.config['JOB_WORKERS'])
+    return _job_executor
+
+def submit_job(wikitext, namespaces=None, previous=None):
+    """
+    Queues the conversion of `wikitext` and returns the job ID, or None if
+    MAX_PENDING_JOBS jobs are already queued or running. Pages already in
+    the conversion cache make jobs that are done at once. With `previous`,
+    an (old_wikitext, old_converted) pair, `wikitext` is converted as a
+    new revision of old_wikitext, see convert_revision.
+    """
+    global _pending_jobs
+    namespaces = namespaces or default_namespaces
+    store = get_job_store()
+    store.purge()
+    cached = conversion_cache.get(ConversionCache.key(wikitext, namespaces.name)) if previous is None else None
+    if cached is not None:
+        return store.create(len(wikitext), namespaces.name, status=DONE, result=cached)
+
+    with _pending_jobs_lock:
+        if _pending_jobs >= app.config['MAX_PENDING_JOBS']:
+            return None
+        _pending_jobs += 1
+    job_id = store.create(len(wikitext), namespaces.name)
+
+    def finished(future):
+        global _pending_jobs
+        with _pending_jobs_lock:
+            _pending_jobs -= 1
+        if future.exception() is not None:
+            # The worker died before it could record the failure
+            store.update(job_id, status=FAILED, error=f'Conversion failed: {future.exception()!r}')
+
+    future = get_job_executor().submit(
+        _run_job, store.path, store.ttl, job_id, wikitext, namespaces.name, previous)
+    future.add_done_callback(finished)
+    return job_id
+
+def _job_response(job_id, status_code=200):
+    job = get_job_store().get(job_id)
+    if job is None:
+        return jsonify({'error': f'Unknown or expired job {job_id!r}'}), 404
+    body = {key: job[key] for key in ('id', 'status', 'progress', 'wiki', 'size', 'created', 'updated')}
+    if job['status'] == DONE:
+        body['converted'] = job['result']
+    elif job['status'] == FAILED:
+        body['error'] = job['error']
+    response = jsonify(body)
+    response.status_code = status_code
+    if status_code == 202:
+        response.headers['Location'] = f'/api/jobs/{job_id}'
+        if respond_async({}, request.headers.get('Prefer')):
+            response.headers['Preference-Applied'] = 'respond-async'
+    return response
+
+def _queue_job(wikitext, namespaces, previous=None):
+    if any(_byte_size(text) > app.config['MAX_JOB_BYTES'] for text in (wikitext, *(previous or ()))):
+        return jsonify({'error': f'Page exceeds {app.config["MAX_JOB_BYTES"]} bytes'}), 413
+    job_id = submit_job(wikitext, namespaces, previous)
+    if job_id is None:
+        response = jsonify({'error': 'Too many pending jobs, try again later'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '5'
+        return response
+    return _job_response(job_id, 202)
+
+def _cache_metrics(field):
+    return lambda: [
+        (('conversions',), conversion_cache.stats()[field]),
+        (('segments',), segment_cache.stats()[field]),
+    ]
+
+for field, metric_type, documentation in (
+    ('entries', 'gauge', 'Entries in the cache.'),
+    ('bytes', 'gauge', 'Memory used by the cached values.'),
+    ('hits', 'counter', 'Cache hits.'),
+    ('misses', 'counter', 'Cache misses.'),
+    ('evictions', 'counter', 'Entries evicted from the cache.'),
+):
+    suffix = '_total' if metric_type == 'counter' else ''
+    metrics_registry.register(CallbackMetric(
+        f'translate_tagger_cache_{field}{suffix}', documentation, _cache_metrics(field), ['cache'], metric_type))
+metrics_registry.register(CallbackMetric(
+    'translate_tagger_pending_jobs', 'Jobs queued or running.', lambda: [((), _pending_jobs)]))
+
+# --- Compression ---
+# Request bodies may be sent with Content-Encoding gzip, or zstd when the
+# zstandard package is installed, and responses are compressed with the
+# best encoding the client accepts.
+
+# Supported encodings, by order of preference
+CONTENT_ENCODINGS = ('zstd', 'gzip') if zstandard else ('gzip',)
+_COMPRESSIBLE_MIMETYPES = frozenset(['application/json', 'application/x-ndjson', 'text/plain', 'text/html'])
+
+class BodyTooLarge(ValueError):
+    """
+    Raised when a request body decompresses to more than the allowed size.
+    """
+
+def decompress(data, encoding, max_bytes=None):
+    """
+    Decompresses a body sent with Content-Encoding `encoding`. Raises
+    BodyTooLarge past `max_bytes` of output, and ValueError for other
+    encodings or corrupt data.
+    """
+    limit = 0 if max_bytes is None else max_bytes + 1
+    try:
+        if encoding == 'gzip':
+            decompressor = zlib.decompressobj(wbits=31)
+            output = decompressor.decompress(data, limit)
+            if not decompressor.eof and not (limit and len(output) >= limit):
+                raise ValueError('Truncated gzip data')
+        elif encoding == 'zstd' and zstandard:
+            with zstandard.ZstdDecompressor().stream_reader(data) as reader:
+                output = reader.read(limit) if limit else reader.readall()
+        else:
+            raise ValueError(f'Unsupported Content-Encoding: {encoding}')
+    except (zlib.error, getattr(zstandard, 'ZstdError', zlib.error)) as e:
+        raise ValueError(f'Invalid {encoding} data: {e}') from None
+    if max_bytes is not None and len(output) > max_bytes:
+        raise BodyTooLarge(f'The decompressed body exceeds the limit of {max_bytes} bytes')
+    return output
+
+def compress(data, encoding):
+    """
+    Compresses `data` for Content-Encoding `encoding`.
+    """
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor().compress(data)
+    compressor = zlib.compressobj(6, wbits=31)
+    return compressor.compress(data) + compressor.flush()
+
+def compress_chunks(chunks, encoding):
+    """
+    Compresses a streamed body chunk by chunk, flushing after every chunk
+    so that the client can decode each one as soon as it arrives.
+    """
+    if encoding == 'zstd':
+        compressor = zstandard.ZstdCompressor().compressobj()
+        flush = lambda: compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+    else:
+        compressor = zlib.compressobj(6, wbits=31)
+        flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+    for chunk in chunks:
+        if chunk:
+            yield compressor.compress(chunk) + flush()
+    yield compressor.flush()
+
+def encoded_etag(etag, encoding):
+    """
+    The ETag of the response with ETag `etag` once compressed with `encoding`.
+    """
+    return f'{etag}-{encoding}'
+
+def matching_etag(etag, if_none_match):
+    """
+    Returns the ETag of the response with ETag `etag`, plain or compressed,
+    that the If-None-Match ETags `if_none_match` contain, or None.
+    """
+    for candidate in (etag, *(encoded_etag(etag, encoding) for encoding in CONTENT_ENCODINGS)):
+        if if_none_match.contains(candidate):
+            return candidate
+    return None
+
+class _DecompressingStream(io.RawIOBase):
+    """
+    The body `stream` of a request sent with Content-Encoding `encoding`,
+    decompressed as it is read, so that at most a chunk of it is held in
+    memory. Raises ValueError for unsupported encodings. Reading raises
+    RequestEntityTooLarge past `max_bytes` of output, and
+    UnsupportedMediaType for corrupt data.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, stream, encoding, max_bytes=None):
+        if encoding == 'gzip':
+            self._decompressor = zlib.decompressobj(wbits=31)
+        elif encoding == 'zstd' and zstandard:
+            self._reader = zstandard.ZstdDecompressor().stream_reader(stream)
+        else:
+            raise ValueError(f'Unsupported Content-Encoding: {encoding}')
+        self.stream = stream
+        self.encoding = encoding
+        self.max_bytes = max_bytes
+        self.size = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        try:
+            if self.encoding == 'gzip':
+                data = self._read_gzip(len(buffer))
+            else:
+                data = self._reader.read(len(buffer))
+        except (zlib.error, getattr(zstandard, 'ZstdError', zlib.error)) as e:
+            raise UnsupportedMediaType(f'Invalid {self.encoding} data: {e}') from None
+        self.size += len(data)
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            raise RequestEntityTooLarge(f'The decompressed body exceeds the limit of {self.max_bytes} bytes')
+        buffer[:len(data)] = data
+        return len(data)
+
+    def _read_gzip(self, size):
+        decompressor = self._decompressor
+        while not decompressor.eof:
+            data = decompressor.unconsumed_tail or self.stream.read(self.CHUNK_SIZE)
+            if not data:
+                raise zlib.error('truncated data')
+            output = decompressor.decompress(data, size)
+            if output:
+                return output
+        return b''
+
+class _DecompressRequests:
+    """
+    WSGI middleware that decompresses request bodies sent with a
+    Content-Encoding while the routes read them, so that they only see
+    plain bodies. Bodies of any length are accepted, chunked ones
+    included, and the MAX_DECOMPRESSED_BYTES limit applies to their output.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+        if encoding and encoding != 'identity':
+            try:
+                stream = _DecompressingStream(
+                    get_input_stream(environ), encoding, app.config['MAX_DECOMPRESSED_BYTES'])
+            except ValueError as e:
+                payload = json.dumps({'error': str(e)}).encode('utf-8')
+                start_response('415 Unsupported Media Type',
+                               [('Content-Type', 'application/json'), ('Content-Length', str(len(payload)))])
+                return [payload]
+            # The decompressed length is unknown: the body is read to its end
+            environ = dict(environ, **{'wsgi.input': io.BufferedReader(stream), 'wsgi.input_terminated': True})
+            environ.pop('CONTENT_LENGTH', None)
+            del environ['HTTP_CONTENT_ENCODING']
+        return self.wsgi_app(environ, start_response)
+
+@app.errorhandler(RequestEntityTooLarge)
+@app.errorhandler(UnsupportedMediaType)
+def _request_body_error(e):
+    return jsonify({'error': e.description}), e.code
+
+app.wsgi_app = _DecompressRequests(app.wsgi_app)
+
+@app.after_request
+def _compress_response(response):
+    min_bytes = app.config['COMPRESS_MIN_BYTES']
+    if (min_bytes is None or response.mimetype not in _COMPRESSIBLE_MIMETYPES
+            or response.status_code < 200 or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers or response.direct_passthrough):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(CONTENT_ENCODINGS)
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = compress_chunks(response.iter_encoded(), encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < min_bytes:
+            return response
+        response.set_data(compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        # The compressed bytes differ, and so does their ETag
+        response.set_etag(encoded_etag(etag, encoding))
+    return response
+
+# Routes whose latency is recorded, by endpoint
+_TIMED_ENDPOINTS = {'convert': '/convert', 'api_convert': '/api/convert'}
+
+@app.before_request
+def _start_request_timer():
+    if request.endpoint in _TIMED_ENDPOINTS and app.config['CONVERSION_METRICS']:
+        g.request_started = time.perf_counter()
+
+@app.after_request
+def _record_request_latency(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        REQUEST_SECONDS.observe(
+            time.perf_counter() - started, path=_TIMED_ENDPOINTS[request.endpoint],
+            method=request.method, status=response.status_code)
+    return response
+
+def _input_too_large(wikitext):
+    """
+    Returns a 413 response if `wikitext` is above MAX_INPUT_BYTES.
+    """
+    max_bytes = app.config['MAX_INPUT_BYTES']
+    if max_bytes is not None and _byte_size(wikitext) > max_bytes:
+        return jsonify({'error': _input_size_error(max_bytes)}), 413
+    return None
+
+def _stream_conversion(wikitext, namespaces, include_original=True, as_text=False):
+    """
+    Returns the /api/convert body for `wikitext` as an iterator converting
+    the page as the body is sent: JSON, or the converted text alone with
+    `as_text`. The first chunk is converted before returning, so that
+    ConversionTimeout can still become a 422. Once the body has started, a
+    timeout ends the JSON with an "error" field, and cuts a text body off
+    before its end.
+    """
+    time_budget = app.config['CONVERSION_TIME_BUDGET']
+    chunks = convert_iter(wikitext, app.config['INCREMENTAL_CONVERSION'], namespaces, time_budget)
+    first = next(chunks, '')
+    if as_text:
+        return chain([first], chunks)
+
+    def body():
+        yield '{"converted": "' + json.dumps(first)[1:-1]
+        try:
+            for chunk in chunks:
+                yield json.dumps(chunk)[1:-1]
+        except ConversionTimeout:
+            yield '", "error": ' + json.dumps(_time_budget_error(time_budget)) + '}'
+            return
+        yield '", "original": ' + json.dumps(wikitext) + '}' if include_original else '"}'
+    return body()
+
+def output_options(args, data, accept):
+    """
+    Returns the form of /api/convert response a request asks for, from its
+    query string `args`, JSON payload `data` and Accept header `accept`:
+    the original is sent back unless include_original is false, and
+    clients preferring text/plain get the converted text only.
+    """
+    if 'include_original' in args:
+        include_original = _flag(args['include_original'])
+    else:
+        include_original = data.get('include_original', True) is not False
+    as_text = accept.best_match(['application/json', 'text/plain']) == 'text/plain'
+    return {'include_original': include_original, 'as_text': as_text}
+
+def respond_async(args, prefer):
+    """
+    Whether a /api/convert request lets large pages become jobs, with
+    ?async=1 in its query string `args` or respond-async in its Prefer
+    header `prefer`.
+    """
+    if 'async' in args:
+        return _flag(args['async'])
+    return any(preference.split(';', 1)[0].strip().lower() == 'respond-async'
+               for preference in (prefer or '').split(','))
+
+def response_variant(key, with_units=False, include_original=True, as_text=False):
+    """
+    Returns the cache key `key` extended with the form of the response,
+    so that every form gets its own ETag.
+    """
+    variant = key + ('-units' if with_units else '')
+    if as_text:
+        return variant + '-text'
+    return variant if include_original else variant + '-converted'
+
+def _conversion_response(wikitext, converted_text, include_original=True, as_text=False, **extra):
+    """
+    Returns the /api/convert response: JSON with the converted text, the
+    original unless `include_original` is false and the `extra` fields,
+    or the converted text alone as text/plain with `as_text`.
+    """
+    if as_text:
+        return Response(converted_text, mimetype='text/plain')
+    result = {'original': wikitext} if include_original else {}
+    result['converted'] = converted_text
+    result.update(extra)
+    return jsonify(result)
+
+def _flag(value):
+    """
+    Whether a query string flag such as ?trace=1 is set.
+    """
+    return value is not None and value.lower() not in ('', '0', 'false')
+
+@app.errorhandler(ConversionTimeout)
+def _conversion_timeout(e):
+    return jsonify({'error': _time_budget_error(app.config['CONVERSION_TIME_BUDGET'])}), 422
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """
+    Exposes the conversion metrics in the Prometheus text format.
+    """
+    if not app.config['CONVERSION_METRICS']:
+        return jsonify({'error': 'Metrics are disabled'}), 404
+    return Response(metrics_registry.exposition(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/')
+def index():
+    return render_template('home.html')
+
+@app.route('/convert', methods=['GET'])
+def redirect_to_home():
+    return render_template('home.html')
+
+@app.route('/convert', methods=['POST'])
+def convert():
+    wikitext = request.form.get('wikitext', '')
+    too_large = _input_too_large(wikitext)
+    if too_large:
+        return too_large
+    converted_text = convert_cached(wikitext)
+    return render_template('home.html', original=wikitext, converted=converted_text)
+
+@app.route('/api/convert', methods=['GET', 'POST'])
+def api_convert():
+    if request.method == 'GET':
+        return """
+        <h1>Translate Tagger API</h1>
+        <p>Send a POST request with JSON data to use this API.</p>
+        <p>Example:</p>
+        <pre>
+        curl -X POST https://translatetagger.toolforge.org/api/convert \\
+        -H "Content-Type: application/json" \\
+        -d '{"wikitext": "This is a test [[link|example]]"}'
+        </pre>
+        """
+    elif request.method == 'POST':
+        data = request.get_json()
+        if not data or 'wikitext' not in data:
+            return jsonify({'error': 'Missing "wikitext" in JSON payload'}), 400
+        
+        wikitext = data.get('wikitext', '')
+        try:
+            namespaces = get_namespaces(data.get('wiki') or request.args.get('wiki'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        with_units = _flag(request.args.get('units'))
+        output = output_options(request.args, data, request.accept_mimetypes)
+        jobs = respond_async(request.args, request.headers.get('Prefer'))
+        if _flag(request.args.get('trace')):
+            # Always converted inline and uncached, so that the timings are real
+            inline_max = app.config['INLINE_CONVERT_MAX_BYTES']
+            if inline_max is not None and _byte_size(wikitext) > inline_max:
+                return jsonify({'error': f'Traced pages are limited to {inline_max} bytes'}), 413
+            too_large = _input_too_large(wikitext)
+            if too_large:
+                return too_large
+            trace = trace_conversion(
+                wikitext, namespaces, app.config['CONVERSION_TIME_BUDGET'], app.config['TRACE_MAX_TOKENS'])
+            converted_text = trace.pop('converted')
+            extra = {'trace': trace}
+            if with_units:
+                extra['units'] = translation_units(converted_text)
+            # JSON even for clients preferring text/plain, which has no room for the trace
+            return _conversion_response(wikitext, converted_text, include_original=output['include_original'], **extra)
+        if 'old_wikitext' in data or 'old_converted' in data:
+            # Revision mode, uncached since the result depends on the old conversion
+            if not isinstance(data.get('old_wikitext'), str) or not isinstance(data.get('old_converted'), str):
+                return jsonify({'error': '"old_wikitext" and "old_converted" must be sent together'}), 400
+            previous = (data['old_wikitext'], data['old_converted'])
+            inline_max = app.config['INLINE_CONVERT_MAX_BYTES']
+            if jobs and inline_max is not None and any(_byte_size(text) > inline_max for text in (wikitext, *previous)):
+                return _queue_job(wikitext, namespaces, previous)
+            for text in (wikitext, *previous):
+                too_large = _input_too_large(text)
+                if too_large:
+                    return too_large
+            converted_text = convert_revision(*previous, wikitext, namespaces, app.config['CONVERSION_TIME_BUDGET'])
+            extra = {'units': translation_units(converted_text)} if with_units else {}
+            return _conversion_response(wikitext, converted_text, **output, **extra)
+        key = ConversionCache.key(wikitext, namespaces.name)
+        etag = conversion_etag(response_variant(key, with_units, **output), namespaces) if app.config['CONVERSION_ETAGS'] else None
+        matched = matching_etag(etag, request.if_none_match) if etag else None
+        if matched:
+            # The client already has this result
+            response = Response(status=304)
+            response.set_etag(matched)
+            return response
+
+        size = _byte_size(wikitext)
+        inline_max = app.config['INLINE_CONVERT_MAX_BYTES']
+        if jobs and inline_max is not None and size > inline_max and key not in conversion_cache:
+            # Large pages are converted in the background if the client can wait
+            return _queue_job(wikitext, namespaces)
+        cached = key in conversion_cache
+        too_large = _input_too_large(wikitext)
+        if too_large and not cached:
+            return too_large
+        stream_min = app.config['STREAM_CONVERT_MIN_BYTES']
+        if stream_min is not None and size > stream_min and not cached and not with_units:
+            # Sent as it is converted, without keeping the result in memory,
+            # and without an ETag since the conversion may still fail
+            return Response(_stream_conversion(wikitext, namespaces, **output),
+                            mimetype='text/plain' if output['as_text'] else 'application/json')
+
+        converted_text = convert_cached(wikitext, key, namespaces)
+        
+        extra = {'units': translation_units(converted_text)} if with_units else {}
+        response = _conversion_response(wikitext, converted_text, **output, **extra)
+        if etag:
+            response.set_etag(etag)
+        return response
+
+@app.route('/api/cache/stats', methods=['GET'])
+def api_cache_stats():
+    return jsonify({
+        'conversions': conversion_cache.stats(),
+        'segments': segment_cache.stats(),
+    })
+
+@app.route('/api/convert/batch', methods=['POST'])
+def api_convert_batch():
+    """
+    Converts a JSON array of {"id": ..., "wikitext": ...} documents from
+    the wiki given by the "wiki" query parameter. Results are returned in
+    the order of the input, each one carrying either "converted" or "error".
+    """
+    max_items = app.config['MAX_BATCH_ITEMS']
+    max_bytes = app.config['MAX_BATCH_BYTES']
+    if request.content_length is not None and request.content_length > max_bytes:
+        return jsonify({'error': f'Batch payload exceeds {max_bytes} bytes'}), 413
+
+    wiki = request.args.get('wiki')
+    try:
+        get_namespaces(wiki)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, list):
+        return jsonify({'error': 'Expected a JSON array of {"id", "wikitext"} objects'}), 400
+    if len(data) > max_items:
+        return jsonify({'error': f'Batch exceeds {max_items} items'}), 413
+
+    max_input_bytes = app.config['MAX_INPUT_BYTES']
+    results = []
+    texts = []
+    pending = []  # Indexes in `results` waiting for a conversion
+    total_size = 0
+    for item in data:
+        if not isinstance(item, dict) or not isinstance(item.get('wikitext'), str):
+            results.append({
+                'id': item.get('id') if isinstance(item, dict) else None,
+                'error': 'Missing "wikitext" string',
+            })
+            continue
+        size = _byte_size(item['wikitext'])
+        total_size += size
+        if max_input_bytes is not None and size > max_input_bytes:
+            results.append({'id': item.get('id'), 'error': _input_size_error(max_input_bytes)})
+            continue
+        results.append({'id': item.get('id')})
+        texts.append(item['wikitext'])
+        pending.append(len(results) - 1)
+    if total_size > max_bytes:
+        return jsonify({'error': f'Batch payload exceeds {max_bytes} bytes'}), 413
+
+    chunk_size = app.config['BATCH_CHUNK_SIZE']
+    chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+    chunk_results = get_executor().map(
+        _convert_many, chunks, repeat(wiki), repeat(app.config['CONVERSION_TIME_BUDGET']))
+    converted = (result for chunk in chunk_results for result in chunk)
+    for index, (converted_text, error) in zip(pending, converted):
+        if error is None:
+            results[index]['converted'] = converted_text
+        else:
+            results[index]['error'] = error
+
+    return jsonify({'results': results})
+
+@app.route('/api/convert/stream', methods=['POST'])
+def api_convert_stream():
+    """
+    Streams NDJSON in and out: every input line is a {"title", "wikitext"}
+    record and every output line is written as soon as that record is done.
+    The "wiki" query parameter selects the wiki the records come from.
+    """
+    try:
+        namespaces = get_namespaces(request.args.get('wiki'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    def lines():
+        try:
+            yield from convert_ndjson(
+                request.stream, namespaces, app.config['MAX_INPUT_BYTES'], app.config['CONVERSION_TIME_BUDGET'])
+        except (RequestEntityTooLarge, UnsupportedMediaType) as e:
+            # A compressed body can only be checked as it is read
+            yield json.dumps({'error': e.description}) + '\n'
+
+    return Response(stream_with_context(lines()), mimetype='application/x-ndjson')
+
+@app.route('/api/jobs', methods=['POST'])
+def api_create_job():
+    """
+    Queues the conversion of {"wikitext": ..., "wiki": ...} and returns
+    202 with the job, whose status can then be polled at /api/jobs/<id>.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('wikitext'), str):
+        return jsonify({'error': 'Missing "wikitext" in JSON payload'}), 400
+    try:
+        namespaces = get_namespaces(data.get('wiki') or request.args.get('wiki'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return _queue_job(data['wikitext'], namespaces)
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def api_get_job(job_id):
+    """
+    Reports the status and progress of a job, with the converted text
+    once it is done.
+    """
+    return _job_response(job_id)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Wiki Translate Tagger')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('serve', help='run the development web server (default)')
+    ndjson_parser = subparsers.add_parser(
+        'ndjson', help='convert NDJSON {"title", "wikitext"} records, one per line')
+    ndjson_parser.add_argument('input', nargs='?', default='-',
+                               type=argparse.FileType('r', encoding='utf-8'),
+                               help='input file (default: standard input)')
+    ndjson_parser.add_argument('output', nargs='?', default='-',
+                               type=argparse.FileType('w', encoding='utf-8'),
+                               help='output file (default: standard output)')
+    dump_parser = subparsers.add_parser(
+        'dump', help='convert a MediaWiki XML dump (.xml, .xml.bz2 or .xml.gz)')
+    dump_parser.add_argument('input', help='XML dump to convert')
+    dump_parser.add_argument('output', help='output dump file, or directory with --format dir')
+    dump_parser.add_argument('--format', choices=['xml', 'dir'], default='xml',
+                             help='write an XML dump or a directory of .wiki files (default: xml)')
+    dump_parser.add_argument('--workers', type=int, default=None,
+                             help='worker processes (default: number of CPUs)')
+    dump_parser.add_argument('--chunk-size', type=int, default=16,
+                             help='pages sent to a worker at a time (default: 16)')
+    dump_parser.add_argument('--resume', action='store_true',
+                             help='continue after the last page recorded in the checkpoint file')
+    for subparser in (ndjson_parser, dump_parser):
+        subparser.add_argument('--siteinfo', metavar='FILE',
+                               help='siteinfo JSON of the wiki the pages come from, for its namespace names')
+    args = parser.parse_args(argv)
+
+    namespaces = None
+    if getattr(args, 'siteinfo', None):
+        with open(args.siteinfo, encoding='utf-8') as f:
+            namespaces = NamespaceRegistry.from_siteinfo(args.siteinfo, json.load(f))
+
+    if args.command == 'dump':
+        from dumps import convert_dump, failures_path
+        try:
+            count = convert_dump(args.input, args.output, output_format=args.format,
+                                 workers=args.workers, chunk_size=args.chunk_size, resume=args.resume,
+                                 namespaces=namespaces)
+        except ValueError as e:
+            parser.exit(1, f'{e}\n')
+        print(f'Converted {count} pages', file=sys.stderr)
+        if os.path.exists(failures_path(args.output)):
+            print(f'Pages that failed are listed in {failures_path(args.output)}', file=sys.stderr)
+    elif args.command == 'ndjson':
+        for line in convert_ndjson(args.input, namespaces):
+            args.output.write(line)
+            args.output.flush()
+    else:
+        app.run(debug=True)
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    main()
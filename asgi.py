@@ -0,0 +1,456 @@
+"""
+ASGI entry point, for serving the converter with an ASGI server:
+
+    uvicorn asgi:application
+    python asgi.py --host 0.0.0.0 --port 8000   # needs uvicorn
+
+POST /api/convert is handled here without blocking the event loop. Cached
+results and small pages are answered at once; other pages are converted
+on a process pool of ASYNC_CONVERT_WORKERS, at most one page per worker.
+Pages of ASYNC_LARGE_MIN_BYTES or more may only use half of the workers,
+so small requests keep low latency while a few huge pages are converting.
+Every other request, and /api/convert requests using other options
+(trace, units, revisions, jobs asked for with ?async=1 or
+Prefer: respond-async), is served by the Flask app on ASYNC_FLASK_THREADS
+threads. Requests only wait when no worker or thread is free; when
+ASYNC_MAX_QUEUED are already waiting, or one cannot start within
+CONVERSION_TIME_BUDGET, the response is a 503 with Retry-After. Request
+bodies are decompressed and responses compressed as in the Flask app.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+from werkzeug.datastructures import MIMEAccept, MultiDict
+from werkzeug.http import parse_accept_header, parse_etags, quote_etag, unquote_etag
+
+from app import (
+    CONTENT_ENCODINGS, REQUEST_SECONDS, BodyTooLarge, ConversionCache, ConversionTimeout, _convert_many,
+    _byte_size, _input_size_error, _time_budget_error, app, compress, conversion_cache, conversion_etag,
+    convert_to_translatable_wikitext, decompress, encoded_etag, get_namespaces, matching_etag, output_options,
+    respond_async, response_variant, store_conversion,
+)
+
+# Seconds a client should wait before retrying after a 503
+RETRY_AFTER = 1
+
+# Larger responses are compressed in a thread rather than in the event loop
+THREADED_COMPRESSION_MIN_BYTES = 64 * 1024
+
+class _Overloaded(Exception):
+    """
+    Raised when a request cannot be given a worker or thread.
+    """
+
+class ConversionPool:
+    """
+    Process pool converting the pages of asgi.py, with a slot per worker.
+    Large pages also take one of `large_slots` slots, so that they never
+    hold every worker. Requests left to the Flask app run on a pool of
+    `threads` threads, with a slot per thread. When no slot is free, at
+    most `max_queued` requests wait for one.
+    """
+
+    def __init__(self, workers=None, max_queued=64, threads=16):
+        workers = workers or os.cpu_count() or 1
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.thread_executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='asgi-flask')
+        self.slots = asyncio.Semaphore(workers)
+        self.large_slots = asyncio.Semaphore(max(1, workers // 2))
+        self.thread_slots = asyncio.Semaphore(threads)
+        self.max_queued = max_queued
+        self.queued = 0
+
+    async def _acquire(self, gates, deadline):
+        """
+        Takes a slot of every gate in `gates` and returns them. Raises
+        _Overloaded if one is taken while `max_queued` requests are already
+        waiting, or if no slot frees up before `deadline`, a
+        time.monotonic() value or None.
+        """
+        acquired = []
+        try:
+            for gate in gates:
+                if gate.locked():
+                    await self._wait(gate, deadline)
+                else:
+                    await gate.acquire()  # Free, returns at once
+                acquired.append(gate)
+        except BaseException:
+            for gate in acquired:
+                gate.release()
+            raise
+        return acquired
+
+    async def _wait(self, gate, deadline):
+        if self.queued >= self.max_queued:
+            raise _Overloaded('Too many requests are waiting')
+        self.queued += 1
+        try:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            await asyncio.wait_for(gate.acquire(), timeout)
+        except asyncio.TimeoutError:
+            raise _Overloaded('No worker was free before the deadline') from None
+        finally:
+            self.queued -= 1
+
+    async def convert(self, wikitext, wiki, large, deadline):
+        """
+        Converts `wikitext` in a worker and returns (converted, error).
+        Raises _Overloaded if no slot can be had, see _acquire.
+        """
+        acquired = await self._acquire([self.large_slots, self.slots] if large else [self.slots], deadline)
+        try:
+            time_budget = None if deadline is None else max(deadline - time.monotonic(), 0)
+            loop = asyncio.get_running_loop()
+            [result] = await loop.run_in_executor(self.executor, _convert_many, [wikitext], wiki, time_budget)
+            return result
+        finally:
+            for gate in acquired:
+                gate.release()
+
+    async def run_in_thread(self, function, deadline):
+        """
+        Calls `function` in a thread and returns its result. Raises
+        _Overloaded if no slot can be had, see _acquire.
+        """
+        acquired = await self._acquire([self.thread_slots], deadline)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.thread_executor, function)
+        finally:
+            for gate in acquired:
+                gate.release()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.thread_executor.shutdown(wait=False, cancel_futures=True)
+
+_pool = None
+
+def get_pool():
+    """
+    Returns the ConversionPool, creating it in the running event loop on first use.
+    """
+    global _pool
+    if _pool is None:
+        _pool = ConversionPool(
+            app.config['ASYNC_CONVERT_WORKERS'], app.config['ASYNC_MAX_QUEUED'], app.config['ASYNC_FLASK_THREADS'])
+    return _pool
+
+# --- Responses ---
+
+async def _send_response(send, status, body=b'', headers=()):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+async def _send_json(send, status, data, headers=()):
+    body = json.dumps(data).encode('utf-8')
+    await _send_response(send, status, body, [('content-type', 'application/json'), *headers])
+
+async def _send_compressed(scope, send, body, headers):
+    """
+    Sends a 200 response, compressed with the best encoding the client accepts.
+    """
+    headers = [*headers, ('vary', 'Accept-Encoding')]
+    min_bytes = app.config['COMPRESS_MIN_BYTES']
+    encoding = parse_accept_header(_header(scope, b'accept-encoding')).best_match(CONTENT_ENCODINGS)
+    if encoding is not None and min_bytes is not None and len(body) >= min_bytes:
+        if len(body) >= THREADED_COMPRESSION_MIN_BYTES:
+            body = await asyncio.to_thread(compress, body, encoding)
+        else:
+            body = compress(body, encoding)
+        headers.append(('content-encoding', encoding))
+        # The compressed bytes differ, and so does their ETag
+        headers = [(name, quote_etag(encoded_etag(unquote_etag(value)[0], encoding)) if name == 'etag' else value)
+                   for name, value in headers]
+    await _send_response(send, 200, body, headers)
+
+def _header(scope, name):
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+# --- /api/convert ---
+
+def _convert_request(scope, body):
+    """
+    Returns (wikitext, wiki, output options) if the request is a plain
+    /api/convert one handled here, or None to leave it to the Flask app.
+    """
+    if scope['method'] != 'POST' or scope['path'] != '/api/convert':
+        return None
+    args = MultiDict(parse_qsl(scope['query_string'].decode('latin-1'), keep_blank_values=True))
+    if set(args) - {'wiki', 'include_original'} or respond_async(args, _header(scope, b'prefer')):
+        return None
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return None
+    if (not isinstance(data, dict) or not isinstance(data.get('wikitext'), str)
+            or set(data) - {'wikitext', 'wiki', 'include_original'}):
+        return None
+    output = output_options(args, data, parse_accept_header(_header(scope, b'accept'), MIMEAccept))
+    return data['wikitext'], data.get('wiki') or args.get('wiki'), output
+
+async def _api_convert(scope, send, wikitext, wiki, output):
+    """
+    Serves POST /api/convert like the Flask route, converting on the pool.
+    """
+    config = app.config
+    try:
+        namespaces = get_namespaces(wiki)
+    except ValueError as e:
+        await _send_json(send, 400, {'error': str(e)})
+        return
+    key = ConversionCache.key(wikitext, namespaces.name)
+    headers = []
+    if config['CONVERSION_ETAGS']:
+        etag = conversion_etag(response_variant(key, **output), namespaces)
+        matched = matching_etag(etag, parse_etags(_header(scope, b'if-none-match')))
+        if matched:
+            await _send_response(send, 304, headers=[('etag', quote_etag(matched))])
+            return
+        headers.append(('etag', quote_etag(etag)))
+    converted_text = conversion_cache.get(key)
+    if converted_text is None:
+        size = _byte_size(wikitext)
+        max_bytes = config['MAX_INPUT_BYTES']
+        if max_bytes is not None and size > max_bytes:
+            await _send_json(send, 413, {'error': _input_size_error(max_bytes)})
+            return
+        time_budget = config['CONVERSION_TIME_BUDGET']
+        if size <= config['ASYNC_INLINE_MAX_BYTES']:
+            # Faster than a round trip to a worker
+            try:
+                converted_text = convert_to_translatable_wikitext(
+                    wikitext, incremental=config['INCREMENTAL_CONVERSION'], namespaces=namespaces,
+                    time_budget=time_budget)
+            except ConversionTimeout:
+                await _send_json(send, 422, {'error': _time_budget_error(time_budget)})
+                return
+        else:
+            deadline = None if time_budget is None else time.monotonic() + time_budget
+            large = size >= config['ASYNC_LARGE_MIN_BYTES']
+            try:
+                converted_text, error = await get_pool().convert(wikitext, wiki, large, deadline)
+            except _Overloaded as e:
+                await _send_json(send, 503, {'error': str(e)}, [('retry-after', str(RETRY_AFTER))])
+                return
+            if error is not None:
+                # The worker only fails on its deadline, or on a bug
+                status = 500 if error.startswith('Conversion failed') else 422
+                await _send_json(send, status, {'error': _time_budget_error(time_budget) if status == 422 else error})
+                return
+        store_conversion(key, wikitext, converted_text, namespaces)
+    if output['as_text']:
+        body = converted_text.encode('utf-8')
+        headers.append(('content-type', 'text/plain; charset=utf-8'))
+    else:
+        result = {'original': wikitext} if output['include_original'] else {}
+        result['converted'] = converted_text
+        body = json.dumps(result).encode('utf-8')
+        headers.append(('content-type', 'application/json'))
+    await _send_compressed(scope, send, body, headers)
+
+# --- Flask ---
+
+def _wsgi_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_LENGTH':
+            continue
+        if name != 'CONTENT_TYPE':
+            name = 'HTTP_' + name
+        environ[name] = environ[name] + ',' + value if name in environ else value
+    return environ
+
+class _ClientGone(Exception):
+    """
+    Raised when the client disconnects before its response is sent.
+    """
+
+async def _wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+async def _call_flask(scope, body, receive, send):
+    """
+    Serves the request with the Flask app on a thread of the pool, with
+    the same backpressure as conversions. The app and the iteration of
+    its response run in that thread, so that streamed responses keep their
+    request context; chunks are handed over through a bounded queue. If
+    the client disconnects, the rest of the response is dropped and the
+    thread stops at the next chunk.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=8)
+    done = object()
+    cancelled = threading.Event()
+
+    def put(item):
+        if not cancelled.is_set():
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    def run():
+        def start_response(status, headers, exc_info=None):
+            put((int(status.split(' ', 1)[0]), headers))
+            return lambda data: put(data)
+        if cancelled.is_set():
+            return  # The client left while the request waited for a thread
+        try:
+            response = app.wsgi_app(_wsgi_environ(scope, body), start_response)
+            try:
+                for chunk in response:
+                    if cancelled.is_set():
+                        break
+                    if chunk:
+                        put(chunk)
+            finally:
+                if hasattr(response, 'close'):
+                    response.close()
+        except BaseException as e:
+            put(e)
+        put(done)
+
+    time_budget = app.config['CONVERSION_TIME_BUDGET']
+    deadline = None if time_budget is None else time.monotonic() + time_budget
+    worker = asyncio.ensure_future(get_pool().run_in_thread(run, deadline))
+    disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+
+    async def next_item():
+        get = asyncio.ensure_future(queue.get())
+        await asyncio.wait([get, worker, disconnected], return_when=asyncio.FIRST_COMPLETED)
+        if not get.done():
+            if worker.done() and worker.exception() is not None:
+                get.cancel()
+                raise worker.exception()  # No thread was free
+            if not worker.done():
+                get.cancel()
+                raise _ClientGone()
+        # Once the thread is done, all of its items are in the queue
+        item = await get
+        if isinstance(item, BaseException):
+            raise item
+        return item
+
+    try:
+        status, headers = await next_item()
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+        })
+        while (item := await next_item()) is not done:
+            await send({'type': 'http.response.body', 'body': item, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    except _Overloaded as e:
+        await _send_json(send, 503, {'error': str(e)}, [('retry-after', str(RETRY_AFTER))])
+    except _ClientGone:
+        pass
+    finally:
+        disconnected.cancel()
+        if not worker.done():
+            # Unblocks the thread, which drops the rest of the response
+            cancelled.set()
+            while not queue.empty():
+                queue.get_nowait()
+    await asyncio.wait([worker])  # The thread keeps its slot until it is done
+
+# --- Application ---
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if _pool is not None:
+                    _pool.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        return
+    body = await _read_body(receive)
+    if body is None:
+        return
+    encoding = (_header(scope, b'content-encoding') or '').strip().lower()
+    if encoding and encoding != 'identity':
+        try:
+            body = decompress(body, encoding, app.config['MAX_DECOMPRESSED_BYTES'])
+        except ValueError as e:
+            await _send_json(send, 413 if isinstance(e, BodyTooLarge) else 415, {'error': str(e)})
+            return
+        scope = dict(scope, headers=[(name, value) for name, value in scope['headers'] if name != b'content-encoding'])
+    convert_request = _convert_request(scope, body)
+    if convert_request is not None:
+        started = time.perf_counter()
+        status = []
+
+        async def send_timed(message):
+            if message['type'] == 'http.response.start':
+                status.append(message['status'])
+            await send(message)
+
+        await _api_convert(scope, send_timed, *convert_request)
+        if app.config['CONVERSION_METRICS']:
+            REQUEST_SECONDS.observe(time.perf_counter() - started, path='/api/convert', method='POST', status=status[0])
+        return
+    await _call_flask(scope, body, receive, send)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the Wiki Translate Tagger over ASGI with uvicorn')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on (default: 8000)')
+    args = parser.parse_args(argv)
+    try:
+        import uvicorn
+    except ImportError:
+        sys.exit('uvicorn is not installed: pip install uvicorn, or serve asgi:application with another ASGI server')
+    uvicorn.run(application, host=args.host, port=args.port)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,512 @@
+"""
+Benchmarks for the wikitext converter.
+
+Generates realistic pages with a seeded generator (paragraphs with nested
+links, file captions, lists, templates, tables, <syntaxhighlight> blocks,
+behaviour switches...), times `convert_to_translatable_wikitext` and every
+process_* helper, and reports throughput, latency percentiles and peak
+memory as JSON so that runs can be compared between commits:
+
+    python benchmark.py --sizes 1K 100K 1M 5M --output before.json
+    python benchmark.py --sizes 1K 100K 1M 5M --compare before.json
+    python benchmark.py --sizes 500K --baseline HEAD~1
+    python benchmark.py --sizes 1K --links 20000 --no-helpers   # per-link cost
+    python benchmark.py --sizes 1K --wrap 20000 --baseline HEAD~1  # <translate> wrapping cost
+
+`--worst-case` times pathological inputs (unterminated constructs, deep
+nesting...) at growing sizes and checks that the conversion time stays
+linear; `--fuzz N` converts N random fragments and checks that none raises,
+that incremental and streamed conversions agree with full conversion and
+that converting the result again changes nothing.
+The script exits with status 1 if either check fails.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+import types
+
+import app
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# --- Corpus Generation ---
+
+WORDS = (
+    'the of and to in is was for on that with as by at from his her an were are which this be '
+    'also has had first one their its new after who they have two been other when there all during '
+    'into school time may years more most only over city some world would where later up such used '
+    'many can state about national out known university united then made translation page community '
+    'project wiki help article editor language content meeting volunteers documentation'
+).split()
+
+TEMPLATE_NAMES = ['Note', 'Main', 'Cite web', 'Infobox', 'Clarify', 'Lang', 'Tracked', 'Done']
+SWITCHES = ['__NOTOC__', '__TOC__', '__FORCETOC__', '__NOEDITSECTION__', '__NOINDEX__']
+EMOJIS = ['\U0001F642', '✅', '⚠', '\U0001F4D6']
+CODE_SAMPLE = '''def greet(name):
+    """Says hello."""
+    return f"Hello, {name}!"
+'''
+
+class CorpusGenerator:
+    """
+    Generates deterministic, well-formed wikitext pages from a seed.
+    """
+
+    def __init__(self, seed=0):
+        self.random = random.Random(seed)
+
+    def words(self, low, high):
+        return ' '.join(self.random.choice(WORDS) for _ in range(self.random.randint(low, high)))
+
+    def title(self):
+        return app.capitalise_first_letter(self.words(1, 3))
+
+    def link(self):
+        kind = self.random.random()
+        if kind < 0.5:
+            return f'[[{self.title()}]]'
+        if kind < 0.8:
+            return f'[[{self.title()}|{self.words(1, 3)}]]'
+        if kind < 0.9:
+            return f'[[Special:{self.title().replace(" ", "")}]]'
+        return f'[[{self.title()}#{self.title()}|{self.words(1, 2)}]]'
+
+    def external_link(self):
+        return f'[https://example.org/{self.words(1, 2).replace(" ", "/")} {self.words(1, 4)}]'
+
+    def template(self):
+        name = self.random.choice(TEMPLATE_NAMES)
+        if self.random.random() < 0.5:
+            return f'{{{{{name}}}}}'
+        return f'{{{{{name}|{self.words(1, 3)}|text={self.words(2, 6)}}}}}'
+
+    def file(self):
+        name = f'{self.title().replace(" ", "_")}.{self.random.choice(["jpg", "png", "svg"])}'
+        if self.random.random() < 0.2:
+            return f'[[File:{name}|alt={self.random.choice(EMOJIS)}]]'
+        options = self.random.sample(['thumb', 'left', 'right', 'upright', '200px', 'frameless'], 2)
+        caption = f'{self.words(2, 6)} {self.link()}' if self.random.random() < 0.3 else self.words(2, 8)
+        return f'[[{self.random.choice(["File", "Image"])}:{name}|{"|".join(options)}|alt={self.words(1, 4)}|{caption}]]'
+
+    def inline(self):
+        kind = self.random.random()
+        if kind < 0.35:
+            return self.link()
+        if kind < 0.5:
+            return self.external_link()
+        if kind < 0.6:
+            return self.template()
+        if kind < 0.7:
+            return f'<code>{self.words(1, 2)}</code>'
+        if kind < 0.78:
+            return f'H<sub>{self.random.randint(2, 9)}</sub>O'
+        if kind < 0.85:
+            return '<br>'
+        if kind < 0.92:
+            return f'<small>{self.words(2, 5)}</small>'
+        return self.file()
+
+    def sentence(self):
+        chunks = [self.words(3, 12)]
+        for _ in range(self.random.randint(0, 3)):
+            chunks.append(self.inline())
+            chunks.append(self.words(1, 8))
+        return app.capitalise_first_letter(' '.join(chunks)) + '.'
+
+    def paragraph(self):
+        return ' '.join(self.sentence() for _ in range(self.random.randint(1, 5)))
+
+    def heading(self):
+        level = '=' * self.random.randint(2, 4)
+        return f'{level} {self.title()} {level}'
+
+    def list_block(self):
+        lines = []
+        for _ in range(self.random.randint(2, 8)):
+            marker = self.random.choice(['*', '*', '#', '**', ':', ';'])
+            lines.append(f'{marker} {self.sentence()}')
+        return '\n'.join(lines)
+
+    def table(self):
+        rows = ['{| class="wikitable"', f'! {self.title()} !! {self.title()} !! {self.title()}']
+        for _ in range(self.random.randint(2, 10)):
+            rows.append('|-')
+            rows.append(f'| {self.words(1, 4)} || {self.link()} || {self.words(1, 6)}')
+        rows.append('|}')
+        return '\n'.join(rows)
+
+    def syntax_highlight(self):
+        return f'<syntaxhighlight lang="python">\n{CODE_SAMPLE}</syntaxhighlight>'
+
+    def block(self):
+        kind = self.random.random()
+        if kind < 0.45:
+            return self.paragraph()
+        if kind < 0.6:
+            return self.heading()
+        if kind < 0.75:
+            return self.list_block()
+        if kind < 0.82:
+            return self.table()
+        if kind < 0.88:
+            return self.file()
+        if kind < 0.92:
+            return self.syntax_highlight()
+        if kind < 0.96:
+            return f'<blockquote>{self.paragraph()}</blockquote>'
+        return self.random.choice(SWITCHES)
+
+    def gallery(self, count):
+        """
+        Returns `count` links as found on image-heavy pages, four in five
+        of them file links.
+        """
+        return [self.file() if self.random.random() < 0.8 else self.link() for _ in range(count)]
+
+    def text_runs(self, count):
+        """
+        Returns `count` runs of text as merged by the converter before
+        they are wrapped in <translate> tags, with whitespace around them.
+        """
+        return [
+            self.random.choice(['', ' ', '\n']) + self.paragraph() + self.random.choice(['', '\n', '\n\n'])
+            for _ in range(count)
+        ]
+
+    def page(self, size):
+        """
+        Returns a page of at least `size` characters made of whole blocks.
+        """
+        blocks = []
+        length = 0
+        while length < size:
+            block = self.block()
+            blocks.append(block)
+            length += len(block) + 2
+        return '\n\n'.join(blocks)
+
+def generate_page(size, seed=0):
+    """
+    Returns a deterministic page of at least `size` characters.
+    """
+    return CorpusGenerator(seed).page(size)
+
+def parse_size(value):
+    """
+    Parses sizes such as 512, 64K or 5M into a number of characters.
+    """
+    units = {'K': 1024, 'M': 1024 * 1024}
+    value = value.strip().upper()
+    if value[-1:] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+# Pathological inputs of about `n` characters
+WORST_CASES = {
+    'unterminated_links': lambda n: '[[a ' * (n // 4),
+    'unterminated_external_links': lambda n: '[http://x ' * (n // 10),
+    'unterminated_tags': lambda n: '<poem>a ' * (n // 8),
+    'unterminated_templates': lambda n: '{{a ' * (n // 4),
+    'unterminated_tables': lambda n: '{|a ' * (n // 4),
+    'url_without_spaces': lambda n: 'http' * (n // 4),
+    'nested_links': lambda n: '[[a|' * (n // 8) + ']]' * (n // 8),
+    'nested_templates': lambda n: '{{a|' * (n // 8) + '}}' * (n // 8),
+    'stray_closers': lambda n: ']]}}|}' * (n // 6),
+    'list_items': lambda n: '\n#' * (n // 2),
+    'table_cells': lambda n: '{|\n|' + 'a||' * (n // 3) + '\n|}',
+    'table_rows': lambda n: '{|\n' + '|-\n|a\n' * (n // 7) + '|}',
+    'table_tags': lambda n: '{|\n|' + '<ref>a||<nowiki>|</nowiki>' * (n // 27) + '\n|}',
+}
+
+# Fragments combined at random by the fuzzer, most of them unbalanced
+FUZZ_PIECES = [
+    '[[', ']]', '{{', '}}', '{{{', '}}}', '{|', '|}', '|', '[http', 'http', ' ', '\n', '\n\n',
+    '* x', '\n* x', '\n# y', '#', ';', ':', '\n; t', 'a', 'word', '__TOC__', '<br>',
+    '[[l]]', '[[a|[[b]]]]', '[[File:x.png|thumb|cap]]', '[[Category:c]]', '[[File:i.png|alt=\U0001F642]]',
+    '[http://x.org d]', 'http://u ', '{{T}}', '{|t|}', '<code>c</code>', '<div>d</div>',
+    '<sub>2</sub>', '<math>m</math>', '<nowiki>n</nowiki>', '<poem>p</poem>', '<poem>', '</poem>',
+    '<ref>', '</ref>', '<ref>r [[l]]</ref>', '<ref name="a" />', '<references/>', '<br/>', '<div class="d">',
+    '</div>', '<gallery>', '</gallery>', '<code/>', '{|\n', '\n|-', '\n| ', '\n! ', ' || ', ' !! ',
+    '\n|+ c', ' style="s" | ', '\n|}', '\nFile:g.png|', 'link=l|', '<gallery mode="m">\nA.png|cap\n</gallery>',
+    '<translate>', '</translate>', '<translate>t [[l]]</translate>', '<languages/>', '<tvar name=v>x</tvar>',
+]
+
+# --- Measurements ---
+
+def percentile(sorted_values, fraction):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def time_runs(func, arg, min_time, min_runs=3, max_runs=1000):
+    """
+    Calls func(arg) repeatedly for at least `min_time` seconds and
+    `min_runs` runs, returning the sorted wall times in seconds.
+    """
+    timings = []
+    started = time.perf_counter()
+    while len(timings) < max_runs and (len(timings) < min_runs or time.perf_counter() - started < min_time):
+        start = time.perf_counter()
+        func(arg)
+        timings.append(time.perf_counter() - start)
+    return sorted(timings)
+
+def peak_memory(func, arg):
+    """
+    Returns the peak memory in bytes allocated while running func(arg).
+    """
+    tracemalloc.start()
+    try:
+        func(arg)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def latency_report(timings, size):
+    return {
+        'runs': len(timings),
+        'mean_ms': round(sum(timings) / len(timings) * 1000, 3),
+        'p50_ms': round(percentile(timings, 0.5) * 1000, 3),
+        'p90_ms': round(percentile(timings, 0.9) * 1000, 3),
+        'p99_ms': round(percentile(timings, 0.99) * 1000, 3),
+        'mb_per_second': round(size / percentile(timings, 0.5) / 1e6, 3),
+    }
+
+def benchmark_conversion(convert, text, min_time):
+    report = latency_report(time_runs(convert, text, min_time), len(text))
+    report['peak_memory_bytes'] = peak_memory(convert, text)
+    return report
+
+# Extra arguments the numbering pass passes to some helpers
+_HELPER_ARGS = {
+    'process_double_brackets': (0,),
+    'process_external_link': (0,),
+    'process_tvar_tag': ('code0',),
+}
+
+def benchmark_helpers(text):
+    """
+    Times the parser and every process_* helper on the nodes of `text`.
+    Returns {name: {calls, seconds, us_per_call}}.
+    """
+    start = time.perf_counter()
+    nodes = app.parse(text)
+    results = {'parse': {'calls': 1, 'seconds': round(time.perf_counter() - start, 6)}}
+
+    by_handler = {}
+    for node in nodes:
+        by_handler.setdefault(node.handler, []).append(node.text)
+    for handler, handler_parts in by_handler.items():
+        name = handler.__name__
+        args = _HELPER_ARGS.get(name, ())
+        start = time.perf_counter()
+        for part in handler_parts:
+            handler(part, *args)
+        seconds = time.perf_counter() - start
+        results[name] = {
+            'calls': len(handler_parts),
+            'seconds': round(seconds, 6),
+            'us_per_call': round(seconds / len(handler_parts) * 1e6, 3),
+        }
+    return dict(sorted(results.items()))
+
+def benchmark_links(module, links, min_time):
+    """
+    Times module.process_double_brackets on every link of `links`.
+    Returns {links, p50_ms, us_per_link}.
+    """
+    process = module.process_double_brackets
+    timings = time_runs(lambda links: [process(link, 0) for link in links], links, min_time)
+    p50 = percentile(timings, 0.5)
+    return {
+        'links': len(links),
+        'p50_ms': round(p50 * 1000, 3),
+        'us_per_link': round(p50 / len(links) * 1e6, 3),
+    }
+
+def best_time(func, arg, runs=3):
+    return min(time_runs(func, arg, 0, min_runs=runs, max_runs=runs))
+
+def benchmark_worst_cases(sizes, max_slope=1.3):
+    """
+    Times the conversion of every WORST_CASES input at each size and fits
+    the growth exponent between the smallest and the largest size.
+    Returns {case: {ms, slope, linear}}; `linear` is False when the time
+    grows faster than size ** max_slope.
+    """
+    results = {}
+    for name, make in WORST_CASES.items():
+        timings = [best_time(app.convert_to_translatable_wikitext, make(size)) for size in sizes]
+        slope = math.log(timings[-1] / timings[0]) / math.log(sizes[-1] / sizes[0])
+        results[name] = {
+            'ms': [round(t * 1000, 3) for t in timings],
+            'slope': round(slope, 2),
+            'linear': slope <= max_slope,
+        }
+    return results
+
+def fuzz(iterations, seed=0, max_pieces=15):
+    """
+    Converts random concatenations of FUZZ_PIECES fully, incrementally and
+    with convert_iter, and converts the result again. Returns {cases,
+    failures}, listing the inputs that raised, whose conversions differ or
+    whose second conversion changes the result.
+    """
+    rng = random.Random(seed)
+    failures = []
+    for _ in range(iterations):
+        text = ''.join(rng.choice(FUZZ_PIECES) for _ in range(rng.randint(1, max_pieces)))
+        try:
+            full = app.convert_to_translatable_wikitext(text)
+            incremental = app.convert_to_translatable_wikitext(text, incremental=True)
+            streamed = ''.join(app.convert_iter(text, chunk_size=1))
+            again = app.convert_to_translatable_wikitext(full)
+        except Exception as e:
+            failures.append({'input': text, 'error': repr(e)})
+            continue
+        if full != incremental:
+            failures.append({'input': text, 'error': 'incremental conversion differs'})
+        elif full != streamed:
+            failures.append({'input': text, 'error': 'streamed conversion differs'})
+        elif full != again:
+            failures.append({'input': text, 'error': 'converting the result again changes it'})
+    return {'cases': iterations, 'failures': failures}
+
+def benchmark_wrap(module, runs, min_time):
+    """
+    Times module._wrap_in_translate on every text run of `runs`.
+    Returns {runs, chars, p50_ms, ns_per_char}.
+    """
+    wrap = module._wrap_in_translate
+    timings = time_runs(lambda runs: [wrap(run) for run in runs], runs, min_time)
+    p50 = percentile(timings, 0.5)
+    chars = sum(map(len, runs))
+    return {
+        'runs': len(runs),
+        'chars': chars,
+        'p50_ms': round(p50 * 1000, 3),
+        'ns_per_char': round(p50 / chars * 1e9, 3),
+    }
+
+# --- Comparison Between Revisions ---
+
+def load_revision(rev):
+    """
+    Imports app.py as it was at the given git revision and returns the module.
+    """
+    source = subprocess.run(
+        ['git', 'show', f'{rev}:app.py'],
+        cwd=REPO_DIR, check=True, capture_output=True, text=True,
+    ).stdout
+    name = f'app_{rev}'.replace('~', '_').replace('^', '_').replace('/', '_')
+    module = types.ModuleType(name)
+    module.__file__ = os.path.join(REPO_DIR, 'app.py')
+    sys.modules[name] = module
+    exec(compile(source, f'{rev}:app.py', 'exec'), module.__dict__)
+    return module
+
+def current_commit():
+    result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                            cwd=REPO_DIR, capture_output=True, text=True)
+    return result.stdout.strip() or None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the wikitext converter on generated pages.')
+    parser.add_argument('--sizes', nargs='+', default=['1K', '10K', '100K', '1M', '5M'],
+                        help='page sizes, e.g. 512 64K 5M (default: 1K 10K 100K 1M 5M)')
+    parser.add_argument('--seed', type=int, default=0, help='corpus seed (default: 0)')
+    parser.add_argument('--min-time', type=float, default=1.0,
+                        help='minimum seconds spent timing each size (default: 1.0)')
+    parser.add_argument('--no-helpers', action='store_true',
+                        help='skip timing the individual process_* helpers')
+    parser.add_argument('--links', type=int, default=5000,
+                        help='number of links for the per-link micro-benchmark, 0 to skip (default: 5000)')
+    parser.add_argument('--wrap', type=int, default=5000,
+                        help='number of text runs for the <translate> wrapping micro-benchmark, '
+                             '0 to skip (default: 5000)')
+    parser.add_argument('--baseline', metavar='REV',
+                        help='also time the converter from this git revision')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='report speedups against a previous JSON report')
+    parser.add_argument('--worst-case', nargs='*', metavar='SIZE',
+                        help='check that pathological inputs convert in linear time, '
+                             'at the given sizes (default: 32K 64K 128K 256K)')
+    parser.add_argument('--fuzz', type=int, default=0, metavar='N',
+                        help='convert N random fragments and report failures (default: 0)')
+    parser.add_argument('--output', metavar='FILE', help='write the JSON report to FILE')
+    args = parser.parse_args(argv)
+
+    baseline = load_revision(args.baseline) if args.baseline else None
+    previous = {}
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            previous = {r['size']: r for r in json.load(f)['results']}
+
+    results = []
+    for size in map(parse_size, args.sizes):
+        text = generate_page(size, seed=args.seed)
+        result = {'size': size, 'chars': len(text)}
+        result.update(benchmark_conversion(app.convert_to_translatable_wikitext, text, args.min_time))
+        if baseline:
+            timings = time_runs(baseline.convert_to_translatable_wikitext, text, args.min_time)
+            result['baseline'] = latency_report(timings, len(text))
+            result['baseline']['speedup'] = round(result['baseline']['p50_ms'] / result['p50_ms'], 2)
+        if size in previous:
+            result['speedup_vs_previous'] = round(previous[size]['p50_ms'] / result['p50_ms'], 2)
+        results.append(result)
+
+    report = {
+        'meta': {
+            'commit': current_commit(),
+            'baseline': args.baseline,
+            'seed': args.seed,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+        },
+        'results': results,
+    }
+    if args.links:
+        links = CorpusGenerator(args.seed).gallery(args.links)
+        report['links'] = benchmark_links(app, links, args.min_time)
+        if baseline:
+            report['links']['baseline'] = benchmark_links(baseline, links, args.min_time)
+            report['links']['baseline']['speedup'] = round(
+                report['links']['baseline']['us_per_link'] / report['links']['us_per_link'], 2)
+    if args.wrap:
+        runs = CorpusGenerator(args.seed).text_runs(args.wrap)
+        report['wrap'] = benchmark_wrap(app, runs, args.min_time)
+        if baseline:
+            report['wrap']['baseline'] = benchmark_wrap(baseline, runs, args.min_time)
+            report['wrap']['baseline']['speedup'] = round(
+                report['wrap']['baseline']['ns_per_char'] / report['wrap']['ns_per_char'], 2)
+    if not args.no_helpers:
+        report['helpers'] = benchmark_helpers(generate_page(parse_size(args.sizes[-1]), seed=args.seed))
+    passed = True
+    if args.worst_case is not None:
+        sizes = [parse_size(size) for size in args.worst_case or ['32K', '64K', '128K', '256K']]
+        report['worst_case'] = benchmark_worst_cases(sizes)
+        passed = all(case['linear'] for case in report['worst_case'].values())
+    if args.fuzz:
+        report['fuzz'] = fuzz(args.fuzz, args.seed)
+        passed = passed and not report['fuzz']['failures']
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    print(output)
+    if not passed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+"""
+Offline conversion of MediaWiki XML dumps (Special:Export or
+pages-articles style), without the HTTP layer.
+
+Pages are read with a streaming parser and converted in chunks on a
+process pool; results are written in dump order, either as a new XML dump
+or as a directory of .wiki files. After every chunk the last finished page
+ID is recorded in a checkpoint file next to the output so that an
+interrupted run can be resumed. The <siteinfo> of the dump and the
+metadata of every revision are copied to XML output. Pages that fail to
+convert are left out of the output and listed in a failures file next to
+it, one JSON line per page.
+"""
+import bz2
+import gzip
+import json
+import os
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import quote
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape, quoteattr
+
+from app import convert_to_translatable_wikitext
+
+EXPORT_NAMESPACE = 'http://www.mediawiki.org/xml/export-0.11/'
+
+# `revision` is the XML of the fields of the revision other than its text,
+# and `error` why the page could not be converted
+Page = namedtuple('Page', ['title', 'ns', 'id', 'text', 'revision', 'error'], defaults=('', None))
+
+# Revision fields that describe the original text, and are not copied
+_TEXT_FIELDS = ('text', 'sha1')
+
+def open_dump(path):
+    """
+    Opens a dump for binary reading, decompressing .bz2 and .gz files.
+    """
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rb')
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+def _element_xml(elem, indent):
+    """
+    Serialises an element of the input dump with its children, without
+    the namespace of the input, for copying it to the output.
+    """
+    name = _local_name(elem.tag)
+    attributes = ''.join(f' {_local_name(key)}={quoteattr(value)}' for key, value in elem.attrib.items())
+    children = list(elem)
+    if children:
+        return (f'{indent}<{name}{attributes}>\n'
+                + ''.join(_element_xml(child, indent + '  ') for child in children)
+                + f'{indent}</{name}>\n')
+    if not elem.text:
+        return f'{indent}<{name}{attributes} />\n'
+    return f'{indent}<{name}{attributes}>{escape(elem.text)}</{name}>\n'
+
+def read_siteinfo(path):
+    """
+    Returns the XML of the <siteinfo> of the dump at `path`, or None if it
+    has none. Only the start of the dump is read.
+    """
+    with open_dump(path) as source:
+        for _, elem in ElementTree.iterparse(source, events=('end',)):
+            name = _local_name(elem.tag)
+            if name == 'siteinfo':
+                return _element_xml(elem, '  ')
+            if name == 'page':
+                return None
+    return None
+
+def iter_pages(source):
+    """
+    Yields a Page for every <page> element of the dump, keeping only the
+    page currently being read in memory. For dumps with several revisions
+    per page the last revision is used.
+    """
+    context = ElementTree.iterparse(source, events=('start', 'end'))
+    _, root = next(context)
+    for event, elem in context:
+        if event != 'end' or _local_name(elem.tag) != 'page':
+            continue
+        title = ns = page_id = None
+        text = revision = ''
+        for child in elem:
+            name = _local_name(child.tag)
+            if name == 'title':
+                title = child.text
+            elif name == 'ns':
+                ns = child.text
+            elif name == 'id':
+                page_id = child.text
+            elif name == 'revision':
+                revision = ''
+                for field in child:
+                    if _local_name(field.tag) == 'text':
+                        text = field.text or ''
+                    elif _local_name(field.tag) not in _TEXT_FIELDS:
+                        revision += _element_xml(field, '      ')
+        yield Page(title, ns, page_id, text, revision)
+        # Drop the finished page (and anything before it) from the tree
+        root.clear()
+
+def _convert_pages(pages, namespaces=None):
+    """
+    Converts a chunk of pages in a worker process. A page that fails is
+    returned with its error, so that the rest of the chunk is kept.
+    """
+    converted = []
+    for page in pages:
+        try:
+            converted.append(page._replace(text=convert_to_translatable_wikitext(page.text, namespaces=namespaces)))
+        except Exception as e:
+            converted.append(page._replace(error=f'Conversion failed: {e!r}'))
+    return converted
+
+def _iter_chunks(pages, chunk_size):
+    chunk = []
+    for page in pages:
+        chunk.append(page)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def convert_pages(pages, workers=None, chunk_size=16, namespaces=None):
+    """
+    Converts an iterable of pages on a process pool and yields the results
+    in input order. At most two chunks per worker are in flight at a time,
+    so memory stays bounded however long the dump is. `namespaces` is the
+    NamespaceRegistry of the wiki the dump comes from.
+    """
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        max_pending = 2 * workers
+        pending = deque()
+        for chunk in _iter_chunks(pages, chunk_size):
+            pending.append(executor.submit(_convert_pages, chunk, namespaces))
+            if len(pending) >= max_pending:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+class XMLDumpWriter:
+    """
+    Writes converted pages as a MediaWiki XML dump, starting with the
+    `siteinfo` XML of the input dump.
+    """
+
+    FOOTER = b'</mediawiki>\n'
+
+    def __init__(self, path, resume_offset=None, siteinfo=None):
+        if resume_offset is None:
+            self.file = open(path, 'wb')
+            self.file.write(f'<mediawiki xmlns="{EXPORT_NAMESPACE}">\n'.encode('utf-8'))
+            if siteinfo:
+                self.file.write(siteinfo.encode('utf-8'))
+        else:
+            self.file = open(path, 'r+b')
+            self.file.truncate(resume_offset)
+            self.file.seek(resume_offset)
+
+    def write(self, page):
+        self.file.write((
+            '  <page>\n'
+            f'    <title>{escape(page.title or "")}</title>\n'
+            f'    <ns>{escape(page.ns or "0")}</ns>\n'
+            f'    <id>{escape(page.id or "")}</id>\n'
+            '    <revision>\n'
+            f'{page.revision}'
+            f'      <text xml:space="preserve">{escape(page.text)}</text>\n'
+            '    </revision>\n'
+            '  </page>\n'
+        ).encode('utf-8'))
+
+    def offset(self):
+        self.file.flush()
+        return self.file.tell()
+
+    def close(self):
+        self.file.write(self.FOOTER)
+        self.file.close()
+
+class DirectoryWriter:
+    """
+    Writes every converted page to <directory>/<title>.wiki.
+    """
+
+    def __init__(self, path, resume_offset=None, siteinfo=None):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, page):
+        filename = quote((page.title or page.id or '').replace(' ', '_'), safe='') + '.wiki'
+        with open(os.path.join(self.path, filename), 'w', encoding='utf-8') as f:
+            f.write(page.text)
+
+    def offset(self):
+        return None
+
+    def close(self):
+        pass
+
+WRITERS = {'xml': XMLDumpWriter, 'dir': DirectoryWriter}
+
+def checkpoint_path(output):
+    return output.rstrip(os.sep) + '.checkpoint'
+
+def failures_path(output):
+    return output.rstrip(os.sep) + '.failures'
+
+def convert_dump(input_path, output, output_format='xml', workers=None, chunk_size=16, resume=False,
+                 namespaces=None):
+    """
+    Converts every page of the dump at `input_path` and writes the result to
+    `output`. With `resume`, pages up to the last page ID recorded in the
+    checkpoint file are skipped and the existing output and failures file
+    are continued from where the checkpoint left them; a ValueError is
+    raised if that page is not in the dump. Pages that fail are listed in
+    the failures file and the run goes on.
+    `namespaces` is the NamespaceRegistry of the wiki the dump comes from.
+    Returns the number of pages converted by this run.
+    """
+    checkpoint_file = checkpoint_path(output)
+    failures_file = failures_path(output)
+    last_page_id = resume_offset = None
+    if resume and os.path.exists(checkpoint_file):
+        with open(checkpoint_file, encoding='utf-8') as f:
+            checkpoint = json.load(f)
+        last_page_id = checkpoint['last_page_id']
+        resume_offset = checkpoint['offset']
+        if checkpoint.get('failures_offset') is not None and os.path.exists(failures_file):
+            # Drop the failures of the pages after the checkpoint, which are converted again
+            with open(failures_file, 'r+b') as f:
+                f.truncate(checkpoint['failures_offset'])
+    elif os.path.exists(failures_file):
+        os.remove(failures_file)  # Left by an earlier run
+    siteinfo = read_siteinfo(input_path) if output_format == 'xml' and resume_offset is None else None
+
+    count = done = 0
+    with open_dump(input_path) as source:
+        pages = iter_pages(source)
+        if last_page_id is not None:
+            for page in pages:
+                if page.id == last_page_id:
+                    break
+            else:
+                raise ValueError(f'Page {last_page_id} of {checkpoint_file} is not in {input_path}')
+        writer = WRITERS[output_format](output, resume_offset=resume_offset, siteinfo=siteinfo)
+        try:
+            for page in convert_pages(pages, workers=workers, chunk_size=chunk_size, namespaces=namespaces):
+                if page.error is None:
+                    writer.write(page)
+                    count += 1
+                else:
+                    _write_failure(failures_file, page)
+                done += 1
+                if done % chunk_size == 0:
+                    _write_checkpoint(checkpoint_file, page.id, writer.offset(), failures_file)
+            if done:
+                _write_checkpoint(checkpoint_file, page.id, writer.offset(), failures_file)
+        finally:
+            writer.close()
+    return count
+
+def _write_failure(path, page):
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps({'id': page.id, 'title': page.title, 'error': page.error}, ensure_ascii=False) + '\n')
+
+def _write_checkpoint(path, page_id, offset, failures_file):
+    failures_offset = os.path.getsize(failures_file) if os.path.exists(failures_file) else 0
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'last_page_id': page_id, 'offset': offset, 'failures_offset': failures_offset}, f)
+    os.replace(tmp_path, path)
@@ -0,0 +1,100 @@
+"""
+Persistent state of asynchronous conversion jobs.
+
+Jobs are kept in a small SQLite database so that the web process and the
+worker processes converting the pages can all read and update them. Every
+job expires `ttl` seconds after it was last updated; expired jobs are
+purged when new ones are created.
+"""
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    progress REAL NOT NULL DEFAULT 0,
+    wiki TEXT,
+    size INTEGER NOT NULL,
+    result TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    expires REAL NOT NULL
+)
+'''
+
+class JobStore:
+    """
+    Jobs stored in the SQLite database at `path`. A connection is opened
+    per operation, so one store can be shared between threads and a store
+    for the same path can be created in every worker process.
+    """
+
+    def __init__(self, path, ttl=3600):
+        self.path = path
+        self.ttl = ttl
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute(_SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        # Commits on success and always closes the connection
+        db = sqlite3.connect(self.path, timeout=30)
+        db.row_factory = sqlite3.Row
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def create(self, size, wiki=None, status=QUEUED, result=None):
+        """
+        Adds a job for a page of `size` characters and returns its ID.
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        progress = 1.0 if status == DONE else 0.0
+        with self._connect() as db:
+            db.execute(
+                'INSERT INTO jobs (id, status, progress, wiki, size, result, created, updated, expires)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (job_id, status, progress, wiki, size, result, now, now, now + self.ttl),
+            )
+        return job_id
+
+    def update(self, job_id, **fields):
+        """
+        Updates the status, progress, result or error of a job and pushes
+        back its expiry.
+        """
+        now = time.time()
+        fields.update(updated=now, expires=now + self.ttl)
+        assignments = ', '.join(f'{name} = ?' for name in fields)
+        with self._connect() as db:
+            db.execute(f'UPDATE jobs SET {assignments} WHERE id = ?', (*fields.values(), job_id))
+
+    def get(self, job_id):
+        """
+        Returns the job as a dict, or None if it does not exist or expired.
+        """
+        with self._connect() as db:
+            row = db.execute(
+                'SELECT * FROM jobs WHERE id = ? AND expires > ?', (job_id, time.time())
+            ).fetchone()
+        return dict(row) if row else None
+
+    def purge(self):
+        """
+        Deletes expired jobs and returns how many were deleted.
+        """
+        with self._connect() as db:
+            return db.execute('DELETE FROM jobs WHERE expires <= ?', (time.time(),)).rowcount
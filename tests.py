@@ -1,5 +1,27 @@
 import unittest
-from app import convert_to_translatable_wikitext, process_double_brackets
+import asyncio
+import gzip
+import json
+import os
+import random
+import tempfile
+import time
+from xml.etree import ElementTree
+import app as app_module
+import asgi
+from benchmark import (
+    FUZZ_PIECES, WORST_CASES, CorpusGenerator, benchmark_helpers, benchmark_links, benchmark_wrap, fuzz, generate_page,
+    parse_size,
+)
+from dumps import EXPORT_NAMESPACE, _local_name, checkpoint_path, convert_dump, failures_path
+from jobs import DONE, JobStore
+from metrics import Histogram, Registry
+from app import (
+    app, Category, ConversionCache, ConversionTimeout, ExternalLink, File, Link, ListItem, NamespaceRegistry, Switch, Tag,
+    Template, TemplateParameter, Text, convert_iter, convert_ndjson, convert_to_translatable_wikitext, get_namespaces,
+    parse, parse_template, process_double_brackets, render, segment_cache, split_namespace, trace_conversion,
+    convert_revision, translation_units, unit_hash,
+)
 
 class TestTranslatableWikitext(unittest.TestCase):
 
@@ -73,6 +95,31 @@ class TestTranslatableWikitext(unittest.TestCase):
             '<translate>[[<tvar name=0>Special:MyLanguage</tvar>/Help|Help]] ing</translate>'
         )
 
+    def test_file_caption_with_nested_link(self):
+        self.assertEqual(
+            convert_to_translatable_wikitext('[[File:Example.jpg|thumb|A caption with [[a link|text]] and {{T|x}}]]'),
+            '[[File:Example.jpg|thumb|<translate>A caption with [[a link|text]] and {{T|x}}</translate>]]'
+        )
+
+    def test_localised_namespaces(self):
+        self.assertEqual(
+            convert_to_translatable_wikitext('[[Datei:Karte.png|mini]] [[KATEGORIE:Hilfe]]'),
+            '[[File:Karte.png|mini]] [[Category:Hilfe{{#translation:}}]]'
+        )
+        self.assertEqual(
+            convert_to_translatable_wikitext('[[Datei:Karte.png|mini|hochkant=0.5|Eine Karte]]'),
+            '[[File:Karte.png|mini|hochkant=0.5|<translate>Eine Karte</translate>]]'
+        )
+        self.assertEqual(split_namespace('image:Foo.jpg'), ('File', 'Foo.jpg'))
+        self.assertEqual(split_namespace('Spécial:Recherche'), ('Special', 'Recherche'))
+        self.assertEqual(split_namespace('Filesystem'), (None, 'Filesystem'))
+
+    def test_link_with_extra_pipes(self):
+        self.assertEqual(
+            convert_to_translatable_wikitext('See [[a|b|c]].'),
+            '<translate>See [[a|b|c]].</translate>'
+        )
+
     def test_template_simple(self):
         self.assertEqual(
             convert_to_translatable_wikitext("{{Template Name}}"),
@@ -91,6 +138,35 @@ class TestTranslatableWikitext(unittest.TestCase):
             '<translate>Some text with</translate> {{A template here}} <translate>and more text.</translate>'
         )
 
+    def test_nested_templates(self):
+        self.assertEqual(
+            convert_to_translatable_wikitext('Text {{A|{{B|c}}|d}} more'),
+            '<translate>Text</translate> {{A|{{B|c}}|d}} <translate>more</translate>'
+        )
+
+    def test_template_parameter(self):
+        self.assertEqual(
+            convert_to_translatable_wikitext('{{{param|default}}} text'),
+            '{{{param|default}}} <translate>text</translate>'
+        )
+
+    def test_unterminated_template_is_text(self):
+        self.assertEqual(
+            convert_to_translatable_wikitext('Broken {{A and [[link]]'),
+            '<translate>Broken {{A and [[<tvar name=0>Special:MyLanguage</tvar>/Link|link]]</translate>'
+        )
+
+    def test_parse_template(self):
+        self.assertEqual(
+            parse_template('{{Infobox|Foo|title = Hello [[a|b]]|{{X|y=1}}|size=3}}'),
+            ('Infobox', [
+                TemplateParameter('1', 'Foo', False),
+                TemplateParameter('title', 'Hello [[a|b]]', True),
+                TemplateParameter('2', '{{X|y=1}}', False),
+                TemplateParameter('size', '3', False),
+            ])
+        )
+
     def test_nowiki_tag(self):
         self.assertEqual(
             convert_to_translatable_wikitext("Some text with <nowiki>[[Raw link]]</nowiki> content."),
@@ -110,7 +186,7 @@ class TestTranslatableWikitext(unittest.TestCase):
         )
 
     def test_code_tag_with_tvar(self):
-        # Assuming process_code_tag assigns tvar names sequentially starting from 0
+        # Assuming tvar tags assign tvar names sequentially starting from 0
         self.assertEqual(
             convert_to_translatable_wikitext("Here is <code>some code</code> for you."),
             "<translate>Here is <code><tvar name=code0>some code</tvar></code> for you.</translate>"
@@ -188,5 +264,1152 @@ class TestTranslatableWikitext(unittest.TestCase):
             "; <translate>Term</translate>\n: <translate>Definition</translate>\n: <translate>Description</translate>\n"
         )
 
+class TestTagPolicies(unittest.TestCase):
+
+    def test_wrap_keeps_whitespace_outside(self):
+        wrap = app_module._wrap_in_translate
+        self.assertEqual(wrap(' \n Hello world\t\n'), ' \n <translate>Hello world</translate>\t\n')
+        self.assertEqual(wrap('Hello'), '<translate>Hello</translate>')
+        self.assertEqual(wrap('\xa0Hello'), '<translate>\xa0Hello</translate>')
+        self.assertEqual(wrap(' \xa0\n'), ' \xa0\n')
+
+    def test_policies(self):
+        self.assertEqual(app_module.process_wrapped_tag('<div class="x">\n Text \n</div>'),
+                         '<div class="x"><translate>Text</translate></div>')
+        self.assertEqual(app_module.process_wrapped_tag('<div> </div>'), '<div> </div>')
+        self.assertEqual(app_module.process_tvar_tag('<code> x </code>', 'code3'),
+                         '<code><tvar name=code3>x</tvar></code>')
+        self.assertIs(parse('<math>x</math>')[0].policy, app_module.TagPolicy.passthrough)
+
+    def test_tvar_numbers_per_tag(self):
+        self.assertEqual(
+            convert_to_translatable_wikitext('<code>a</code> and <code>b</code>'),
+            '<translate><code><tvar name=code0>a</tvar></code> and <code><tvar name=code1>b</tvar></code></translate>'
+        )
+
+class TestTagRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.policies = dict(app_module.TAG_POLICIES)
+        self.void_tags = set(app_module.VOID_TAGS)
+
+    def tearDown(self):
+        app_module.TAG_POLICIES.clear()
+        app_module.TAG_POLICIES.update(self.policies)
+        app_module.VOID_TAGS.clear()
+        app_module.VOID_TAGS.update(self.void_tags)
+        app_module._compile_tokeniser()
+
+    def test_ref_content_is_converted(self):
+        self.assertEqual(
+            convert_to_translatable_wikitext('Fact.<ref>See [[Page]].</ref> More [[a]].'),
+            '<translate>Fact.<ref>See [[<tvar name=0>Special:MyLanguage</tvar>/Page|Page]].</ref>'
+            ' More [[<tvar name=1>Special:MyLanguage</tvar>/A|a]].</translate>'
+        )
+        self.assertEqual(
+            convert_to_translatable_wikitext(
+                'A<ref>{{Cite|x}} [[File:A.png|thumb|Map]] [http://example.org Site] <code>id</code></ref> b.'),
+            '<translate>A<ref>{{Cite|x}} [[File:A.png|thumb|Map]] [<tvar name=url0>http://example.org</tvar> Site]'
+            ' <code><tvar name=code0>id</tvar></code></ref> b.</translate>'
+        )
+
+    def test_ref_in_the_middle_of_a_sentence(self):
+        self.assertEqual(
+            convert_to_translatable_wikitext('The sky is blue<ref>Smith 2020</ref> and the grass is green.'),
+            '<translate>The sky is blue<ref>Smith 2020</ref> and the grass is green.</translate>'
+        )
+
+    def test_opaque_and_self_closing_tags(self):
+        self.assertEqual(
+            convert_to_translatable_wikitext('A<ref name="n" /> b\n<references/>\n<score>c d</score>'),
+            '<translate>A<ref name="n" /> b</translate>\n<references/>\n<score>c d</score>'
+        )
+        self.assertEqual(
+            convert_to_translatable_wikitext('<blockquote class="q">Quote</blockquote>'),
+            '<blockquote class="q"><translate>Quote</translate></blockquote>'
+        )
+
+    def test_register_tag(self):
+        text = 'Intro <site-box>Boxed text</site-box>'
+        self.assertEqual(convert_to_translatable_wikitext(text), '<translate>Intro <site-box>Boxed text</site-box></translate>')
+        app_module.register_tag('site-box', 'wrap')
+        self.assertEqual(
+            convert_to_translatable_wikitext(text),
+            '<translate>Intro</translate> <site-box><translate>Boxed text</translate></site-box>'
+        )
+        app_module.register_tag('hr', app_module.TagPolicy.passthrough, void=True)
+        self.assertEqual(convert_to_translatable_wikitext('a<hr>b'), '<translate>a</translate><hr><translate>b</translate>')
+        with self.assertRaises(ValueError):
+            app_module.register_tag('box', 'translate')
+        with self.assertRaises(ValueError):
+            app_module.register_tag('<box>', 'wrap')
+
+class TestTablesAndGalleries(unittest.TestCase):
+
+    def test_table_cells(self):
+        self.assertEqual(
+            convert_to_translatable_wikitext(
+                '{| class="wikitable"\n|+ Caption\n! Name !! style="x" | Note\n'
+                '|- style="y"\n| [[Apple]] || colspan=2 | A red fruit\n|}'
+            ),
+            '{| class="wikitable"\n|+ <translate>Caption</translate>\n'
+            '! <translate>Name</translate> !! style="x" | <translate>Note</translate>\n'
+            '|- style="y"\n| <translate>[[<tvar name=0>Special:MyLanguage</tvar>/Apple|Apple]]</translate>'
+            ' || colspan=2 | <translate>A red fruit</translate>\n|}'
+        )
+
+    def test_table_separators_inside_links_and_templates(self):
+        self.assertEqual(
+            convert_to_translatable_wikitext('{|\n| [[a|b]] text\n| {{T|x\n|y}} z\n|}'),
+            '{|\n| <translate>[[<tvar name=0>Special:MyLanguage</tvar>/A|b]] text</translate>\n'
+            '| {{T|x\n|y}} <translate>z</translate>\n|}'
+        )
+
+    def test_table_separators_inside_tags(self):
+        self.assertEqual(
+            convert_to_translatable_wikitext(
+                '{|\n| Text with <nowiki>||</nowiki> pipes || b\n| a<ref>x\n| y</ref>\n|}'),
+            '{|\n| <translate>Text with</translate> <nowiki><translate>||</translate></nowiki> '
+            '<translate>pipes</translate> || <translate>b</translate>\n'
+            '| <translate>a<ref>x\n| y</ref></translate>\n|}'
+        )
+
+    GALLERY = '<gallery mode="packed">\nFile:A.jpg|A [[cat]]\nB.png|alt=Text\nC.png|link=X|Two\nD.png\n</gallery>'
+
+    def test_gallery_captions(self):
+        self.assertEqual(
+            convert_to_translatable_wikitext(self.GALLERY),
+            '<gallery mode="packed">\nFile:A.jpg|<translate>A [[<tvar name=0>Special:MyLanguage</tvar>/Cat|cat]]'
+            '</translate>\nB.png|alt=Text\nC.png|link=X|<translate>Two</translate>\nD.png\n</gallery>'
+        )
+
+    def test_gallery_caption_before_options(self):
+        self.assertEqual(
+            convert_to_translatable_wikitext('<gallery>\nA.png|Caption|alt=x\nB.png|link=y| |page=2\n</gallery>'),
+            '<gallery>\nA.png|<translate>Caption</translate>|alt=x\nB.png|link=y| |page=2\n</gallery>'
+        )
+
+class TestAlreadyTranslatable(unittest.TestCase):
+
+    def test_markup_is_kept(self):
+        text = '<languages/>\n<translate>Done [[<tvar name=0>Special:MyLanguage</tvar>/A|a]]</translate>\n\nNew [[b]].'
+        self.assertEqual(
+            convert_to_translatable_wikitext(text),
+            '<languages/>\n<translate>Done [[<tvar name=0>Special:MyLanguage</tvar>/A|a]]</translate>\n\n'
+            '<translate>New [[<tvar name=0>Special:MyLanguage</tvar>/B|b]].</translate>'
+        )
+
+    def test_converting_twice_changes_nothing(self):
+        for page in (generate_page(20000, seed=3), TestTablesAndGalleries.GALLERY, '[[Category:C]] [[File:x.png|thumb|Cap]]'):
+            converted = convert_to_translatable_wikitext(page)
+            self.assertEqual(convert_to_translatable_wikitext(converted), converted)
+
+    def test_converting_fuzz_corpus_twice_changes_nothing(self):
+        rng = random.Random(7)
+        for _ in range(2000):
+            text = ''.join(rng.choice(FUZZ_PIECES) for _ in range(rng.randint(1, 25)))
+            converted = convert_to_translatable_wikitext(text)
+            self.assertEqual(convert_to_translatable_wikitext(converted), converted, text)
+
+    def test_stray_closing_tags_are_text(self):
+        for text, expected in [
+            ('</translate> x', '</translate> <translate>x</translate>'),
+            ('a </tvar> [[b]]', '<translate>a</translate> </tvar> <translate>[[<tvar name=0>Special:MyLanguage</tvar>/B|b]]</translate>'),
+        ]:
+            converted = convert_to_translatable_wikitext(text)
+            self.assertEqual(converted, expected)
+            self.assertEqual(convert_to_translatable_wikitext(converted), converted)
+
+    def test_unclosed_translate_tag_keeps_the_rest(self):
+        text = 'Intro [[a]]\n<translate>Open [[b]]'
+        self.assertEqual(
+            convert_to_translatable_wikitext(text),
+            '<translate>Intro [[<tvar name=0>Special:MyLanguage</tvar>/A|a]]</translate>\n<translate>Open [[b]]'
+        )
+
+    def test_raw_url_before_translate_tag(self):
+        converted = convert_to_translatable_wikitext('http://x.org<translate>t [[l]]</translate>')
+        self.assertEqual(converted, 'http://x.org<translate>t [[l]]</translate>')
+        self.assertEqual(convert_to_translatable_wikitext(converted), converted)
+
+    def test_converted_page_is_served_from_cache(self):
+        client = app.test_client()
+        converted = client.post('/api/convert', json={'wikitext': 'Cached [[again]].'}).get_json()['converted']
+        hits = app_module.conversion_cache.hits
+        response = client.post('/api/convert', json={'wikitext': converted})
+        self.assertEqual(response.get_json()['converted'], converted)
+        self.assertEqual(app_module.conversion_cache.hits, hits + 1)
+
+class TestParseAPI(unittest.TestCase):
+
+    SAMPLE = (
+        '* Item with [[link]]\n'
+        'See [[File:A.png|thumb|Caption]] and [[Category:Docs]].\n'
+        '{{Note|text=Hi}} [http://example.com site] <code>x</code>__NOTOC__'
+    )
+
+    def test_node_types(self):
+        nodes = parse(self.SAMPLE)
+        self.assertEqual([type(node) for node in nodes], [
+            ListItem, Text, File, Text, Category, Text, Template, Text, ExternalLink, Text, Tag, Switch,
+        ])
+        self.assertEqual(nodes[10].name, 'code')
+
+    def test_nodes_reference_source(self):
+        nodes = parse(self.SAMPLE)
+        self.assertEqual(''.join(node.text for node in nodes), self.SAMPLE)
+        for node in nodes:
+            self.assertIs(node.source, self.SAMPLE)
+            self.assertFalse(hasattr(node, '__dict__'))
+        link = nodes[2]
+        self.assertEqual(self.SAMPLE[link.start:link.end], '[[File:A.png|thumb|Caption]]')
+
+    def test_node_accessors(self):
+        nodes = parse('[[ Main Page |home]] {{Infobox|title=X}}')
+        self.assertIsInstance(nodes[0], Link)
+        self.assertEqual(nodes[0].target, 'Main Page')
+        self.assertEqual(nodes[2].name, 'Infobox')
+        self.assertEqual(nodes[2].parse()[1], [TemplateParameter('title', 'X', True)])
+
+    def test_render_matches_convert(self):
+        self.assertEqual(render(parse(self.SAMPLE)), convert_to_translatable_wikitext(self.SAMPLE))
+
+DEWIKI_SITEINFO = {
+    'batchcomplete': True,
+    'query': {
+        'namespaces': {
+            '-1': {'id': -1, 'case': 'first-letter', 'name': 'Spezial', 'canonical': 'Special'},
+            '0': {'id': 0, 'case': 'first-letter', 'name': ''},
+            '6': {'id': 6, 'case': 'first-letter', 'name': 'Datei', 'canonical': 'File'},
+            '14': {'id': 14, 'case': 'first-letter', 'name': 'Kategorie', 'canonical': 'Category'},
+        },
+        'namespacealiases': [{'id': 6, 'alias': 'Bild'}, {'id': 6, 'alias': 'Image'}],
+    },
+}
+
+class TestNamespaceRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.siteinfo_dir = tempfile.TemporaryDirectory()
+        with open(os.path.join(self.siteinfo_dir.name, 'dewiki.json'), 'w', encoding='utf-8') as f:
+            json.dump(DEWIKI_SITEINFO, f)
+        self.previous_dir = app.config['SITEINFO_DIR']
+        app.config['SITEINFO_DIR'] = self.siteinfo_dir.name
+
+    def tearDown(self):
+        app.config['SITEINFO_DIR'] = self.previous_dir
+        self.siteinfo_dir.cleanup()
+
+    def test_from_siteinfo(self):
+        registry = NamespaceRegistry.from_siteinfo('dewiki', DEWIKI_SITEINFO)
+        self.assertEqual(registry.split('bild:Karte.png'), ('File', 'Karte.png'))
+        self.assertEqual(registry.split('Category:Hilfe'), ('Category', 'Hilfe'))
+        self.assertEqual(registry.split('Fichier:Carte.png'), (None, 'Fichier:Carte.png'))
+
+    def test_formatversion_1(self):
+        siteinfo = {'query': {
+            'namespaces': {'6': {'id': 6, '*': 'Fichier', 'canonical': 'File'}},
+            'namespacealiases': [{'id': 14, '*': 'Catégorie principale'}],
+        }}
+        registry = NamespaceRegistry.from_siteinfo('frwiki', siteinfo)
+        self.assertEqual(registry.split('Fichier:Carte.png'), ('File', 'Carte.png'))
+        self.assertEqual(registry.split('catégorie_principale:X'), ('Category', 'X'))
+
+    def test_etag_follows_siteinfo(self):
+        registry = NamespaceRegistry.from_siteinfo('dewiki', DEWIKI_SITEINFO)
+        siteinfo = json.loads(json.dumps(DEWIKI_SITEINFO))
+        siteinfo['query']['namespacealiases'].append({'id': 14, 'alias': 'Kat'})
+        self.assertEqual(
+            app_module.conversion_etag('k', registry),
+            app_module.conversion_etag('k', NamespaceRegistry.from_siteinfo('dewiki', DEWIKI_SITEINFO))
+        )
+        self.assertNotEqual(
+            app_module.conversion_etag('k', registry),
+            app_module.conversion_etag('k', NamespaceRegistry.from_siteinfo('dewiki', siteinfo))
+        )
+
+    def test_conversion_per_wiki(self):
+        text = '[[Bild:Karte.png|Eine Karte]] [[Fichier:x]]'
+        self.assertEqual(
+            convert_to_translatable_wikitext(text, namespaces=get_namespaces('dewiki')),
+            '[[File:Karte.png|<translate>Eine Karte</translate>]] <translate>[[<tvar name=1>Special:MyLanguage</tvar>/Fichier:x|Fichier:x]]</translate>'
+        )
+        self.assertIs(get_namespaces('dewiki'), get_namespaces('dewiki'))
+
+    def test_unknown_wiki(self):
+        for wiki in ('nowiki', '../dewiki'):
+            with self.assertRaises(ValueError):
+                get_namespaces(wiki)
+
+    def test_api_wiki_profile(self):
+        client = app.test_client()
+        body = {'wikitext': '[[Kategorie:Hilfe]]', 'wiki': 'dewiki'}
+        response = client.post('/api/convert', json=body)
+        self.assertEqual(response.get_json()['converted'], '[[Category:Hilfe{{#translation:}}]]')
+        default = client.post('/api/convert', json={'wikitext': 'Plain [[Kategorie:Hilfe]] text.'})
+        dewiki = client.post('/api/convert?wiki=dewiki', json={'wikitext': 'Plain [[Kategorie:Hilfe]] text.'})
+        self.assertNotEqual(default.headers['ETag'], dewiki.headers['ETag'])
+        response = client.post('/api/convert', json={'wikitext': 'x', 'wiki': 'nowiki'})
+        self.assertEqual(response.status_code, 400)
+        response = client.post('/api/convert/batch?wiki=nowiki', json=[{'wikitext': 'x'}])
+        self.assertEqual(response.status_code, 400)
+
+class TestTrace(unittest.TestCase):
+
+    SAMPLE = 'See [[Main Page|home]] and [http://example.com site].\n{{T}} <code>x</code> end'
+
+    def test_trace_conversion(self):
+        trace = trace_conversion(self.SAMPLE)
+        self.assertEqual(trace['converted'], convert_to_translatable_wikitext(self.SAMPLE))
+        kinds = [(token['kind'], token['handler']) for token in trace['tokens']]
+        self.assertEqual(kinds[:4], [
+            ('text', '_wrap_in_translate'), ('link', 'process_double_brackets'),
+            ('text', '_wrap_in_translate'), ('external_link', 'process_external_link'),
+        ])
+        link = trace['tokens'][1]
+        self.assertEqual(self.SAMPLE[link['start']:link['end']], '[[Main Page|home]]')
+        self.assertEqual(trace['tvars'], {'0': 1, 'url0': 3, 'code0': 7})
+        self.assertEqual(trace['blocks'][0]['tokens'], [0, 1, 2, 3, 4])
+        self.assertEqual(set(trace['stages']), {'parse', 'render'})
+        self.assertEqual(len(trace['slowest']), len(trace['tokens']))
+
+    def test_trace_api(self):
+        response = app.test_client().post('/api/convert?trace=1', json={'wikitext': self.SAMPLE})
+        data = response.get_json()
+        self.assertEqual(data['converted'], convert_to_translatable_wikitext(self.SAMPLE))
+        self.assertIn('tokens', data['trace'])
+        self.assertNotIn('ETag', response.headers)
+        response = app.test_client().post('/api/convert?trace=1', json={'wikitext': self.SAMPLE},
+                                          headers={'Accept': 'text/plain'})
+        self.assertEqual(response.mimetype, 'application/json')
+        self.assertIn('tokens', response.get_json()['trace'])
+
+    def test_trace_limits(self):
+        trace = trace_conversion(self.SAMPLE, max_tokens=2)
+        self.assertEqual(len(trace['tokens']), 2)
+        self.assertTrue(trace['truncated'])
+        self.assertGreater(trace['token_count'], 2)
+        self.assertEqual(trace['tvars'], {'0': 1})
+        self.assertEqual(trace['blocks'][0]['tokens'], [0, 1])
+        self.assertFalse(trace_conversion(self.SAMPLE)['truncated'])
+        client = app.test_client()
+        previous_config = dict(app.config)
+        try:
+            app.config['INLINE_CONVERT_MAX_BYTES'] = 10
+            response = client.post('/api/convert?trace=1', json={'wikitext': self.SAMPLE})
+            self.assertEqual(response.status_code, 413)
+        finally:
+            app.config.update(previous_config)
+
+class TestTranslationUnits(unittest.TestCase):
+
+    SAMPLE = 'First [[a]] para.\n\n{{T}}\nSecond [http://x.org x].'
+
+    def test_units(self):
+        converted = convert_to_translatable_wikitext(self.SAMPLE)
+        units = translation_units(converted)
+        self.assertEqual([unit['tvars'] for unit in units], [['0'], ['url0']])
+        self.assertEqual(converted[units[1]['start']:units[1]['end']],
+                         'Second [<tvar name=url0>http://x.org</tvar> x].')
+        self.assertEqual(units[1]['hash'], unit_hash('Second [<tvar name=url0>http://x.org</tvar> x].'))
+        edited = translation_units(convert_to_translatable_wikitext(self.SAMPLE.replace('First', 'New')))
+        self.assertNotEqual(edited[0]['hash'], units[0]['hash'])
+        self.assertEqual(edited[1]['hash'], units[1]['hash'])
+
+    def test_units_api(self):
+        client = app.test_client()
+        plain = client.post('/api/convert', json={'wikitext': self.SAMPLE})
+        response = client.post('/api/convert?units=1', json={'wikitext': self.SAMPLE})
+        data = response.get_json()
+        self.assertNotIn('units', plain.get_json())
+        self.assertEqual(data['units'], translation_units(data['converted']))
+        self.assertNotEqual(response.headers['ETag'], plain.headers['ETag'])
+
+class TestConvertRevision(unittest.TestCase):
+
+    OLD = 'Intro [[a]] and [[b]].\n\n{{T}}\n\nSee [[c]] and <code>x</code> [http://x.org x].'
+
+    def test_tvar_names_are_kept(self):
+        old_converted = convert_to_translatable_wikitext(self.OLD)
+        new = 'Added [[n]].\n\n{{U}}\n\n' + self.OLD.replace('and [[b]]', 'and [[z]], [[b]]')
+        converted = convert_revision(self.OLD, old_converted, new)
+        units = translation_units(converted)
+        self.assertEqual([unit['tvars'] for unit in units], [['3'], ['0', '4', '1'], ['2', 'code0', 'url0']])
+        self.assertEqual(units[2]['hash'], translation_units(old_converted)[1]['hash'])
+        self.assertEqual(app_module._TVAR_NAME_RE.sub('<tvar>', converted),
+                         app_module._TVAR_NAME_RE.sub('<tvar>', convert_to_translatable_wikitext(new)))
+
+    def test_unchanged_page(self):
+        self.assertEqual(convert_revision(self.OLD, 'previous', self.OLD), 'previous')
+
+    def test_only_changed_segments_are_converted(self):
+        old = 'First [[a]] paragraph.\n\n{{T}}\n\nSecond [[b]].\n\n{{U}}\n\nThird [[c]].'
+        old_converted = convert_to_translatable_wikitext(old)
+        new = old.replace('Second [[b]]', 'Second [[b]] and [[d]]')
+        parsed = []
+        parse = app_module.parse
+
+        def recording(wikitext, namespaces=None):
+            parsed.append(wikitext)
+            return parse(wikitext, namespaces)
+
+        app_module.segment_cache.clear()
+        try:
+            app_module.parse = recording
+            converted = convert_revision(old, old_converted, new)
+        finally:
+            app_module.parse = parse
+        self.assertTrue(parsed)
+        self.assertFalse([text for text in parsed if 'First' in text or 'Third' in text])
+        self.assertEqual(converted, old_converted.replace(
+            'Second [[<tvar name=1>Special:MyLanguage</tvar>/B|b]].',
+            'Second [[<tvar name=1>Special:MyLanguage</tvar>/B|b]] and [[<tvar name=3>Special:MyLanguage</tvar>/D|d]].'))
+        # Without the old segments in old_converted, the whole page is converted
+        edited = old_converted.replace('Second', 'Edited')
+        self.assertEqual(app_module._TVAR_NAME_RE.sub('<tvar>', convert_revision(old, edited, new)),
+                         app_module._TVAR_NAME_RE.sub('<tvar>', convert_to_translatable_wikitext(new)))
+
+    def test_revision_api(self):
+        client = app.test_client()
+        old_converted = convert_to_translatable_wikitext(self.OLD)
+        new = 'Added [[n]].\n\n' + self.OLD
+        response = client.post('/api/convert', json={
+            'wikitext': new, 'old_wikitext': self.OLD, 'old_converted': old_converted})
+        self.assertEqual(response.get_json()['converted'], convert_revision(self.OLD, old_converted, new))
+        response = client.post('/api/convert', json={'wikitext': new, 'old_wikitext': self.OLD})
+        self.assertEqual(response.status_code, 400)
+        previous_config = dict(app.config)
+        try:
+            app.config['MAX_INPUT_BYTES'] = len(new)
+            response = client.post('/api/convert', json={
+                'wikitext': new, 'old_wikitext': self.OLD, 'old_converted': old_converted + ' ' * len(new)})
+            self.assertEqual(response.status_code, 413)
+        finally:
+            app.config.update(previous_config)
+
+    def test_link_descriptions_do_not_rename_tvars(self):
+        old_converted = convert_to_translatable_wikitext(self.OLD)
+        new = self.OLD.replace('[http://x.org x]', '[http://x.org y]').replace('[[c]]', '[[c|see c]]')
+        units = translation_units(convert_revision(self.OLD, old_converted, new))
+        self.assertEqual(units[1]['tvars'], ['2', 'code0', 'url0'])
+
+class TestMalformedInput(unittest.TestCase):
+
+    def test_unterminated_link_is_text(self):
+        self.assertEqual(
+            convert_to_translatable_wikitext('Open [[link and [[closed]]'),
+            '<translate>Open [[link and [[<tvar name=0>Special:MyLanguage</tvar>/Closed|closed]]</translate>'
+        )
+
+    def test_unterminated_external_link_is_text(self):
+        self.assertEqual(
+            convert_to_translatable_wikitext('See [http://example.org and <code>x</code>'),
+            '<translate>See [</translate>http://example.org <translate>and <code><tvar name=code0>x</tvar></code></translate>'
+        )
+
+    def test_process_double_brackets_rejects_unwrapped_input(self):
+        with self.assertRaises(ValueError):
+            process_double_brackets('[[link', 0)
+
+    def test_pathological_inputs_convert_quickly(self):
+        for name, make in WORST_CASES.items():
+            with self.subTest(name):
+                text = make(100000)
+                start = time.perf_counter()
+                convert_to_translatable_wikitext(text)
+                self.assertLess(time.perf_counter() - start, 5)
+
+    def test_time_budget(self):
+        with self.assertRaises(ConversionTimeout):
+            convert_to_translatable_wikitext('[[a]] ' * 100, time_budget=-1)
+        self.assertTrue(convert_to_translatable_wikitext('[[a]]', time_budget=10))
+
+    def test_api_limits(self):
+        client = app.test_client()
+        previous_config = dict(app.config)
+        try:
+            app.config['MAX_INPUT_BYTES'] = 10
+            response = client.post('/api/convert', json={'wikitext': 'Too large for the limit'})
+            self.assertEqual(response.status_code, 413)
+            response = client.post('/api/convert/batch', json=[{'id': 1, 'wikitext': 'Too large for the limit'}])
+            self.assertIn('error', response.get_json()['results'][0])
+            # Limits are in UTF-8 bytes: 4 characters, 12 bytes
+            response = client.post('/api/convert', json={'wikitext': 'ページ本'})
+            self.assertEqual(response.status_code, 413)
+            app.config['MAX_INPUT_BYTES'] = None
+            app.config['CONVERSION_TIME_BUDGET'] = -1
+            response = client.post('/api/convert', json={'wikitext': 'Over [[budget]] ' * 10})
+            self.assertEqual(response.status_code, 422)
+            self.assertIn('time budget', response.get_json()['error'])
+        finally:
+            app.config.update(previous_config)
+
+class TestConversionCache(unittest.TestCase):
+
+    def test_lru_eviction_by_entries(self):
+        cache = ConversionCache(max_entries=2)
+        cache.put('a', 'A')
+        cache.put('b', 'B')
+        self.assertEqual(cache.get('a'), 'A')  # 'b' is now the least recently used
+        cache.put('c', 'C')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 'C')
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (2, 1, 1))
+
+    def test_eviction_by_bytes(self):
+        cache = ConversionCache(max_entries=100, max_bytes=250)
+        cache.put('a', 'x' * 100)
+        cache.put('b', 'y' * 100)
+        self.assertIsNone(cache.get('a'))
+        self.assertLessEqual(cache.stats()['bytes'], 250)
+        cache.put('huge', 'z' * 1000)  # Larger than the whole cache, never stored
+        self.assertIsNone(cache.get('huge'))
+
+    def test_api_etag(self):
+        client = app.test_client()
+        response = client.post('/api/convert', json={'wikitext': '==HELLO=='})
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        response = client.post('/api/convert', json={'wikitext': '==HELLO=='}, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_data(), b'')
+        response = client.post('/api/convert', json={'wikitext': '==BYE=='}, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_etag_follows_tag_policies(self):
+        client = app.test_client()
+        body = {'wikitext': 'Some <etag-box>boxed</etag-box> text'}
+        etag = client.post('/api/convert', json=body).headers['ETag']
+        app_module.register_tag('etag-box', 'wrap')
+        self.addCleanup(app_module.register_tag, 'etag-box', 'passthrough')
+        response = client.post('/api/convert', json=body, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+class TestIncrementalConversion(unittest.TestCase):
+
+    PAGE = (
+        'Intro with [[First]] link.\n\n'
+        '* Item [[Second]]\n\n'
+        '{{Template|\n\nwith a blank line}}\n\n'
+        '<div>Div\n\ncontent</div>\n\n'
+        'Text with [https://example.org a link] and <code>x</code>.\n\n'
+        'Last [[Third]] paragraph.'
+    )
+
+    def test_same_output_as_full_conversion(self):
+        self.assertEqual(
+            convert_to_translatable_wikitext(self.PAGE, incremental=True),
+            convert_to_translatable_wikitext(self.PAGE),
+        )
+
+    def test_tvar_names_stay_global(self):
+        converted = convert_to_translatable_wikitext(self.PAGE, incremental=True)
+        self.assertIn('[[<tvar name=0>Special:MyLanguage</tvar>/First|First]]', converted)
+        self.assertIn('[[<tvar name=1>Special:MyLanguage</tvar>/Third|Third]]', converted)
+
+    def test_unchanged_paragraphs_are_reused(self):
+        convert_to_translatable_wikitext(self.PAGE, incremental=True)
+        misses = segment_cache.stats()['misses']
+        edited = self.PAGE.replace('Last', 'Final')
+        self.assertEqual(
+            convert_to_translatable_wikitext(edited, incremental=True),
+            convert_to_translatable_wikitext(edited),
+        )
+        # Only the edited paragraph had to be tokenised again
+        self.assertEqual(segment_cache.stats()['misses'], misses + 1)
+
+class TestBatchAPI(unittest.TestCase):
+
+    def setUp(self):
+        self.client = app.test_client()
+
+    def test_batch_results_in_order(self):
+        response = self.client.post('/api/convert/batch', json=[
+            {'id': 'a', 'wikitext': '[[link]]'},
+            {'id': 'b', 'wikitext': '__NOTOC__'},
+            {'id': 'c', 'wikitext': '==HELLO=='},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['results'], [
+            {'id': 'a', 'converted': '<translate>[[<tvar name=0>Special:MyLanguage</tvar>/Link|link]]</translate>'},
+            {'id': 'b', 'converted': '__NOTOC__'},
+            {'id': 'c', 'converted': '<translate>==HELLO==</translate>'},
+        ])
+
+    def test_batch_per_item_errors(self):
+        response = self.client.post('/api/convert/batch', json=[
+            {'id': 1, 'text': 'no wikitext'},
+            {'id': 2, 'wikitext': 'Hello'},
+        ])
+        results = response.get_json()['results']
+        self.assertEqual(results[0]['id'], 1)
+        self.assertIn('error', results[0])
+        self.assertEqual(results[1], {'id': 2, 'converted': '<translate>Hello</translate>'})
+
+    def test_batch_requires_array(self):
+        response = self.client.post('/api/convert/batch', json={'wikitext': 'Hello'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_batch_limits(self):
+        max_items = app.config['MAX_BATCH_ITEMS']
+        max_bytes = app.config['MAX_BATCH_BYTES']
+        try:
+            app.config['MAX_BATCH_ITEMS'] = 2
+            response = self.client.post('/api/convert/batch', json=[{'wikitext': 'a'}] * 3)
+            self.assertEqual(response.status_code, 413)
+            app.config['MAX_BATCH_BYTES'] = 10
+            response = self.client.post('/api/convert/batch', json=[{'wikitext': 'a' * 100}])
+            self.assertEqual(response.status_code, 413)
+        finally:
+            app.config['MAX_BATCH_ITEMS'] = max_items
+            app.config['MAX_BATCH_BYTES'] = max_bytes
+
+async def asgi_call(method, path, data=None, query=b'', headers=(), body=b'', disconnect=False):
+    """
+    Runs one request through the ASGI application and returns its
+    status, headers and body. After the body, the client waits for the
+    response, or disconnects if `disconnect` is set.
+    """
+    messages = []
+    received = []
+    if data is not None:
+        body = json.dumps(data).encode('utf-8')
+
+    async def receive():
+        if not received:
+            received.append(body)
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        if disconnect:
+            return {'type': 'http.disconnect'}
+        await asyncio.Event().wait()
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {
+        'type': 'http', 'method': method, 'path': path, 'query_string': query, 'root_path': '',
+        'headers': [(b'content-type', b'application/json'), *headers],
+    }
+    await asgi.application(scope, receive, send)
+    if not messages:
+        return None, {}, b''
+    return (messages[0]['status'], dict(messages[0]['headers']),
+            b''.join(message.get('body', b'') for message in messages[1:]))
+
+def asgi_request(*args, **kwargs):
+    return asyncio.run(asgi_call(*args, **kwargs))
+
+class TestAsgi(unittest.TestCase):
+
+    def setUp(self):
+        self.config = dict(app.config)
+        app.config.update(ASYNC_CONVERT_WORKERS=2, ASYNC_INLINE_MAX_BYTES=100)
+
+    def tearDown(self):
+        app.config.update(self.config)
+        if asgi._pool is not None:
+            asgi._pool.shutdown()
+            asgi._pool = None
+
+    def test_convert(self):
+        for wikitext in ('Small [[page]]', 'Larger [[page]] ' * 20):
+            status, headers, body = asgi_request('POST', '/api/convert', {'wikitext': wikitext})
+            self.assertEqual(status, 200)
+            self.assertEqual(json.loads(body)['converted'], convert_to_translatable_wikitext(wikitext))
+        status, _, _ = asgi_request('POST', '/api/convert', {'wikitext': wikitext}, headers=[(b'if-none-match', headers[b'etag'])])
+        self.assertEqual(status, 304)
+
+    def test_other_routes_are_served_by_flask(self):
+        status, _, body = asgi_request('POST', '/api/convert', {'wikitext': 'x'}, query=b'units=1')
+        self.assertEqual(status, 200)
+        self.assertIn('units', json.loads(body))
+        status, _, body = asgi_request('GET', '/api/cache/stats')
+        self.assertEqual(status, 200)
+        self.assertIn('conversions', json.loads(body))
+
+    def test_backpressure(self):
+        app.config.update(ASYNC_CONVERT_WORKERS=1, ASYNC_MAX_QUEUED=0)
+        # A free worker is used even when nothing may wait
+        status, _, _ = asgi_request('POST', '/api/convert', {'wikitext': 'Queued [[page]] ' * 20})
+        self.assertEqual(status, 200)
+
+        async def both():
+            return await asyncio.gather(*(
+                asgi_call('POST', '/api/convert', {'wikitext': 'Queued [[page]] %d ' % i * 20}) for i in range(2)))
+        responses = asyncio.run(both())
+        self.assertEqual(sorted(status for status, _, _ in responses), [200, 503])
+        self.assertIn(b'retry-after', max(responses)[1])
+        status, _, _ = asgi_request('POST', '/api/convert', {'wikitext': 'Inline'})
+        self.assertEqual(status, 200)
+
+    def test_flask_backpressure(self):
+        app.config.update(ASYNC_FLASK_THREADS=1, ASYNC_MAX_QUEUED=0)
+
+        async def both():
+            return await asyncio.gather(*(asgi_call('GET', '/api/cache/stats') for _ in range(2)))
+        responses = asyncio.run(both())
+        self.assertEqual(sorted(status for status, _, _ in responses), [200, 503])
+        app.config['ASYNC_MAX_QUEUED'] = 1
+        asgi._pool.shutdown()
+        asgi._pool = None
+        responses = asyncio.run(both())
+        self.assertEqual([status for status, _, _ in responses], [200, 200])
+
+    def test_client_disconnect(self):
+        app.config['ASYNC_FLASK_THREADS'] = 1
+        body = b'{"wikitext": "Some [[page]]"}\n' * 500
+
+        async def leave():
+            return await asyncio.wait_for(asgi_call('POST', '/api/convert/stream', body=body, disconnect=True), 10)
+        asyncio.run(leave())
+        # The thread stopped and gave its slot back
+        status, _, _ = asgi_request('GET', '/api/cache/stats')
+        self.assertEqual(status, 200)
+        self.assertEqual(asgi._pool.thread_slots._value, 1)
+
+class TestCompression(unittest.TestCase):
+
+    PAGE = 'Some [[page]] text.\n\n' * 200
+
+    def setUp(self):
+        self.client = app.test_client()
+
+    def test_gzip_request_and_response(self):
+        body = gzip.compress(json.dumps({'wikitext': self.PAGE}).encode('utf-8'))
+        response = self.client.post('/api/convert', data=body, headers={
+            'Content-Type': 'application/json', 'Content-Encoding': 'gzip', 'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        data = json.loads(gzip.decompress(response.get_data()))
+        self.assertEqual(data['converted'], convert_to_translatable_wikitext(self.PAGE))
+
+    @unittest.skipUnless(app_module.zstandard, 'zstandard is not installed')
+    def test_zstd(self):
+        zstandard = app_module.zstandard
+        body = zstandard.ZstdCompressor().compress(json.dumps({'wikitext': self.PAGE}).encode('utf-8'))
+        response = self.client.post('/api/convert', data=body, headers={
+            'Content-Type': 'application/json', 'Content-Encoding': 'zstd', 'Accept-Encoding': 'gzip, zstd'})
+        self.assertEqual(response.headers['Content-Encoding'], 'zstd')
+        data = json.loads(zstandard.ZstdDecompressor().decompressobj().decompress(response.get_data()))
+        self.assertEqual(data['converted'], convert_to_translatable_wikitext(self.PAGE))
+
+    def test_bad_request_bodies(self):
+        headers = {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+        response = self.client.post('/api/convert', data=b'not gzip', headers=headers)
+        self.assertEqual(response.status_code, 415)
+        response = self.client.post('/api/convert', data=b'x', headers=dict(headers, **{'Content-Encoding': 'br'}))
+        self.assertEqual(response.status_code, 415)
+        limit = app.config['MAX_DECOMPRESSED_BYTES']
+        try:
+            app.config['MAX_DECOMPRESSED_BYTES'] = 1000
+            body = gzip.compress(json.dumps({'wikitext': self.PAGE}).encode('utf-8'))
+            response = self.client.post('/api/convert', data=body, headers=headers)
+            self.assertEqual(response.status_code, 413)
+        finally:
+            app.config['MAX_DECOMPRESSED_BYTES'] = limit
+
+    def test_streamed_request_bodies(self):
+        body = gzip.compress(json.dumps({'wikitext': self.PAGE}).encode('utf-8'))
+        headers = {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+        # Chunked upload, without a Content-Length
+        response = self.client.post('/api/convert', data=body, headers=headers,
+                                    environ_overrides={'CONTENT_LENGTH': '', 'wsgi.input_terminated': True})
+        self.assertEqual(response.get_json()['converted'], convert_to_translatable_wikitext(self.PAGE))
+        response = self.client.post('/api/convert', data=body, headers=headers,
+                                    environ_overrides={'CONTENT_LENGTH': 'many'})
+        self.assertEqual(response.status_code, 415)
+        limit = app.config['MAX_DECOMPRESSED_BYTES']
+        try:
+            app.config['MAX_DECOMPRESSED_BYTES'] = 1000
+            response = self.client.post('/api/convert/stream', data=gzip.compress(b'{"wikitext": "a"}\n' * 100),
+                                        headers={'Content-Encoding': 'gzip'})
+            lines = response.get_data(as_text=True).splitlines()
+            self.assertIn('exceeds the limit', json.loads(lines[-1])['error'])
+        finally:
+            app.config['MAX_DECOMPRESSED_BYTES'] = limit
+
+    def test_etag_per_encoding(self):
+        plain = self.client.post('/api/convert', json={'wikitext': self.PAGE})
+        compressed = self.client.post('/api/convert', json={'wikitext': self.PAGE}, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(compressed.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(compressed.headers['ETag'], plain.headers['ETag'][:-1] + '-gzip"')
+        response = self.client.post('/api/convert', json={'wikitext': self.PAGE},
+                                    headers={'Accept-Encoding': 'gzip', 'If-None-Match': compressed.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], compressed.headers['ETag'])
+        status, headers, _ = asgi_request('POST', '/api/convert', {'wikitext': self.PAGE},
+                                          headers=[(b'accept-encoding', b'gzip')])
+        self.assertEqual(headers[b'etag'].decode('latin-1'), compressed.headers['ETag'])
+
+    def test_converted_only(self):
+        full = self.client.post('/api/convert', json={'wikitext': self.PAGE})
+        response = self.client.post('/api/convert?include_original=0', json={'wikitext': self.PAGE})
+        self.assertEqual(response.get_json(), {'converted': full.get_json()['converted']})
+        self.assertNotEqual(response.headers['ETag'], full.headers['ETag'])
+        response = self.client.post('/api/convert', json={'wikitext': self.PAGE, 'include_original': False})
+        self.assertNotIn('original', response.get_json())
+        response = self.client.post('/api/convert', json={'wikitext': self.PAGE}, headers={'Accept': 'text/plain'})
+        self.assertEqual(response.mimetype, 'text/plain')
+        self.assertEqual(response.get_data(as_text=True), full.get_json()['converted'])
+
+    def test_streamed_response(self):
+        stream_min = app.config['STREAM_CONVERT_MIN_BYTES']
+        try:
+            app.config['STREAM_CONVERT_MIN_BYTES'] = 100
+            response = self.client.post('/api/convert', json={'wikitext': self.PAGE + 'streamed'},
+                                        headers={'Accept-Encoding': 'gzip', 'Accept': 'text/plain'})
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(gzip.decompress(response.get_data()).decode('utf-8'),
+                             convert_to_translatable_wikitext(self.PAGE + 'streamed'))
+        finally:
+            app.config['STREAM_CONVERT_MIN_BYTES'] = stream_min
+
+    def test_asgi(self):
+        body = gzip.compress(json.dumps({'wikitext': self.PAGE, 'include_original': False}).encode('utf-8'))
+        status, headers, body = asgi_request('POST', '/api/convert', headers=[
+            (b'content-encoding', b'gzip'), (b'accept-encoding', b'gzip')], body=body)
+        self.assertEqual((status, headers[b'content-encoding']), (200, b'gzip'))
+        self.assertEqual(json.loads(gzip.decompress(body)), {'converted': convert_to_translatable_wikitext(self.PAGE)})
+
+class TestJobs(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.previous_config = dict(app.config)
+        app.config['JOB_DATABASE'] = os.path.join(self.directory.name, 'jobs.sqlite3')
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config.update(self.previous_config)
+        self.directory.cleanup()
+
+    def wait_for(self, location):
+        for _ in range(200):
+            job = self.client.get(location).get_json()
+            if job['status'] not in ('queued', 'running'):
+                return job
+            time.sleep(0.05)
+        self.fail('Job did not finish')
+
+    def test_job_lifecycle(self):
+        wikitext = generate_page(20000)
+        response = self.client.post('/api/jobs', json={'wikitext': wikitext})
+        self.assertEqual(response.status_code, 202)
+        self.assertIn(response.get_json()['status'], ('queued', 'running', 'done'))
+        job = self.wait_for(response.headers['Location'])
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual(job['progress'], 1.0)
+        self.assertEqual(job['converted'], convert_to_translatable_wikitext(wikitext))
+
+    def test_large_pages_become_jobs(self):
+        app.config['INLINE_CONVERT_MAX_BYTES'] = 10
+        # Only when the client asks for it
+        response = self.client.post('/api/convert', json={'wikitext': 'A sync page over the limit.'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['converted'], '<translate>A sync page over the limit.</translate>')
+        response = self.client.post('/api/convert?async=1', json={'wikitext': 'A page longer than the limit.'})
+        self.assertEqual(response.status_code, 202)
+        self.assertNotIn('Preference-Applied', response.headers)
+        job = self.wait_for(response.headers['Location'])
+        self.assertEqual(job['converted'], '<translate>A page longer than the limit.</translate>')
+        response = self.client.post('/api/convert', json={'wikitext': 'Another long page.'},
+                                    headers={'Prefer': 'wait=10, respond-async'})
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.headers['Preference-Applied'], 'respond-async')
+        self.assertEqual(self.wait_for(response.headers['Location'])['status'], 'done')
+        response = self.client.post('/api/convert?async=1', json={'wikitext': 'Short.'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_large_revisions_become_jobs(self):
+        old = TestConvertRevision.OLD
+        old_converted = convert_to_translatable_wikitext(old)
+        new = 'Added [[n]].\n\n' + old
+        app.config['INLINE_CONVERT_MAX_BYTES'] = 10
+        response = self.client.post('/api/convert', json={
+            'wikitext': new, 'old_wikitext': old, 'old_converted': old_converted})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post('/api/convert?async=1', json={
+            'wikitext': new, 'old_wikitext': old, 'old_converted': old_converted})
+        self.assertEqual(response.status_code, 202)
+        job = self.wait_for(response.headers['Location'])
+        self.assertEqual(job['converted'], convert_revision(old, old_converted, new))
+
+    def test_limits(self):
+        self.assertEqual(self.client.get('/api/jobs/missing').status_code, 404)
+        self.assertEqual(self.client.post('/api/jobs', json={}).status_code, 400)
+        app.config['MAX_JOB_BYTES'] = 5
+        self.assertEqual(self.client.post('/api/jobs', json={'wikitext': 'Too long'}).status_code, 413)
+        app.config['MAX_JOB_BYTES'] = 100
+        app.config['MAX_PENDING_JOBS'] = 0
+        response = self.client.post('/api/jobs', json={'wikitext': 'A new page.'})
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response.headers)
+
+    def test_store_expiry(self):
+        store = JobStore(os.path.join(self.directory.name, 'expiry.sqlite3'), ttl=60)
+        job_id = store.create(5, status=DONE, result='x')
+        self.assertEqual(store.get(job_id)['result'], 'x')
+        store.ttl = -1
+        store.update(job_id, progress=1.0)
+        self.assertIsNone(store.get(job_id))
+        self.assertEqual(store.purge(), 1)
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram_exposition(self):
+        registry = Registry()
+        histogram = registry.register(Histogram('latency_seconds', 'Latency.', ['path'], buckets=(0.1, 1.0)))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value, path='/x')
+        self.assertEqual(registry.exposition(), (
+            '# HELP latency_seconds Latency.\n'
+            '# TYPE latency_seconds histogram\n'
+            'latency_seconds_bucket{path="/x",le="0.1"} 2\n'
+            'latency_seconds_bucket{path="/x",le="1.0"} 3\n'
+            'latency_seconds_bucket{path="/x",le="+Inf"} 4\n'
+            'latency_seconds_sum{path="/x"} 3.65\n'
+            'latency_seconds_count{path="/x"} 4\n'
+        ))
+
+    def test_metrics_endpoint(self):
+        client = app.test_client()
+        client.post('/api/convert', json={'wikitext': 'Metrics test with <code>x</code> and [[File:A.png|thumb]].'})
+        body = client.get('/metrics').get_data(as_text=True)
+        self.assertIn('translate_tagger_constructs_total{kind="code"}', body)
+        self.assertIn('translate_tagger_constructs_total{kind="file"}', body)
+        self.assertIn('translate_tagger_conversion_stage_seconds_count{stage="parse"}', body)
+        self.assertIn('translate_tagger_request_duration_seconds_count{path="/api/convert",method="POST",status="200"}', body)
+        self.assertIn('translate_tagger_cache_hits_total{cache="conversions"}', body)
+
+    def test_metrics_disabled(self):
+        app.config['CONVERSION_METRICS'] = False
+        try:
+            self.assertEqual(app.test_client().get('/metrics').status_code, 404)
+        finally:
+            app.config['CONVERSION_METRICS'] = True
+
+class TestConvertIter(unittest.TestCase):
+
+    def test_chunks_join_to_conversion(self):
+        page = generate_page(20000, seed=2)
+        expected = convert_to_translatable_wikitext(page)
+        chunks = list(convert_iter(page, chunk_size=1000))
+        self.assertGreater(len(chunks), 10)
+        self.assertEqual(''.join(chunks), expected)
+        self.assertEqual(''.join(convert_iter(page, incremental=True)), expected)
+        self.assertEqual(list(convert_iter('')), [])
+
+    def test_api_streams_large_pages(self):
+        client = app.test_client()
+        page = generate_page(5000, seed=3)
+        previous_config = dict(app.config)
+        try:
+            # Pages above the job threshold are streamed too when no job is asked for
+            app.config.update(STREAM_CONVERT_MIN_BYTES=1000, INLINE_CONVERT_MAX_BYTES=2000)
+            response = client.post('/api/convert', json={'wikitext': page})
+            self.assertTrue(response.is_streamed)
+        finally:
+            app.config.update(previous_config)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), {
+            'original': page, 'converted': convert_to_translatable_wikitext(page),
+        })
+        self.assertNotIn('ETag', response.headers)
+
+    def test_streamed_timeouts(self):
+        client = app.test_client()
+        page = generate_page(5000, seed=3)
+        previous_config = dict(app.config)
+        convert_iter = app_module.convert_iter
+
+        def interrupted(*args):
+            yield 'Converted so far'
+            raise ConversionTimeout()
+
+        try:
+            app.config['STREAM_CONVERT_MIN_BYTES'] = 1000
+            app.config['CONVERSION_TIME_BUDGET'] = -1
+            response = client.post('/api/convert', json={'wikitext': page})
+            self.assertEqual(response.status_code, 422)
+            app.config['CONVERSION_TIME_BUDGET'] = 10
+            app_module.convert_iter = interrupted
+            response = client.post('/api/convert', json={'wikitext': page})
+            self.assertNotIn('ETag', response.headers)
+            data = response.get_json()
+            self.assertEqual(data['converted'], 'Converted so far')
+            self.assertIn('time budget', data['error'])
+            self.assertNotIn('original', data)
+        finally:
+            app_module.convert_iter = convert_iter
+            app.config.update(previous_config)
+
+class TestNDJSONStreaming(unittest.TestCase):
+
+    def test_convert_ndjson_records(self):
+        lines = list(convert_ndjson([
+            '{"title": "A", "wikitext": "==HELLO=="}\n',
+            '\n',
+            'not json\n',
+            '{"title": "B"}\n',
+        ]))
+        self.assertEqual(json.loads(lines[0]), {'title': 'A', 'converted': '<translate>==HELLO==</translate>'})
+        self.assertEqual(json.loads(lines[1])['line'], 3)
+        self.assertIn('error', json.loads(lines[1]))
+        self.assertEqual(json.loads(lines[2])['title'], 'B')
+        self.assertIn('error', json.loads(lines[2]))
+        self.assertEqual(len(lines), 3)
+
+    def test_stream_endpoint(self):
+        body = '{"title": "A", "wikitext": "[[link]]"}\n{"title": "B", "wikitext": "__NOTOC__"}\n'
+        response = app.test_client().post('/api/convert/stream', data=body, content_type='application/x-ndjson')
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertEqual([json.loads(line) for line in response.get_data(as_text=True).splitlines()], [
+            {'title': 'A', 'converted': '<translate>[[<tvar name=0>Special:MyLanguage</tvar>/Link|link]]</translate>'},
+            {'title': 'B', 'converted': '__NOTOC__'},
+        ])
+
+SAMPLE_DUMP = '''<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/" version="0.10">
+  <siteinfo><sitename>Test</sitename></siteinfo>
+  <page><title>Alpha</title><ns>0</ns><id>1</id><revision><id>10</id><timestamp>2024-01-02T03:04:05Z</timestamp>
+    <contributor><username>Ann &amp; Bob</username><id>7</id></contributor><model>wikitext</model>
+    <format>text/x-wiki</format><text xml:space="preserve">[[link]]</text><sha1>abc</sha1></revision></page>
+  <page><title>Beta/Sub</title><ns>0</ns><id>2</id><revision><id>11</id><text xml:space="preserve">__NOTOC__</text></revision></page>
+  <page><title>Gamma</title><ns>0</ns><id>3</id><revision><id>12</id><text xml:space="preserve">==HELLO==</text></revision></page>
+</mediawiki>
+'''
+
+class BrokenLinks:
+    """
+    The default namespaces, failing on every link.
+    """
+
+    def __getattr__(self, name):
+        return getattr(app_module.default_namespaces, name)
+
+    def match(self, *args):
+        raise ValueError('Broken link')
+
+class TestDumpConversion(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.input = os.path.join(self.tmpdir.name, 'dump.xml')
+        with open(self.input, 'w', encoding='utf-8') as f:
+            f.write(SAMPLE_DUMP)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_xml_output_in_order(self):
+        output = os.path.join(self.tmpdir.name, 'out.xml')
+        self.assertEqual(convert_dump(self.input, output, workers=2, chunk_size=1), 3)
+        ns = {'mw': EXPORT_NAMESPACE}
+        root = ElementTree.parse(output).getroot()
+        self.assertEqual(root.find('mw:siteinfo/mw:sitename', ns).text, 'Test')
+        pages = root.findall('mw:page', ns)
+        self.assertEqual([page.find('mw:title', ns).text for page in pages], ['Alpha', 'Beta/Sub', 'Gamma'])
+        revision = pages[0].find('mw:revision', ns)
+        self.assertEqual([_local_name(field.tag) for field in revision],
+                         ['id', 'timestamp', 'contributor', 'model', 'format', 'text'])
+        self.assertEqual(revision.find('mw:contributor/mw:username', ns).text, 'Ann & Bob')
+        self.assertEqual(
+            [page.find('mw:revision/mw:text', ns).text for page in pages],
+            ['<translate>[[<tvar name=0>Special:MyLanguage</tvar>/Link|link]]</translate>',
+             '__NOTOC__', '<translate>==HELLO==</translate>'],
+        )
+
+    def test_directory_output(self):
+        output = os.path.join(self.tmpdir.name, 'pages')
+        convert_dump(self.input, output, output_format='dir', workers=1)
+        self.assertEqual(sorted(os.listdir(output)), ['Alpha.wiki', 'Beta%2FSub.wiki', 'Gamma.wiki'])
+        with open(os.path.join(output, 'Gamma.wiki'), encoding='utf-8') as f:
+            self.assertEqual(f.read(), '<translate>==HELLO==</translate>')
+
+    def test_resume_xml_output(self):
+        output = os.path.join(self.tmpdir.name, 'out.xml')
+        convert_dump(self.input, output, workers=1)
+        with open(output, 'rb') as f:
+            complete = f.read()
+        # Pretend the previous run stopped after the second page
+        offset = complete.index(b'  <page>', complete.index(b'<id>2</id>'))
+        with open(checkpoint_path(output), 'w', encoding='utf-8') as f:
+            json.dump({'last_page_id': '2', 'offset': offset}, f)
+        self.assertEqual(convert_dump(self.input, output, workers=1, resume=True), 1)
+        with open(output, 'rb') as f:
+            self.assertEqual(f.read(), complete)
+        with open(checkpoint_path(output), 'w', encoding='utf-8') as f:
+            json.dump({'last_page_id': '99', 'offset': offset}, f)
+        with self.assertRaises(ValueError):
+            convert_dump(self.input, output, workers=1, resume=True)
+        with open(output, 'rb') as f:
+            self.assertEqual(f.read(), complete)
+
+    def test_resume_keeps_failures_once(self):
+        with open(self.input, 'w', encoding='utf-8') as f:
+            f.write(SAMPLE_DUMP.replace('==HELLO==', '[[hello]]'))
+        output = os.path.join(self.tmpdir.name, 'out.xml')
+        convert_dump(self.input, output, workers=1, chunk_size=1, namespaces=BrokenLinks())
+        with open(output, 'rb') as f:
+            complete = f.read()
+        with open(failures_path(output), 'rb') as f:
+            failures = f.read()
+        # Pretend the previous run stopped after the second page, with the
+        # failure of the third already written
+        offset = complete.index(b'</mediawiki>')
+        with open(checkpoint_path(output), 'w', encoding='utf-8') as f:
+            json.dump({'last_page_id': '2', 'offset': offset, 'failures_offset': failures.index(b'\n') + 1}, f)
+        convert_dump(self.input, output, workers=1, resume=True, namespaces=BrokenLinks())
+        with open(failures_path(output), 'rb') as f:
+            self.assertEqual(f.read(), failures)
+        self.assertEqual([json.loads(line)['id'] for line in failures.splitlines()], ['1', '3'])
+
+    def test_failed_pages_are_recorded(self):
+        output = os.path.join(self.tmpdir.name, 'out.xml')
+        self.assertEqual(convert_dump(self.input, output, workers=1, namespaces=BrokenLinks()), 2)
+        with open(failures_path(output), encoding='utf-8') as f:
+            failures = [json.loads(line) for line in f]
+        self.assertEqual([(failure['id'], failure['title']) for failure in failures], [('1', 'Alpha')])
+        self.assertIn('Broken link', failures[0]['error'])
+        ns = {'mw': EXPORT_NAMESPACE}
+        pages = ElementTree.parse(output).getroot().findall('mw:page', ns)
+        self.assertEqual([page.find('mw:title', ns).text for page in pages], ['Beta/Sub', 'Gamma'])
+
+class TestBenchmarkCorpus(unittest.TestCase):
+
+    def test_generator_is_deterministic(self):
+        self.assertEqual(generate_page(4096, seed=7), generate_page(4096, seed=7))
+        self.assertNotEqual(generate_page(4096, seed=7), generate_page(4096, seed=8))
+        self.assertGreaterEqual(len(generate_page(4096)), 4096)
+
+    def test_generated_pages_convert(self):
+        page = generate_page(20000, seed=1)
+        self.assertTrue(convert_to_translatable_wikitext(page))
+        helpers = benchmark_helpers(page)
+        self.assertIn('process_double_brackets', helpers)
+        self.assertIn('process_wrapped_tag', helpers)
+
+    def test_benchmark_links(self):
+        links = CorpusGenerator(1).gallery(50)
+        self.assertEqual(len(links), 50)
+        report = benchmark_links(app_module, links, 0)
+        self.assertEqual(report['links'], 50)
+        self.assertGreater(report['us_per_link'], 0)
+
+    def test_fuzz(self):
+        self.assertEqual(fuzz(500, seed=3)['failures'], [])
+
+    def test_benchmark_wrap(self):
+        runs = CorpusGenerator(1).text_runs(20)
+        report = benchmark_wrap(app_module, runs, 0)
+        self.assertEqual(report['chars'], sum(map(len, runs)))
+        self.assertGreater(report['ns_per_char'], 0)
+
+    def test_parse_size(self):
+        self.assertEqual([parse_size(s) for s in ('512', '64K', '5M')], [512, 65536, 5 * 1024 * 1024])
+
 if __name__ == '__main__':
     unittest.main(exit=False, failfast=True)